@@ -0,0 +1,92 @@
+"""
+Compare cache hit rates of the legacy and current `cached` key schemas.
+
+Replays a trace of get_id calls through the `cached` decorator from several
+simulated processes sharing one cache, once with the legacy key function and
+once with the current one.
+
+    python -m benchmarks.cache_key_hitrate --processes 8 --calls 200000
+    python -m benchmarks.cache_key_hitrate --trace urls.txt
+"""
+import argparse
+import md5
+import random
+
+from pminifier.cache import CacheBackend, KEY_VERSION
+from pminifier.redis_cache_backend import cached
+from benchmarks.traces import read_trace, url_for, zipf_trace
+
+class DictCacheBackend(CacheBackend):
+    """Stands in for the shared Redis/memcached tier"""
+    def __init__(self, params=None):
+        self.data = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def clear(self):
+        self.data.clear()
+
+class legacy_cached(cached):
+    """The key schema used before pminifier:v1 keys"""
+    def _cache_key(self, func, args, kw):
+        classname = args[0].__class__.__name__
+        funcname = func.__name__
+        mangled_args = str(args)+str(kw)
+        return "%s:%s:%s" % (classname, funcname, md5.md5(mangled_args).hexdigest())
+
+def make_process_class(decorator_class, backend):
+    class Process(object):
+        """One worker process with its own minifier instance"""
+        @decorator_class(backend)
+        def get_id(self, url, groupkey):
+            return url
+    return Process
+
+def replay(decorator_class, calls, processes, seed):
+    backend = DictCacheBackend()
+    process_class = make_process_class(decorator_class, backend)
+    workers = [process_class() for i in range(processes)]
+    rng = random.Random(seed)
+    for url in calls:
+        # callers hand in both unicode and byte strings
+        if rng.random() < 0.5:
+            url = unicode(url)
+        rng.choice(workers).get_id(url, 'bench')
+    return backend
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--calls', type=int, default=100000)
+    parser.add_argument('--urls', type=int, default=20000)
+    parser.add_argument('--alpha', type=float, default=1.0)
+    parser.add_argument('--trace', help='file with one url per line to replay')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    if options.trace:
+        calls = read_trace(options.trace)
+    else:
+        calls = [url_for(i) for i in zipf_trace(options.calls, options.urls,
+                                                options.alpha, options.seed)]
+
+    print '%i calls from %i processes' % (len(calls), options.processes)
+    for name, decorator_class in [('legacy', legacy_cached), (KEY_VERSION, cached)]:
+        backend = replay(decorator_class, calls, options.processes, options.seed)
+        total = backend.hits + backend.misses
+        print '%-8s hit rate %6.2f%%  keys %i' % (name, 100.0 * backend.hits / total,
+                                                 len(backend.data))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Compare hit rates of the in-process cache policies on a Zipf trace.
+
+Replays get_id calls through pylru (the LRU the minifiers used to wrap
+themselves with) and through LocalCache with each policy, all holding the
+same number of entries. Part of the trace are URLs only ever asked for
+once, like crawlers walking the long tail.
+
+    python -m benchmarks.l1_policy --size 500 --calls 200000
+    python -m benchmarks.l1_policy --trace urls.txt
+"""
+import argparse
+import random
+
+import pylru
+
+from pminifier.local_cache import POLICIES, LocalCache
+from benchmarks.traces import read_trace, url_for, zipf_trace
+
+def replay_pylru(calls, size):
+    cache = pylru.lrucache(size)
+    hits = 0
+    for url in calls:
+        if url in cache:
+            cache[url]
+            hits += 1
+        else:
+            cache[url] = url
+    return hits
+
+def replay_local(calls, size, policy):
+    cache = LocalCache(size, policy=policy)
+    for url in calls:
+        if cache.get(url) is None:
+            cache.set(url, url)
+    return cache.hits
+
+def make_calls(options):
+    if options.trace:
+        return read_trace(options.trace)
+    rng = random.Random(options.seed)
+    calls = [url_for(i) for i in zipf_trace(options.calls, options.urls,
+                                            options.alpha, options.seed)]
+    for i in xrange(int(len(calls) * options.one_hit)):
+        calls.insert(rng.randrange(len(calls)), url_for(options.urls + i))
+    return calls
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', type=int, default=500)
+    parser.add_argument('--calls', type=int, default=100000)
+    parser.add_argument('--urls', type=int, default=50000)
+    parser.add_argument('--alpha', type=float, default=0.9)
+    parser.add_argument('--one-hit', type=float, default=0.3,
+                        help='share of extra calls for urls seen only once')
+    parser.add_argument('--trace', help='file with one url per line to replay')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    calls = make_calls(options)
+    print '%i calls, %i entries' % (len(calls), options.size)
+    results = [('pylru', replay_pylru(calls, options.size))]
+    for policy in sorted(POLICIES):
+        results.append((policy, replay_local(calls, options.size, policy)))
+    for name, hits in results:
+        print '%-8s hit rate %6.2f%%' % (name, 100.0 * hits / len(calls))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Compare Redis memory and read throughput of the cache layouts.
+
+Writes SimplerMinifier style entries, both lookup directions of every
+URL, once as one Redis string per entry and once packed into hashes of
+about --per-bucket entries, then times batched reads of random URLs.
+Each layout uses its own database of the server, which is flushed.
+
+    python -m benchmarks.redis_layout --entries 1000000 --db 14
+
+For the hash layout to be compact, the server needs
+hash-max-listpack-entries above --per-bucket and hash-max-listpack-value
+above the longest URL, see pminifier.redis_hash_cache.
+"""
+import argparse
+import md5
+import random
+import time
+
+import redis
+
+from pminifier import base62
+from pminifier.redis_cache_backend import RedisCacheBackend
+from pminifier.redis_hash_cache import ENTRIES_PER_BUCKET, RedisHashCacheBackend
+from benchmarks.traces import url_for
+
+def cache_key(get_type, item):
+    return 'mini:bench:%s:%s' % (get_type, md5.md5(item).hexdigest())
+
+def entries(count, batch_size):
+    """Batches of {cache_key: value} of both directions of count URLs"""
+    for start in xrange(0, count, batch_size):
+        batch = {}
+        for i in xrange(start, min(count, start + batch_size)):
+            url, minified = url_for(i), base62.encode(i + 10 ** 9)
+            batch[cache_key('str', url)] = minified
+            batch[cache_key('id', minified)] = url
+        yield batch
+
+def used_memory(conn):
+    return conn.info('memory')['used_memory']
+
+def bench(name, conn, cache, options):
+    conn.flushdb()
+    before = used_memory(conn)
+    start = time.time()
+    for batch in entries(options.entries, 1000):
+        cache.set_many(batch)
+    write_seconds = time.time() - start
+    memory = used_memory(conn) - before
+
+    rng = random.Random(0)
+    reads = 0
+    start = time.time()
+    for i in xrange(options.reads // options.batch):
+        urls = [url_for(rng.randrange(options.entries)) for j in xrange(options.batch)]
+        reads += len(cache.get_many([cache_key('str', url) for url in urls]))
+    read_seconds = time.time() - start
+    print '%-8s %8i %12.1f %12i %12i' % (
+        name, conn.dbsize(), memory / float(2 * options.entries),
+        2 * options.entries / write_seconds, reads / read_seconds)
+    conn.flushdb()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=14,
+                        help='database to flush and use, and the next one')
+    parser.add_argument('--entries', type=int, default=200000, help='URLs to store')
+    parser.add_argument('--per-bucket', type=int, default=ENTRIES_PER_BUCKET)
+    parser.add_argument('--reads', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=100, help='URLs per read')
+    options = parser.parse_args()
+
+    strings = redis.Redis(options.host, options.port, options.db)
+    hashes = redis.Redis(options.host, options.port, options.db + 1)
+    buckets = max(1, 2 * options.entries // options.per_bucket)
+    print '%-8s %8s %12s %12s %12s' % ('layout', 'keys', 'bytes/entry', 'writes/s', 'reads/s')
+    bench('strings', strings, RedisCacheBackend({'client': strings, 'codec': 'bytes'}),
+          options)
+    bench('hashes', hashes, RedisHashCacheBackend({'client': hashes, 'codec': 'bytes',
+                                                   'buckets': buckets}), options)
+
+if __name__ == '__main__':
+    main()
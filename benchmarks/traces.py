@@ -0,0 +1,26 @@
+"""Synthetic access traces for the benchmarks."""
+import bisect
+import random
+
+def zipf_trace(length, population, alpha=1.0, seed=0):
+    """Returns `length` item numbers drawn from a Zipf(alpha) distribution
+    over `population` items, item 0 being the most popular."""
+    rng = random.Random(seed)
+    cumulative = []
+    total = 0.0
+    for rank in xrange(1, population + 1):
+        total += 1.0 / rank ** alpha
+        cumulative.append(total)
+    # shuffle ranks so popularity isn't correlated with item number order
+    items = range(population)
+    rng.shuffle(items)
+    return [items[bisect.bisect_left(cumulative, rng.random() * total)]
+            for i in xrange(length)]
+
+def read_trace(path):
+    """Reads one url per line"""
+    with open(path) as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+def url_for(item):
+    return 'http://example.com/articles/%i?utm_source=bench' % item
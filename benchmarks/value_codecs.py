@@ -0,0 +1,54 @@
+"""
+Compare cache value codecs per value type.
+
+Prints the encoded size and the time for an encode plus decode of typical
+minifier cache values with every codec.
+
+    python -m benchmarks.value_codecs --number 20000
+"""
+import argparse
+import timeit
+
+from pminifier import value_codecs
+from pminifier.value_codecs import get_codec
+
+LONG_URL = (u"https://www.google.com/#hl=en&output=search&sclient=psy-ab&q=parsely&qscrl=1"
+            u"&oq=parsely&aq=f&aqi=g-s4&aql=&gs_l=hp.3..0i10l4.2183l11396l0l11570l18l18l0l0"
+            u"l0l0l172l1787l10j8l18l0.frgbld.&pbx=1&bav=on.2,or.r_gc.r_pw.r_qf.,cf.osb"
+            u"&fp=3a4c3f9900aaf4a9&biw=1920&bih=982") * 4
+
+VALUES = [
+    ('base62 id', 'LfqqC7n0s'),
+    ('int id', 9999999999),
+    ('short url', u'http://www.youtube.com/'),
+    ('long url', LONG_URL),
+    ('batch dict', dict(('http://example.com/%i' % i, 'Fq%i' % i) for i in range(20))),
+]
+
+def codecs(threshold):
+    names = ['pickle', 'raw', 'int', 'auto']
+    if value_codecs.msgpack is not None:
+        names.append('msgpack')
+    res = [(name, get_codec(name)) for name in names]
+    res += [(name + '+zlib', get_codec(name, compress_threshold=threshold))
+            for name in ('pickle', 'raw')]
+    return res
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--compress-threshold', type=int, default=256)
+    options = parser.parse_args()
+
+    print '%-12s %-12s %8s %10s' % ('value', 'codec', 'bytes', 'us/op')
+    for value_name, value in VALUES:
+        for codec_name, codec in codecs(options.compress_threshold):
+            data = codec.encode(value)
+            seconds = timeit.timeit(lambda: codec.decode(codec.encode(value)),
+                                    number=options.number)
+            print '%-12s %-12s %8i %10.2f' % (value_name, codec_name, len(data),
+                                              seconds / options.number * 1e6)
+        print
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Conversion between integer IDs and their base62 minified form.
+
+Decoding uses a precomputed character table and exact integer arithmetic.
+The *_many functions convert whole batches and use numpy when it's
+installed and the batch is large enough to pay for it.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ALPHABET = '2FQYNEJAUsbGu41zndZTeocMai5H7OIjXkKg8qyt3WC9hLplxfVBm0wSRr6vPD'
+
+# Below this many items the pure python loop is faster than numpy
+NUMPY_MIN_BATCH = 64
+# Widest string numpy decodes without overflowing an int64 (62**10 < 2**63)
+_NUMPY_MAX_WIDTH = 10
+# Digits of the largest int64
+_NUMPY_ENCODE_WIDTH = 11
+
+_tables = {}
+
+def encode(id, alphabet=ALPHABET):
+    """Convert the int id to a user-friendly string using base62"""
+    if id < 0:
+        raise ValueError("Must supply a positive integer.")
+    base = len(alphabet)
+    converted = []
+    while id != 0:
+        id, r = divmod(id, base)
+        converted.append(alphabet[r])
+    converted.reverse()
+    return "".join(converted) or '0'
+
+def decode(minified, alphabet=ALPHABET):
+    """Convert the base62 string back to an int"""
+    values = _table(alphabet)['values']
+    base = len(alphabet)
+    output = 0
+    try:
+        for c in minified:
+            output = output * base + values[c]
+    except KeyError:
+        raise ValueError("Minified ID contains invalid characters '%s'" %
+                         "".join(set(minified) - set(alphabet)))
+    return output
+
+def encode_many(ids, alphabet=ALPHABET):
+    """Converts a sequence of ints, returns a list of strings"""
+    ids = list(ids)
+    if numpy is None or len(ids) < NUMPY_MIN_BATCH:
+        return [encode(id, alphabet) for id in ids]
+    try:
+        array = numpy.array(ids, dtype=numpy.int64)
+    except (OverflowError, TypeError, ValueError):
+        return [encode(id, alphabet) for id in ids]
+    if (array < 0).any():
+        raise ValueError("Must supply a positive integer.")
+
+    base = len(alphabet)
+    digits = numpy.empty((len(ids), _NUMPY_ENCODE_WIDTH), dtype=numpy.uint8)
+    for column in xrange(_NUMPY_ENCODE_WIDTH - 1, -1, -1):
+        array, digits[:, column] = numpy.divmod(array, base)
+    chars = _table(alphabet)['chars'][digits]
+    padded = chars.view('S%i' % _NUMPY_ENCODE_WIDTH).ravel().tolist()
+    return [s.lstrip(alphabet[0]) or '0' for s in padded]
+
+def decode_many(minified, alphabet=ALPHABET):
+    """Converts a sequence of base62 strings, returns a list of ints"""
+    minified = list(minified)
+    width = max(len(m) for m in minified) if minified else 0
+    if numpy is None or len(minified) < NUMPY_MIN_BATCH or width > _NUMPY_MAX_WIDTH:
+        return [decode(m, alphabet) for m in minified]
+    try:
+        # padding with the zero digit doesn't change the value
+        buf = "".join(str(m).rjust(width, alphabet[0]) for m in minified)
+    except UnicodeEncodeError:
+        return [decode(m, alphabet) for m in minified]
+
+    values = _table(alphabet)['lookup'][numpy.frombuffer(buf, dtype=numpy.uint8)]
+    if (values < 0).any():
+        for m in minified:
+            decode(m, alphabet) # raises for the first invalid one
+    values = values.reshape(len(minified), width)
+
+    base = len(alphabet)
+    output = numpy.zeros(len(minified), dtype=numpy.int64)
+    for column in xrange(width):
+        output *= base
+        output += values[:, column]
+    return [int(i) for i in output.tolist()]
+
+def _table(alphabet):
+    """Lookup tables for alphabet, built on first use"""
+    table = _tables.get(alphabet)
+    if table is None:
+        table = {'values': dict((c, i) for i, c in enumerate(alphabet))}
+        if numpy is not None:
+            lookup = numpy.full(256, -1, dtype=numpy.int64)
+            for i, c in enumerate(alphabet):
+                lookup[ord(c)] = i
+            table['lookup'] = lookup
+            table['chars'] = numpy.frombuffer(alphabet, dtype=numpy.uint8)
+        _tables[alphabet] = table
+    return table
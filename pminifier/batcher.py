@@ -0,0 +1,93 @@
+"""
+Micro-batching of single item lookups.
+
+Call sites that minify one URL at a time cost one mongo query per URL.
+BatchingMinifier collects the single get_id/get_string calls made by many
+threads within a short window and sends them to the minifier as one batch.
+"""
+import threading
+
+from minifier import Minifier, SimplerMinifier
+
+class _Batch(object):
+    def __init__(self):
+        self.items = set()
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+class BatchingMinifier(object):
+    """
+    Wraps a minifier and batches single lookups made from many threads.
+
+    The first caller of a batch waits up to max_wait seconds for others to
+    join, or until max_batch_size items are queued, and then runs the batch
+    for everyone. Each caller adds at most max_wait of latency; a longer
+    window or a bigger batch size means fewer, larger backend calls.
+
+    A SimplerMinifier is asked through get_ids and get_strings, so batches
+    go through its caches; groupkey has to be its group_key or None.
+    """
+    def __init__(self, minifier, max_batch_size=100, max_wait=0.005):
+        self.minifier = minifier
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._open = {}
+
+    def get_id(self, url, groupkey=None, dont_create=False):
+        """Returns the minified ID of the url, see Minifier.get_id"""
+        if isinstance(self.minifier, SimplerMinifier):
+            if groupkey not in (None, self.minifier.group_key):
+                raise ValueError('This SimplerMinifier only minifies URLs of groupkey %r'
+                                 % self.minifier.group_key)
+            groupkey = self.minifier.group_key
+            lookup_func = lambda urls: self.minifier.get_ids(urls, dont_create=dont_create)
+        else:
+            lookup_func = lambda urls: self.minifier.get_multiple_ids(urls, groupkey,
+                                                                      dont_create=dont_create)
+        return self._submit(('id', groupkey, dont_create), url, lookup_func).get(url)
+
+    def get_string(self, id):
+        """Looks up the string by its ID, see Minifier.get_string"""
+        if isinstance(self.minifier, SimplerMinifier):
+            lookup_func = self.minifier.get_strings
+        else:
+            lookup_func = self.minifier.get_multiple_strings
+        res = self._submit(('string',), id, lookup_func)
+        if not res.get(id):
+            raise Minifier.DoesNotExist('The URL provided does not exist ' +
+                                        'in the minification table.')
+        return res[id]
+
+    def _submit(self, group, item, lookup_func):
+        """Adds item to the open batch of group and returns the batch's
+        results once it ran"""
+        with self._lock:
+            batch = self._open.get(group)
+            leader = batch is None
+            if leader:
+                batch = self._open[group] = _Batch()
+            batch.items.add(item)
+            if len(batch.items) >= self.max_batch_size:
+                # later callers start a new batch
+                del self._open[group]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.max_wait)
+            with self._lock:
+                if self._open.get(group) is batch:
+                    del self._open[group]
+            try:
+                batch.results = lookup_func(list(batch.items)) or {}
+            except Exception as e:
+                batch.error = e
+            batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.results
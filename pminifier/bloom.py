@@ -0,0 +1,206 @@
+"""
+Bloom filters of the URLs each groupkey has in urlById.
+
+A URL the filter doesn't contain was never minified, so lookups that
+can't create entries skip the cache and mongo for it. Filters are built
+from urlById and get every URL the minifier creates.
+
+With a redis connection the filters live in Redis, in the bit order of
+SETBIT, so every process loads the same filter instead of building its
+own. Processes add the URLs they create to the Redis copy, before
+inserting them, and bump its version counter. Lookups only read the
+local copy. Every refresh_interval seconds a process reads the counter
+and reloads the copy when it changed, so a URL another process created
+can be ruled out for up to that long. That only holds if every process
+that creates URLs for the groupkey adds them to the same filter.
+
+Without Redis a process only knows about the URLs it created itself, so
+use that only where a single process creates entries for the groupkey.
+"""
+import math
+import md5
+import struct
+import threading
+import time
+
+from digest import _unicode_to_str
+
+class BloomFilter(object):
+    """Bit array Bloom filter sized for capacity items at error_rate.
+
+    bits: bytes of a filter with the same capacity and error_rate to
+          start from, as returned by to_bytes
+    """
+    def __init__(self, capacity=1000000, error_rate=0.01, bits=None):
+        self.size, self.hashes = geometry(capacity, error_rate)
+        nbytes = (self.size + 7) // 8
+        if bits is None:
+            self.bits = bytearray(nbytes)
+        else:
+            # Redis strings stop at the last byte set
+            self.bits = bytearray(bits[:nbytes]) + bytearray(max(0, nbytes - len(bits)))
+
+    def add(self, item):
+        for pos in positions(item, self.size, self.hashes):
+            self.bits[pos >> 3] |= 0x80 >> (pos & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        for pos in positions(item, self.size, self.hashes):
+            if not bits[pos >> 3] & (0x80 >> (pos & 7)):
+                return False
+        return True
+
+    def to_bytes(self):
+        return str(self.bits)
+
+def geometry(capacity, error_rate):
+    """Returns the (bits, hashes) of a filter for capacity items"""
+    size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    return size, max(1, int(round(size / float(capacity) * math.log(2))))
+
+def positions(item, size, hashes):
+    """Bit positions of item, by double hashing its md5"""
+    h1, h2 = struct.unpack('<QQ', md5.md5(_unicode_to_str(item)).digest())
+    return [(h1 + i * h2) % size for i in xrange(hashes)]
+
+class KnownUrls(object):
+    """Per groupkey Bloom filters of the URLs in urlById.
+
+    Groupkeys without a filter, built here or found in Redis, aren't
+    filtered at all.
+
+    capacity, error_rate: size of every groupkey's filter
+    redis_conn: Redis connection to share the filters through
+    refresh_interval: seconds between checks of a filter's version in
+                      Redis, the filter is reloaded when it changed
+    """
+    key_format = 'pminifier:bloom:{size}:{hashes}:{groupkey}'
+
+    def __init__(self, capacity=1000000, error_rate=0.01, redis_conn=None,
+                 refresh_interval=1):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size, self.hashes = geometry(capacity, error_rate)
+        self.redis = redis_conn
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._filters = {} # groupkey -> (BloomFilter or None, version, time checked)
+        self._building = {} # groupkey -> BloomFilter being built here
+
+    def _new_filter(self, bits=None):
+        return BloomFilter(self.capacity, self.error_rate, bits)
+
+    def _key(self, groupkey):
+        return self.key_format.format(size=self.size, hashes=self.hashes,
+                                      groupkey=_unicode_to_str(groupkey))
+
+    def _filter(self, groupkey):
+        with self._lock:
+            bloom, version, checked = self._filters.get(groupkey, (None, None, None))
+        now = time.time()
+        if self.redis is None or (checked is not None and
+                                  now - checked < self.refresh_interval):
+            return bloom
+        key = self._key(groupkey)
+        current = _version(self.redis.get(key + ':version'))
+        if checked is None or current != version:
+            bloom, current = self._load(key)
+        with self._lock:
+            self._filters[groupkey] = (bloom, current, now)
+        return bloom
+
+    def _load(self, key):
+        """Reads (BloomFilter or None, version) of key from Redis"""
+        # the bits exist before the filter is complete, it is only used
+        # once a build marked it ready
+        with self.redis.pipeline() as pipe:
+            pipe.exists(key + ':ready')
+            pipe.get(key)
+            pipe.get(key + ':version')
+            ready, bits, version = pipe.execute()
+        return (self._new_filter(bits or '') if ready else None), _version(version)
+
+    def may_exist(self, groupkey, urls):
+        """Returns the urls that may be in urlById, dropping those that
+        are definitely not"""
+        bloom = self._filter(groupkey)
+        if bloom is None:
+            return list(urls)
+        with self._lock:
+            return [url for url in urls if url in bloom]
+
+    def add(self, groupkey, urls):
+        """Adds newly created urls to the groupkey's filters"""
+        urls = list(urls)
+        if not urls:
+            return
+        # always, a build in another process may be scanning right now
+        version = None
+        if self.redis is not None:
+            key = self._key(groupkey)
+            with self.redis.pipeline(transaction=False) as pipe:
+                for url in urls:
+                    for pos in positions(url, self.size, self.hashes):
+                        pipe.setbit(key, pos, 1)
+                # after the bits, a process that sees the new version
+                # loads them too
+                pipe.incr(key + ':version')
+                version = pipe.execute()[-1]
+        with self._lock:
+            bloom, loaded, checked = self._filters.get(groupkey, (None, None, None))
+            if bloom is not None and version is not None and loaded == version - 1:
+                # no other process added since the load, the local copy
+                # is as good as a reload
+                self._filters[groupkey] = (bloom, version, checked)
+            for bloom in (bloom, self._building.get(groupkey)):
+                if bloom is not None:
+                    for url in urls:
+                        bloom.add(url)
+
+    def build(self, collection, groupkey, batch_size=10000):
+        """Builds the groupkey's filter from a urlById collection and
+        shares it through Redis. Returns the number of URLs added."""
+        bloom = self._new_filter()
+        with self._lock:
+            self._building[groupkey] = bloom
+        try:
+            added = 0
+            last_id = None
+            while True:
+                criteria = {'groupkey': groupkey}
+                if last_id is not None:
+                    criteria['_id'] = {'$gt': last_id}
+                entries = list(collection.find(criteria, fields=['_id', 'url'],
+                                               sort=[('_id', 1)], limit=batch_size))
+                if not entries:
+                    break
+                with self._lock:
+                    for entry in entries:
+                        bloom.add(entry['url'])
+                added += len(entries)
+                last_id = entries[-1]['_id']
+
+            if self.redis is not None:
+                # OR keeps the URLs processes added while we scanned
+                key = self._key(groupkey)
+                tmp_key = key + ':build'
+                with self.redis.pipeline() as pipe:
+                    pipe.set(tmp_key, bloom.to_bytes())
+                    pipe.bitop('OR', key, key, tmp_key)
+                    pipe.delete(tmp_key)
+                    pipe.set(key + ':ready', 1)
+                    pipe.incr(key + ':version')
+                    pipe.execute()
+                bloom, version = self._load(key)
+            else:
+                version = None
+            with self._lock:
+                self._filters[groupkey] = (bloom, version, time.time())
+        finally:
+            with self._lock:
+                del self._building[groupkey]
+        return added
+
+def _version(value):
+    return int(value) if value is not None else None
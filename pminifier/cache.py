@@ -1,4 +1,13 @@
+import inspect
+import md5
+
+# Bump to stop reading every key written by an older schema
+KEY_VERSION = 'v2'
+
 class CacheBackend(object):
+    # Most keys sent to the server in one multi-key command
+    batch_size = 1000
+
     def __init__(self,params):
         self.client = None
 
@@ -8,8 +17,98 @@ class CacheBackend(object):
     def set(self, key, value):
         pass
 
+    def get_many(self, keys):
+        """Returns {key: value} for the keys found in the cache"""
+        res = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                res[key] = value
+        return res
+
+    def set_many(self, mapping, timeout=None):
+        """Stores every value of mapping, timeout overrides the backend's
+        default expiry where the backend supports it"""
+        for key, value in mapping.iteritems():
+            self.set(key, value)
+
+    def add(self, key, value, timeout=None):
+        """Stores value only if key is missing, returns whether it did.
+        Not atomic here, backends that can do better override it."""
+        if self.get(key) is not None:
+            return False
+        self.set(key, value)
+        return True
+
+    def get_with_ttl(self, key):
+        """Returns (value, seconds left before it expires), the time left
+        is None when it doesn't expire or the backend can't tell"""
+        return self.get(key), None
+
     def delete(self, key):
         pass
 
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def delete_if_equal(self, keys, value):
+        """Deletes those of keys that still hold value, like a lock token.
+        Not atomic here, backends that can do better override it."""
+        for key in keys:
+            if self.get(key) == value:
+                self.delete(key)
+
     def clear(self):
         pass
+
+def batches(items, size):
+    """Splits items into lists of at most size items"""
+    items = list(items)
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+def cache_key(funcname, callargs, namespace=None):
+    """Builds the cache key for a call of funcname with the {name: value}
+    callargs.
+
+    The key only depends on the namespace, the function name and the
+    argument values, so every process and minifier instance computes the
+    same key for the same call. Unicode and byte strings with the same text
+    get the same key.
+    """
+    normalized = tuple(sorted((k, _normalize(v)) for k, v in callargs.iteritems()))
+    prefix = "pminifier:%s:" % KEY_VERSION
+    if namespace:
+        prefix += "%s:" % _normalize(namespace)
+    return "%s%s:%s" % (prefix, funcname, md5.md5(repr(normalized)).hexdigest())
+
+def call_key(func, args, kw):
+    """Builds the cache key for func(*args, **kw).
+
+    Arguments are bound to their parameter names first, so passing one by
+    position or by keyword, or leaving out a default, gives the same key.
+    self (or cls) isn't part of the arguments, its cache_namespace, if any,
+    namespaces the key instead.
+    """
+    callargs = inspect.getcallargs(func, *args, **kw)
+    argnames = inspect.getargspec(func).args
+    owner = None
+    if argnames and (argnames[0] in ('self', 'cls') or getattr(func, 'im_self', None)):
+        owner = callargs.pop(argnames[0])
+    return cache_key(func.__name__, callargs, getattr(owner, 'cache_namespace', None))
+
+def _normalize(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return int(value) # longs that fit repr like ints
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(_normalize(v) for v in value))
+    if isinstance(value, dict):
+        return tuple(sorted((_normalize(k), _normalize(v)) for k, v in value.iteritems()))
+    if isinstance(value, (str, float, bool, type(None))):
+        return value
+    return repr(value)
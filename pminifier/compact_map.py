@@ -0,0 +1,158 @@
+"""
+Compact in-process map from URLs to integer IDs.
+
+Entries are keyed by url_digest(groupkey, url) and kept in two typed
+arrays with open addressing, 23 to 46 bytes per entry with the default
+max_load instead of the hundreds a dict of strings takes. The URL itself isn't
+kept: two URLs with the same 64 bit digest share a slot, so callers that
+can't accept that chance verify hits against urlById.
+"""
+import threading
+
+from array import array
+from itertools import izip
+
+from digest import url_digest
+
+def _int64_typecode():
+    # python 2 arrays have no 'q', but long is 64 bit on LP64 platforms
+    for typecode in ('q', 'l'):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return None
+
+INT64 = _int64_typecode()
+
+# Marks empty slots, digests that happen to equal it are stored as EMPTY + 1
+EMPTY = -2 ** 63
+
+class CompactIdMap(object):
+    """Open addressing hash table of 64 bit digests to 64 bit IDs.
+
+    capacity: slots allocated up front, grown by doubling
+    max_load: share of used slots that triggers growing
+
+    Reads don't take the lock, writes store the ID before the digest so a
+    reader never sees a digest without its ID.
+    """
+    def __init__(self, capacity=1024, max_load=0.7):
+        if INT64 is None:
+            raise RuntimeError('CompactIdMap needs 64 bit array items')
+        self.max_load = max_load
+        self._lock = threading.Lock()
+        self._count = 0
+        self._table = self._new_table(max(capacity, 8))
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        keys, values, mask = self._table
+        return keys.itemsize * len(keys) + values.itemsize * len(values)
+
+    def get(self, digest):
+        """Returns the ID stored for digest, or None"""
+        if digest == EMPTY:
+            digest += 1
+        keys, values, mask = self._table
+        i = digest & mask
+        while True:
+            key = keys[i]
+            if key == digest:
+                return values[i]
+            if key == EMPTY:
+                return None
+            i = (i + 1) & mask
+
+    def put(self, digest, id):
+        with self._lock:
+            self._put(digest, id)
+
+    def get_many(self, groupkey, urls):
+        """Returns {url: id} for the urls of groupkey in the map"""
+        res = {}
+        for url in urls:
+            id = self.get(url_digest(groupkey, url))
+            if id is not None:
+                res[url] = id
+        return res
+
+    def put_many(self, groupkey, mapping):
+        """Stores {url: id} for groupkey"""
+        with self._lock:
+            for url, id in mapping.iteritems():
+                self._put(url_digest(groupkey, url), id)
+
+    def load(self, collection, groupkey=None, batch_size=10000):
+        """Bulk loads the entries of a urlById collection, all of them or
+        those of groupkey. Returns the number of entries loaded."""
+        loaded = 0
+        last_id = None
+        while True:
+            criteria = {}
+            if groupkey is not None:
+                criteria['groupkey'] = groupkey
+            if last_id is not None:
+                criteria['_id'] = {'$gt': last_id}
+            entries = list(collection.find(criteria,
+                                           fields=['_id', 'groupkey', 'url', 'h'],
+                                           sort=[('_id', 1)],
+                                           limit=batch_size))
+            if not entries:
+                return loaded
+            with self._lock:
+                for entry in entries:
+                    digest = entry.get('h')
+                    if digest is None:
+                        if 'groupkey' not in entry:
+                            continue # legacy entries are never looked up
+                        digest = url_digest(entry['groupkey'], entry['url'])
+                    self._put(digest, entry['_id'])
+                    loaded += 1
+            last_id = entries[-1]['_id']
+
+    def _new_table(self, capacity):
+        size = 8
+        while size < capacity:
+            size <<= 1
+        return array(INT64, [EMPTY]) * size, array(INT64, [0]) * size, size - 1
+
+    def _put(self, digest, id):
+        if digest == EMPTY:
+            digest += 1
+        keys, values, mask = self._table
+        i = digest & mask
+        while True:
+            key = keys[i]
+            if key == digest:
+                values[i] = id
+                return
+            if key == EMPTY:
+                break
+            i = (i + 1) & mask
+        if self._count + 1 > self.max_load * len(keys):
+            self._grow()
+            keys, values, mask = self._table
+            i = digest & mask
+            while keys[i] != EMPTY:
+                i = (i + 1) & mask
+        values[i] = id
+        keys[i] = digest
+        self._count += 1
+
+    def _grow(self):
+        keys, values, mask = self._table
+        table = self._new_table(2 * len(keys))
+        new_keys, new_values, new_mask = table
+        for key, value in izip(keys, values):
+            if key != EMPTY:
+                i = key & new_mask
+                while new_keys[i] != EMPTY:
+                    i = (i + 1) & new_mask
+                new_values[i] = value
+                new_keys[i] = key
+        self._table = table
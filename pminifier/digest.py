@@ -0,0 +1,17 @@
+import md5
+import struct
+
+def url_digest(groupkey, url):
+    """Fixed width 64 bit digest of a (groupkey, url) pair.
+
+    Stored as a signed int so it fits a BSON int64.
+    """
+    text = _unicode_to_str(groupkey) + '\0' + _unicode_to_str(url)
+    return struct.unpack('>q', md5.md5(text).digest()[:8])[0]
+
+def _unicode_to_str(text, encoding=None, errors='strict'):
+    if encoding is None:
+        encoding = 'utf-8'
+    if isinstance(text, unicode):
+        return text.encode(encoding, errors)
+    return text
@@ -0,0 +1,47 @@
+"""
+Consistent hashing of cache keys onto a set of nodes.
+
+Every node gets replicas points on a circle of 32 bit md5 hashes, and a
+key belongs to the first node point at or after its own hash. Adding or
+removing a node only moves the keys between its points and the ones
+before them, about 1 / len(nodes) of all keys.
+"""
+import bisect
+import md5
+
+from digest import _unicode_to_str
+
+def _hash(value):
+    return int(md5.md5(_unicode_to_str(value)).hexdigest()[:8], 16)
+
+class HashRing(object):
+    """Maps keys to nodes, a {name: node} dict.
+
+    Keys are placed by node name only, so a node keeps its keys when it
+    moves to another address under the same name. Names derived from
+    addresses, like redis_cache_backend.node_name, change with them.
+    """
+    def __init__(self, nodes, replicas=160):
+        if not nodes:
+            raise ValueError('A hash ring needs at least one node')
+        self.nodes = dict(nodes)
+        self.replicas = replicas
+        points = sorted((_hash('%s-%i' % (name, i)), name)
+                        for name in self.nodes for i in xrange(replicas))
+        self._points = [point for point, name in points]
+        self._names = [name for point, name in points]
+
+    def get_name(self, key):
+        """Name of the node key belongs to"""
+        index = bisect.bisect_left(self._points, _hash(key))
+        return self._names[index % len(self._names)]
+
+    def get_node(self, key):
+        return self.nodes[self.get_name(key)]
+
+    def split(self, keys):
+        """Returns {name: [keys]} of the nodes holding keys"""
+        res = {}
+        for key in keys:
+            res.setdefault(self.get_name(key), []).append(key)
+        return res
@@ -0,0 +1,223 @@
+"""
+Allocation of the integer IDs used as urlById._id.
+
+Minifier takes any IdAllocator:
+
+    MongoCounterAllocator: blocks of IDs from a counter document in
+        urlByIdMeta, the default
+    RedisRangeAllocator: blocks of IDs from INCRBY on a Redis counter, off
+        the mongo write path
+    NodeSequenceAllocator: IDs made of a timestamp, a node ID and a
+        sequence number, no coordination at all
+
+Rather than bumping a counter once per new URL, the counter allocators
+reserve a whole block of IDs at once and hand them out locally. At startup
+Minifier passes the highest urlById._id to check, which raises
+IdOverlapError if the allocator could hand out an ID that is already used.
+"""
+import logging
+import threading
+import time
+
+from pymongo.errors import DuplicateKeyError
+
+from retry import mongodb_retry
+
+log = logging.getLogger('pminifier')
+
+class IdOverlapError(Exception):
+    "The allocator would hand out IDs urlById already holds."
+
+class IdAllocator(object):
+    """Hands out unique integer IDs for new urlById documents."""
+    def allocate(self, count=1):
+        """Returns a list of `count` unused IDs"""
+        raise NotImplementedError
+
+    def check(self, max_id):
+        """Raises IdOverlapError unless every ID still to come is above
+        max_id, the highest ID in use"""
+        raise NotImplementedError
+
+    def release(self, ids):
+        """Hands back allocated ids that weren't used. Allocators that
+        can't reuse them just drop them."""
+
+class BlockAllocator(IdAllocator):
+    """
+    Reserves IDs from a shared counter in blocks of `block_size`.
+
+    A reserved block is handed out to callers of `allocate` from any thread.
+    If `lease` (seconds) is set, the unused remainder of a block is abandoned
+    once the block gets older than the lease, so idle processes don't keep
+    handing out IDs far behind the counter. Abandoned IDs are never reused.
+    """
+    def __init__(self, block_size=1, lease=None):
+        if block_size < 1:
+            raise ValueError("block_size must be a positive integer.")
+        self.block_size = block_size
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._start = 0 # start of the reserved block
+        self._next = 0 # next ID to hand out
+        self._end = 0 # end of the reserved block (exclusive)
+        self._reserved_at = 0
+
+    def allocate(self, count=1):
+        """Returns a list of `count` unused IDs, reserving more when needed"""
+        with self._lock:
+            if (self.lease is not None and self._next < self._end and
+                    time.time() - self._reserved_at > self.lease):
+                log.info('Dropping %i leased IDs', self._end - self._next)
+                self._next = self._end
+
+            ids = []
+            while len(ids) < count:
+                if self._next >= self._end:
+                    self._reserve(max(count - len(ids), self.block_size))
+                take = min(count - len(ids), self._end - self._next)
+                ids.extend(xrange(self._next, self._next + take))
+                self._next += take
+            return ids
+
+    def release(self, ids):
+        """Takes ids back if they are the last ones handed out, so the
+        next allocate returns them again"""
+        ids = sorted(ids)
+        with self._lock:
+            if (ids and ids == range(ids[0], self._next) and
+                    ids[0] >= self._start):
+                self._next = ids[0]
+
+    def check(self, max_id):
+        with self._lock:
+            first = self._next if self._next < self._end else self.current() + 1
+        if max_id is not None and first <= max_id:
+            raise IdOverlapError('The next ID would be %i but urlById already goes up '
+                                 'to %i, seed the counter with it' % (first, max_id))
+
+    def _reserve(self, size):
+        """Bumps the counter by `size` and keeps the resulting range"""
+        self._end = self._increment(size) + 1
+        self._start = self._next = self._end - size
+        self._reserved_at = time.time()
+
+    def _increment(self, size):
+        """Adds size to the counter and returns its new value"""
+        raise NotImplementedError
+
+    def current(self):
+        """Last ID reserved by any process"""
+        raise NotImplementedError
+
+    def seed(self, value):
+        """Raises the counter to value, if it is lower"""
+        raise NotImplementedError
+
+class MongoCounterAllocator(BlockAllocator):
+    """BlockAllocator on the counter_id document of urlByIdMeta"""
+    def __init__(self, db, block_size=1, lease=None, counter_id='minifier_counter'):
+        super(MongoCounterAllocator, self).__init__(block_size, lease)
+        self.db = db
+        self.counter_id = counter_id
+
+    @mongodb_retry()
+    def _increment(self, size):
+        counter = self.db.urlByIdMeta.find_and_modify(query={'_id': self.counter_id},
+                                                      update={'$inc': {'value': size}},
+                                                      upsert=True, new=True)
+        return counter['value']
+
+    @mongodb_retry()
+    def current(self):
+        counter = self.db.urlByIdMeta.find_one({'_id': self.counter_id})
+        return counter['value'] if counter else 0
+
+    @mongodb_retry()
+    def seed(self, value):
+        try:
+            self.db.urlByIdMeta.insert({'_id': self.counter_id, 'value': value})
+        except DuplicateKeyError:
+            self.db.urlByIdMeta.update({'_id': self.counter_id, 'value': {'$lt': value}},
+                                       {'$set': {'value': value}})
+
+class RedisRangeAllocator(BlockAllocator):
+    """BlockAllocator on a Redis counter bumped with INCRBY.
+
+    Redis has to persist the counter (appendonly yes), a counter lost in
+    a restart is caught by check but stops new URLs until seeded again.
+    """
+    def __init__(self, redis_conn, block_size=1000, lease=None,
+                 key='pminifier:id_counter'):
+        super(RedisRangeAllocator, self).__init__(block_size, lease)
+        self.redis = redis_conn
+        self.key = key
+
+    def _increment(self, size):
+        return self.redis.incrby(self.key, size)
+
+    def current(self):
+        return int(self.redis.get(self.key) or 0)
+
+    def seed(self, value):
+        def raise_counter(pipe):
+            if int(pipe.get(self.key) or 0) < value:
+                pipe.multi()
+                pipe.set(self.key, value)
+        self.redis.transaction(raise_counter, self.key)
+
+class NodeSequenceAllocator(IdAllocator):
+    """
+    IDs of milliseconds since `epoch`, `node_id` and a per millisecond
+    sequence number, like Twitter's Snowflake. Needs no coordination, but
+    every process creating IDs at the same time needs its own node_id.
+
+    The bits sum to 63, so IDs stay positive BSON int64s; the defaults
+    leave 41 bits of milliseconds, about 69 years. IDs are longer than
+    counter ones, about 11 base62 characters. When the clock goes back or a
+    millisecond runs out of sequence numbers, IDs are taken from the
+    following milliseconds instead.
+    """
+    def __init__(self, node_id, node_bits=10, sequence_bits=12,
+                 epoch=1262304000000, max_skew=60):
+        if not 0 <= node_id < 1 << node_bits:
+            raise ValueError("node_id must fit in %i bits." % node_bits)
+        self.node_id = node_id
+        self.node_bits = node_bits
+        self.sequence_bits = sequence_bits
+        self.epoch = epoch # ms, 2010-01-01 by default
+        self.max_skew = max_skew
+        self._lock = threading.Lock()
+        self._last = -1 # millisecond of the last ID
+        self._sequence = (1 << sequence_bits) - 1
+
+    def _now(self):
+        return int(time.time() * 1000) - self.epoch
+
+    def allocate(self, count=1):
+        with self._lock:
+            ids = []
+            for i in xrange(count):
+                now = self._now()
+                if now > self._last:
+                    self._last, self._sequence = now, 0
+                elif self._sequence + 1 < 1 << self.sequence_bits:
+                    self._sequence += 1
+                else:
+                    self._last, self._sequence = self._last + 1, 0
+                ids.append((((self._last << self.node_bits) | self.node_id)
+                            << self.sequence_bits) | self._sequence)
+            return ids
+
+    def check(self, max_id):
+        """Only IDs of a clock ahead of ours can overlap ours. Within
+        max_skew seconds they are skipped past, further ahead they raise."""
+        if max_id is None:
+            return
+        latest = max_id >> (self.node_bits + self.sequence_bits)
+        with self._lock:
+            if latest > self._now() + self.max_skew * 1000:
+                raise IdOverlapError('urlById holds IDs of %.0f seconds from now, '
+                                     'check the clock' % ((latest - self._now()) / 1000.0))
+            if latest >= self._last:
+                self._last, self._sequence = latest, (1 << self.sequence_bits) - 1
@@ -0,0 +1,314 @@
+"""
+In-process L1 cache used in front of the shared cache.
+
+Every minifier instance owns its own LocalCache, so instances with
+different group keys or databases never see each other's entries.
+
+Which entry to drop when the cache is full is up to its policy:
+
+    'lru': drop the least recently used entry
+    'tinylfu': W-TinyLFU. New entries go through a small LRU window, and
+        when they fall out of it they only replace the main LRU's victim if
+        they have been asked for more often. A long tail of URLs seen once
+        then can't flush the popular ones out.
+"""
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+from cache import CacheBackend
+
+def _sizeof(key, value):
+    return _deep_sizeof(key) + _deep_sizeof(value)
+
+def _deep_sizeof(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        size += sum(_deep_sizeof(item) for item in obj)
+    return size
+
+class LRUPolicy(object):
+    """Evicts the least recently used key"""
+    def __init__(self, max_entries):
+        self._order = OrderedDict()
+
+    def access(self, key):
+        """key was found"""
+        self._order[key] = self._order.pop(key)
+
+    def miss(self, key):
+        """key was asked for and not found"""
+
+    def add(self, key):
+        self._order[key] = True
+
+    def remove(self, key):
+        self._order.pop(key, None)
+
+    def evict(self):
+        """Removes and returns the key to drop"""
+        return self._order.popitem(last=False)[0]
+
+    def clear(self):
+        self._order.clear()
+
+class FrequencySketch(object):
+    """Count-min sketch of how often keys were seen recently.
+
+    Counters stop at 15 and are all halved every sample_size increments,
+    so old popularity fades out.
+    """
+    seeds = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+
+    def __init__(self, width):
+        size = 16
+        while size < width:
+            size <<= 1
+        self._mask = size - 1
+        self._table = [bytearray(size) for seed in self.seeds]
+        self.sample_size = 10 * size
+        self._additions = 0
+
+    def _indexes(self, key):
+        h = hash(key)
+        return [((h * seed) >> 8) & self._mask for seed in self.seeds]
+
+    def increment(self, key):
+        for row, index in zip(self._table, self._indexes(key)):
+            if row[index] < 15:
+                row[index] += 1
+        self._additions += 1
+        if self._additions >= self.sample_size:
+            self._table = [bytearray(count >> 1 for count in row) for row in self._table]
+            self._additions //= 2
+
+    def frequency(self, key):
+        return min(row[index] for row, index in zip(self._table, self._indexes(key)))
+
+class TinyLFUPolicy(object):
+    """W-TinyLFU: an LRU window in front of a segmented LRU whose entries are
+    only replaced by more frequently used ones"""
+    def __init__(self, max_entries, window=0.01, protected=0.8):
+        max_entries = max_entries or 10000
+        self.window_size = max(1, int(max_entries * window))
+        self.main_size = max(1, max_entries - self.window_size)
+        self.protected_size = int(self.main_size * protected)
+        self.sketch = FrequencySketch(max_entries)
+        self._window = OrderedDict()
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+
+    def access(self, key):
+        self.sketch.increment(key)
+        if key in self._window:
+            self._window[key] = self._window.pop(key)
+        elif key in self._protected:
+            self._protected[key] = self._protected.pop(key)
+        elif key in self._probation:
+            del self._probation[key]
+            self._protected[key] = True
+            if len(self._protected) > self.protected_size:
+                demoted = self._protected.popitem(last=False)[0]
+                self._probation[demoted] = True
+
+    def miss(self, key):
+        self.sketch.increment(key)
+
+    def add(self, key):
+        self._window[key] = True
+        # while the main LRU has room, entries leaving the window just move in
+        while (len(self._window) > self.window_size and
+               len(self._probation) + len(self._protected) < self.main_size):
+            self._probation[self._window.popitem(last=False)[0]] = True
+
+    def remove(self, key):
+        for segment in (self._window, self._probation, self._protected):
+            if segment.pop(key, None) is not None:
+                return
+
+    def evict(self):
+        victim = self._main_victim()
+        if len(self._window) > self.window_size or victim is None:
+            candidate = self._window.popitem(last=False)[0]
+            if victim is None:
+                return candidate
+            if self.sketch.frequency(candidate) <= self.sketch.frequency(victim):
+                return candidate
+            self.remove(victim)
+            self._probation[candidate] = True
+            return victim
+        self.remove(victim)
+        return victim
+
+    def _main_victim(self):
+        for segment in (self._probation, self._protected):
+            if segment:
+                return next(iter(segment))
+        return None
+
+    def clear(self):
+        self._window.clear()
+        self._probation.clear()
+        self._protected.clear()
+
+POLICIES = {
+    'lru': LRUPolicy,
+    'tinylfu': TinyLFUPolicy,
+}
+
+class LocalCache(CacheBackend):
+    """Thread-safe cache bounded by entry count and optionally total bytes.
+
+    max_entries: most entries kept, None for no limit
+    max_bytes: most bytes of keys and values kept, None for no limit
+    timeout: seconds an entry stays valid, None to keep it until evicted
+    sizeof: function(key, value) returning the bytes an entry counts for
+    policy: 'lru' or 'tinylfu', see the module docstring
+    """
+    def __init__(self, max_entries=500, max_bytes=None, timeout=None, sizeof=_sizeof,
+                 policy='lru'):
+        if policy not in POLICIES:
+            raise ValueError('Unknown cache policy %r, use one of %s'
+                             % (policy, ', '.join(sorted(POLICIES))))
+        self.client = None
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.sizeof = sizeof
+        self.policy = policy
+        self._policy = POLICIES[policy](max_entries)
+        self._lock = threading.Lock()
+        self._data = {} # key -> (value, expiry, size)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key, time.time())
+
+    def get_many(self, keys):
+        res = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                value = self._get(key, now)
+                if value is not None:
+                    res[key] = value
+        return res
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._set(key, value, self._expiry(timeout))
+
+    def set_many(self, mapping, timeout=None):
+        expiry = self._expiry(timeout)
+        with self._lock:
+            for key, value in mapping.iteritems():
+                self._set(key, value, expiry)
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self._get(key, time.time()) is not None:
+                return False
+            self._set(key, value, self._expiry(timeout))
+            return True
+
+    def get_with_ttl(self, key):
+        with self._lock:
+            now = time.time()
+            value = self._get(key, now)
+            if value is None or self._data[key][1] is None:
+                return value, None
+            return value, self._data[key][1] - now
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def delete_if_equal(self, keys, value):
+        with self._lock:
+            now = time.time()
+            for key in keys:
+                if self._get(key, now) == value:
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._policy.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Returns the counters and current size of the cache"""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'entries': len(self._data),
+                    'bytes': self._bytes}
+
+    def _expiry(self, timeout):
+        timeout = self.timeout if timeout is None else timeout
+        return time.time() + timeout if timeout else None
+
+    def _get(self, key, now):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            self._remove(key)
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self._policy.miss(key)
+            self.misses += 1
+            return None
+        self._policy.access(key)
+        self.hits += 1
+        return entry[0]
+
+    def _set(self, key, value, expiry):
+        self._remove(key)
+        size = self.sizeof(key, value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self._data[key] = (value, expiry, size)
+        self._policy.add(key)
+        self._bytes += size
+        while ((self.max_entries is not None and len(self._data) > self.max_entries) or
+               (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            self._bytes -= self._data.pop(self._policy.evict())[2]
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._policy.remove(key)
+            self._bytes -= entry[2]
+
+def local_cached(cache, func):
+    """Wraps func with cache, keyed by its name and the call's arguments.
+    Results of None aren't kept, so a miss can't go stale once the item is
+    created."""
+    name = func.__name__
+    def wrapped(*args, **kw):
+        key = (name, args, tuple(sorted(kw.iteritems())))
+        value = cache.get(key)
+        if value is None:
+            value = func(*args, **kw)
+            if value is not None:
+                cache.set(key, value)
+        return value
+    return wrapped
@@ -1,47 +1,92 @@
-import md5
+import math
+
 import pylibmc
 
 from pylru import lrudecorator
 
-from cache import CacheBackend
+from cache import CacheBackend, batches, call_key
+from stampede import cached_call
+from value_codecs import get_codec
 
 class MemcachedCacheBackend(CacheBackend):
     def __init__(self,params):
         self.timeout = params.get('timeout', 3600)
+        self.batch_size = params.get('batch_size', self.batch_size)
+        # pylibmc pickles and compresses values itself unless a codec is set
+        codec = params.get('codec', 'pickle')
+        compress_threshold = params.get('compress_threshold')
+        if codec == 'pickle':
+            self.codec = None
+            self.min_compress_len = compress_threshold or 0
+        else:
+            self.codec = get_codec(codec, compress_threshold)
+            self.min_compress_len = 0
         host = params.get('host', ['localhost'])
         self.client = pylibmc.Client(host, binary=True)
 
     def set(self, key, value):
-        self.client.set(key,value,self.timeout)
+        self.client.set(key, self._encode(value), self.timeout,
+                        min_compress_len=self.min_compress_len)
 
     def get(self,key):
-        return self.client.get(key)
+        return self._decode(self.client.get(key))
+
+    def get_many(self, keys):
+        res = {}
+        for batch in batches(keys, self.batch_size):
+            res.update((key, self._decode(value))
+                       for key, value in self.client.get_multi(batch).iteritems())
+        return res
+
+    def set_many(self, mapping, timeout=None):
+        for batch in batches(mapping.iteritems(), self.batch_size):
+            self.client.set_multi(dict((key, self._encode(value)) for key, value in batch),
+                                  timeout or self.timeout,
+                                  min_compress_len=self.min_compress_len)
+
+    def add(self, key, value, timeout=None):
+        # memcached expiries are whole seconds and 0 never expires
+        timeout = int(math.ceil(timeout or self.timeout))
+        return bool(self.client.add(key, self._encode(value), timeout,
+                                    min_compress_len=self.min_compress_len))
 
     def delete(self, key):
         self.client.delete(key)
 
+    def delete_many(self, keys):
+        for batch in batches(keys, self.batch_size):
+            self.client.delete_multi(batch)
+
     def clear(self):
         self.client.flush_all()
 
+    def _encode(self, value):
+        return self.codec.encode(value) if self.codec else value
+
+    def _decode(self, value):
+        # entries written without a codec come back the way pylibmc stored them
+        if self.codec and isinstance(value, str):
+            return self.codec.decode(value, legacy=lambda data: data)
+        return value
+
 class cached(object):
-    """ This decorator wraps methods and caches their results with memcached. """
-    def __init__(self,client):
+    """ This decorator wraps methods and caches their results with memcached.
+
+    lock_timeout and early_refresh protect against stampedes, see stampede.
+    memcached doesn't tell TTLs, so early_refresh needs another backend.
+    """
+    def __init__(self, client, lock_timeout=None, early_refresh=None, beta=1.0):
         self.client = client
+        self.lock_timeout = lock_timeout
+        self.early_refresh = early_refresh
+        self.beta = beta
 
-    def _cache_key(self, func, args,kw):
-        classname = args[0].__class__.__name__
-        funcname = func.__name__
-        mangled_args = str(args)+str(kw)
-        key = "%s:%s:%s" % (classname,funcname,md5.md5(mangled_args).hexdigest())
-        return key
+    def _cache_key(self, func, args, kw):
+        return call_key(func, args, kw)
 
     def __call__(self, func):
         def wrapped(*args,**kw):
-            memcached = self.client
             key = self._cache_key(func, args,kw)
-            data = memcached.get(key)
-            if data is None:
-                data = func(*args,**kw)
-                memcached.set(key, data)
-            return data
+            return cached_call(self.client, key, lambda: func(*args, **kw),
+                               self.lock_timeout, self.early_refresh, self.beta)
         return wrapped
@@ -7,44 +7,117 @@ Maintain a collection of URL/ID pairs, to allow for 'shortening' a URL.
         Unit tests can be found in minifier_tests.py
 """
 import logging
-import math
 import md5
-import pymongo
 import time
 
+import pymongo
 
-from pymongo.errors import AutoReconnect
-from pylru import lrudecorator
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import base62
+from cache import cache_key
+from digest import _unicode_to_str, url_digest
+from id_allocator import MongoCounterAllocator
+from local_cache import LocalCache, local_cached
+from retry import mongodb_retry
+from negative_cache import NOT_FOUND, NegativeCache
+from redis_cache_backend import RedisCacheBackend
+from redis_hash_cache import RedisHashCacheBackend
+from singleflight import SingleFlight
+from stampede import lock_key, lock_token
+from tiered_cache import Tier, TieredCache
 
 log = logging.getLogger('pminifier')
 
-class mongodb_retry(object):
-    """Retry operation 100 times, wait between retries"""
-    def __call__(self,f):
-        def f_retry(cls,*args, **kwargs):
-            for i in range(100):
-                try:
-                    return f(cls,*args, **kwargs)
-                except AutoReconnect:
-                    log.warning("Failed to connect to PRIMARY. Sleeping 1 second")
-                    time.sleep(1.0)
-                    
-        return f_retry
+DUPLICATE_KEY_ERRORS = (11000, 11001)
+
+def _shared_tier(shared_cache):
+    """shared_cache as a tier without negative entries, they have to expire"""
+    if shared_cache is None or isinstance(shared_cache, Tier):
+        return shared_cache
+    return Tier(shared_cache, negatives=False)
 
 class Minifier(object):
-    alphabet = '2FQYNEJAUsbGu41zndZTeocMai5H7OIjXkKg8qyt3WC9hLplxfVBm0wSRr6vPD'
+    alphabet = base62.ALPHABET
+
+    # Covers lookups by url: groupkey and url are matched and _id is
+    # returned straight from the index
+    url_index = [('groupkey', 1), ('url', 1), ('_id', 1)]
+    legacy_url_index = [('url', 1)]
+    # Used instead of the url indexes when url_hash is on
+    hash_index = [('h', 1)]
+    # Keeps concurrent writers from creating a url twice and replaces
+    # url_index for lookups, see unique_urls
+    unique_url_index = [('groupkey', 1), ('url', 1)]
+    # get_or_create_id allocates an ID on every call, unique_urls takes
+    # them from leased blocks unless told otherwise
+    unique_id_block_size = 100
+    unique_id_lease = 60
 
     class DoesNotExist(Exception):
         "The requested URL does not exist in the table."
 
     @mongodb_retry()
-    def __init__(self, mongo_host, mongo_db):
+    def __init__(self, mongo_host, mongo_db, id_block_size=None, id_lease=None,
+                 url_hash=False, unique_urls=False, id_map=None, verify_id_map=False,
+                 known_urls=None, id_allocator=None, check_ids=False):
+        """
+        id_block_size: number of IDs reserved from the counter at once,
+                       1 by default and unique_id_block_size with
+                       unique_urls
+        id_lease: seconds after which unused reserved IDs are abandoned,
+                  unique_id_lease by default with unique_urls
+        id_allocator: IdAllocator handing out the IDs of new URLs, a
+                      MongoCounterAllocator with id_block_size and id_lease
+                      by default
+        check_ids: raise IdOverlapError if id_allocator would hand out an
+                   ID urlById already holds, at the cost of a query for
+                   the highest _id. Worth it once after switching or
+                   seeding allocators, not on every start
+        url_hash: look URLs up by a 64 bit digest of (groupkey, url)
+                  instead of indexing the full URL
+        unique_urls: enforce one entry per (groupkey, url) with a unique
+                     index, used for lookups instead of url_index, and
+                     create entries by upserting
+        id_map: CompactIdMap consulted before mongo for URL lookups, and
+                filled with the URLs looked up
+        verify_id_map: check id_map hits against the stored url, for
+                       callers that can't accept digest collisions
+        known_urls: KnownUrls filters, lookups with dont_create skip the
+                    URLs they rule out
+        """
+        if url_hash and unique_urls:
+            raise ValueError("unique_urls needs the full url index, it can't "
+                             "be combined with url_hash.")
+        self.url_hash = url_hash
+        self.unique_urls = unique_urls
+        self.id_map = id_map
+        self.verify_id_map = verify_id_map
+        self.known_urls = known_urls
         if isinstance(mongo_host, basestring) or isinstance(mongo_host, list):
             self.conn = pymongo.Connection(mongo_host)
         else:
             self.conn = mongo_host
         self.db = self.conn[mongo_db]
+        # keeps the cache entries of minifiers on different databases apart
+        self.cache_namespace = self.db.name
+        if id_allocator is None:
+            if unique_urls and id_block_size is None:
+                id_block_size = self.unique_id_block_size
+                if id_lease is None:
+                    id_lease = self.unique_id_lease
+            id_allocator = MongoCounterAllocator(self.db,
+                                                 block_size=id_block_size or 1,
+                                                 lease=id_lease)
+        self.id_allocator = id_allocator
         self._init_mongo()
+        if check_ids:
+            self.id_allocator.check(self._max_id())
+
+    def _max_id(self):
+        """Highest urlById._id, None when empty"""
+        entries = list(self.db.urlById.find({}, fields=['_id'], sort=[('_id', -1)], limit=1))
+        return entries[0]['_id'] if entries else None
 
     @mongodb_retry()
     def _init_mongo(self):
@@ -52,12 +125,57 @@ class Minifier(object):
         # Index only when necessary. Many attempts to make the same index
         # at the same moment (from a migration for example) causes mongo
         # to throw confusing errors
-        index = [('url', 1)]
-        indexes = self.db.urlById.index_information()
-        indexes = [i['key'] for i in indexes.values()]
-        if index not in indexes:
+        indexes = self._index_keys()
+        if self.url_hash:
+            if self.hash_index not in indexes:
+                log.warning('Creating urlById hash index')
+                self.db.urlById.ensure_index(self.hash_index, background=False)
+        elif self.unique_urls:
+            # Fails if urlById already holds duplicates, those have to be
+            # cleaned up before turning unique_urls on
+            if self.unique_url_index not in self._index_keys(unique=True):
+                log.warning('Creating unique urlById index')
+                self.db.urlById.ensure_index(self.unique_url_index, unique=True,
+                                             background=False)
+            if self.url_index in indexes:
+                log.warning('urlById has both the unique and the (groupkey, url, _id) '
+                            'index, run Minifier.migrate_indexes()')
+        elif self.url_index in indexes:
+            pass
+        elif self.legacy_url_index in indexes:
+            # Lookups still work off the old index, see migrate_indexes
+            log.warning('urlById is missing the (groupkey, url) index, '
+                        'run Minifier.migrate_indexes()')
+        else:
             log.warning('Creating urlById index')
-            self.db.urlById.ensure_index(index, background=False)
+            self.db.urlById.ensure_index(self.url_index, background=False)
+
+    def _index_keys(self, unique=False):
+        return [i['key'] for i in self.db.urlById.index_information().values()
+                if i.get('unique') or not unique]
+
+    @mongodb_retry()
+    def migrate_indexes(self, drop_legacy=True):
+        """Move an existing deployment to the (groupkey, url, _id) index.
+
+        The new index is built in the background so reads and writes keep
+        going, lookups use the old url index until the build finishes. The
+        old index is dropped only once the new one exists. With unique_urls
+        the unique index replaces the (groupkey, url, _id) one, which is
+        dropped.
+        """
+        indexes = self._index_keys()
+        if self.unique_urls:
+            if self.url_index in indexes:
+                log.warning('Dropping urlById (groupkey, url, _id) index, '
+                            'the unique index replaces it')
+                self.db.urlById.drop_index(self.url_index)
+        elif self.url_index not in indexes:
+            log.warning('Building urlById (groupkey, url) index in the background')
+            self.db.urlById.ensure_index(self.url_index, background=True)
+        if drop_legacy and self.legacy_url_index in self._index_keys():
+            log.warning('Dropping legacy urlById url index')
+            self.db.urlById.drop_index(self.legacy_url_index)
 
     def get_id(self, url, groupkey, dont_create=False):
         """Returns the minified ID of the url.
@@ -74,61 +192,185 @@ class Minifier(object):
     def _get_id_multi(self, urls, groupkey, as_str=False, dont_create=False):
         if not urls:
             return None
+        if dont_create:
+            urls = self._may_exist(urls, groupkey)
+
+        found = self._map_ids(urls, groupkey) if self.id_map is not None else {}
+        missing = set(urls) - set(found)
+
+        if missing:
+            stored = self._find_ids(missing, groupkey)
+            notfound = missing - set(stored)
+
+            if notfound and not dont_create:
+                # Create new entry for keys not found
+                stored.update(self._create_ids(notfound, groupkey))
+            if self.id_map is not None:
+                self.id_map.put_many(groupkey, stored)
+            found.update(stored)
+
+        if as_str:
+            return dict(zip(found.keys(), self.ints_to_base62(found.values())))
+        return found
+
+    def _find_ids(self, urls, groupkey):
+        """Returns {url: id} for the urls of groupkey that already exist"""
+        if self.url_hash:
+            # Entries are fetched by digest, comparing the full url and
+            # groupkey weeds out digest collisions
+            urls = set(urls)
+            digests = [url_digest(groupkey, url) for url in urls]
+            entries = self.db.urlById.find({'h': {'$in': digests}},
+                                           fields=['_id', 'groupkey', 'url'])
+            return {e['url']: e['_id'] for e in entries
+                    if e['url'] in urls and e.get('groupkey') == groupkey}
+
+        entries = self.db.urlById.find({'groupkey': groupkey, 'url': {'$in': list(urls)}},
+                                       fields={'_id': True, 'url': True})
+        return {e['url']: e['_id'] for e in entries}
+
+    def _may_exist(self, urls, groupkey):
+        """Drops the urls known_urls rules out"""
+        if self.known_urls is None:
+            return urls
+        return self.known_urls.may_exist(groupkey, urls)
+
+    def _map_ids(self, urls, groupkey):
+        """Returns {url: id} for the urls of groupkey found in id_map"""
+        found = self.id_map.get_many(groupkey, urls)
+        if self.verify_id_map and found:
+            entries = self._find_entries(found.values())
+            found = {url: id for url, id in found.iteritems()
+                     if id in entries and entries[id]['url'] == url
+                     and entries[id].get('groupkey') == groupkey}
+        return found
+
+    def _create_ids(self, urls, groupkey):
+        """Inserts entries for the urls with one unordered bulk write.
+
+        Returns {url: id}. When another writer created one of the urls
+        first, its ID is read back and returned instead.
+        """
+        urls = list(urls)
+        # before the write, so a filter never rules out a URL that exists.
+        # URLs that end up not inserted only cost a false positive
+        if self.known_urls is not None:
+            self.known_urls.add(groupkey, urls)
+        ids = self.id_allocator.allocate(len(urls))
+        bulk = self.db.urlById.initialize_unordered_bulk_op()
+        for url, counter_value in zip(urls, ids):
+            if self.unique_urls:
+                bulk.find({'groupkey': groupkey, 'url': url}).upsert().update_one(
+                    {'$setOnInsert': {'_id': counter_value}})
+            else:
+                bulk.insert(self._new_entry(counter_value, url, groupkey))
+
+        try:
+            result = bulk.execute({'w': 1})
+        except BulkWriteError as e:
+            result = e.details
+            for error in result['writeErrors']:
+                if error['code'] not in DUPLICATE_KEY_ERRORS:
+                    raise
+
+        if self.unique_urls:
+            # upserts that matched an existing entry don't report its ID
+            res = {urls[u['index']]: u['_id'] for u in result['upserted']}
+        else:
+            failed = set(error['index'] for error in result['writeErrors'])
+            res = {url: ids[i] for i, url in enumerate(urls) if i not in failed}
+
+        conflicts = set(urls) - set(res)
+        if conflicts:
+            winners = self._find_ids(conflicts, groupkey)
+            if conflicts - set(winners):
+                raise BulkWriteError(result)
+            res.update(winners)
+        return res
 
-        entries = self.db.urlById.find({'url': {'$in':urls}}, fields=['_id', 'groupkey','url'])
-        entries = [e for e in entries if e.get('groupkey') == groupkey]
-        found = set([entry['url'] for entry in entries])
-        notfound = set(urls) - set(found)
-
-        res = {}
-        for entry in entries:
-            res[entry['url']] = self.int_to_base62(entry['_id']) if as_str else entry[0]['_id']
-
-        if len(notfound) == 0 or dont_create:
-            return res
+    @mongodb_retry()
+    def get_or_create_id(self, url, groupkey):
+        """Returns the minified ID of the url, creating it if needed.
 
-        # Create new entry for keys not found
-        for url in notfound:
-            counter_value = self._get_current_counter_value()
-            self.db.urlById.insert({'_id': counter_value,
-                                    'url': url,
-                                    'groupkey': groupkey}, safe=True)
+        Existing and new urls alike cost a single upsert, so concurrent
+        callers agree on the ID. The ID offered to the upsert comes from a
+        leased block and is handed back when the url already existed.
+        Needs unique_urls.
+        """
+        if not self.unique_urls:
+            raise ValueError("get_or_create_id needs unique_urls=True.")
+        query = {'groupkey': groupkey, 'url': url}
+        if self.known_urls is not None:
+            self.known_urls.add(groupkey, [url])
+        _id = self.id_allocator.allocate(1)[0]
+        try:
+            entry = self.db.urlById.find_and_modify(
+                query=query, update={'$setOnInsert': {'_id': _id}},
+                upsert=True, new=True, fields={'_id': True})
+        except DuplicateKeyError:
+            # lost the race against a concurrent upsert of the same url
+            entry = self.db.urlById.find_one(query, fields={'_id': True})
+        if entry['_id'] != _id:
+            self.id_allocator.release([_id])
+        return self.int_to_base62(entry['_id'])
+
+    def _new_entry(self, _id, url, groupkey):
+        entry = {'_id': _id, 'url': url, 'groupkey': groupkey}
+        if self.url_hash:
+            entry['h'] = url_digest(groupkey, url)
+        return entry
 
-            value = self.int_to_base62(counter_value) if as_str else counter_value
-            res[url] = value
+    @mongodb_retry()
+    def backfill_url_hashes(self, batch_size=1000):
+        """Add the url digest to entries created before url_hash was on.
 
-        return res
+        Safe to run while the minifier is serving. Returns the number of
+        entries updated.
+        """
+        updated = 0
+        last_id = None
+        while True:
+            criteria = {'h': {'$exists': False}}
+            if last_id is not None:
+                criteria['_id'] = {'$gt': last_id}
+            entries = list(self.db.urlById.find(criteria,
+                                                fields=['_id', 'groupkey', 'url'],
+                                                sort=[('_id', 1)],
+                                                limit=batch_size))
+            if not entries:
+                return updated
+            for entry in entries:
+                self.db.urlById.update({'_id': entry['_id']},
+                                       {'$set': {'h': url_digest(entry['groupkey'],
+                                                                 entry['url'])}})
+            updated += len(entries)
+            last_id = entries[-1]['_id']
 
-    @mongodb_retry()
     def _get_current_counter_value(self):
-        counter = self.db.urlByIdMeta.find_and_modify(query={'_id': 'minifier_counter'},
-                                                          update={'$inc': {'value': 1}},
-                                                          upsert=True, new=True)
-        return counter['value']
+        return self.id_allocator.allocate(1)[0]
 
     @mongodb_retry()
     def get_multiple_strings(self, ids):
         """Looks up the string by its IDs (minified or integer form)"""
-        converted = {}
-        for id in ids:
-            if isinstance(id, basestring):
-                converted[self.base62_to_int(id)] = id
-            else:
-                converted[id] = id
-
-        criteria = {'_id':{'$in':converted.keys()}}
-        entries = self.db.urlById.find(criteria, fields=['url'])
-        res = {}
+        res = {id: entry['url'] for id, entry in self._find_entries(ids).iteritems()}
 
-        for entry in entries:
-            res[converted[ entry['_id'] ]] = entry['url']
-
-        notfound = set(converted.values()) - set(res.keys())
+        notfound = set(ids) - set(res.keys())
         for url in notfound:
             res[url] = None
 
         return res
 
+    def _find_entries(self, ids):
+        """Returns {id: entry} with url and groupkey for the IDs (minified
+        or integer form) that exist"""
+        minified = [id for id in ids if isinstance(id, basestring)]
+        converted = dict(zip(self.base62_to_ints(minified), minified))
+        converted.update((id, id) for id in ids if not isinstance(id, basestring))
+
+        criteria = {'_id':{'$in':converted.keys()}}
+        entries = self.db.urlById.find(criteria, fields=['url', 'groupkey'])
+        return {converted[entry['_id']]: entry for entry in entries}
+
     def get_string(self, id):
         """Looks up the string by its ID (minified or integer form)"""
         res = self.get_multiple_strings([id])
@@ -139,59 +381,258 @@ class Minifier(object):
 
     def int_to_base62(self, id):
         """Convert the int id to a user-friendly string using base62"""
-        if id < 0:
-            raise ValueError("Must supply a positive integer.")
-        l = len(self.alphabet)
-        converted = []
-        while id != 0:
-            id, r = divmod(id, l)
-            converted.insert(0, self.alphabet[r])
-        return "".join(converted) or '0'
+        return base62.encode(id, self.alphabet)
 
     def base62_to_int(self, minified):
         """Convert the base62 string back to an int"""
-        if set(minified) - set(self.alphabet):
-            raise ValueError("Minified ID contains invalid characters '%s'" % "".join(set(minified) - set(self.alphabet)))
+        return base62.decode(minified, self.alphabet)
+
+    def ints_to_base62(self, ids):
+        """Converts a batch of int ids, returns a list of strings"""
+        return base62.encode_many(ids, self.alphabet)
 
-        s = minified[::-1]
-        l = len(self.alphabet)
-        output = 0
-        for i, c in enumerate(s):
-            output += int(self.alphabet.index(c) * math.pow(l, i))
-        return int(output)
+    def base62_to_ints(self, minified):
+        """Converts a batch of base62 strings, returns a list of ints"""
+        return base62.decode_many(minified, self.alphabet)
 
 class CachedMinifier(Minifier):
     """
-    Minifier that caches its operations through a user-defined decorator
+    Minifier that caches its lookups in cache_client
+
+    Every URL and ID is cached on its own, under the keys the cached
+    decorators use for get_id(url, groupkey) and get_string(id), so single and
+    batch lookups share cache entries. Resolving a mapping caches both
+    directions at once.
+
+    get_id and get_string results are also kept in a per-instance, in-process
+    LRU (local_cache) of at most lrusize entries and, if set, lru_bytes bytes,
+    each valid for lru_ttl seconds. lru_policy 'tinylfu' keeps frequently
+    used entries from being flushed out by URLs seen only once.
+
+    Behind that LRU, lookups go through a TieredCache of cache_tiers and
+    then cache_client. shared_cache is a shorthand for a first tier,
+    usually a SharedMemoryCache all worker processes of a host use.
+
+    With coalesce on, threads that miss the LRU for the same item at the
+    same time share a single cache and mongo lookup. With negative_ttl set,
+    URLs and IDs that don't exist are remembered for that many seconds,
+    in an LRU of negative_size entries and in the cache.
+
+    With cache_decorator_class, like cached or a partial of it with
+    lock_timeout/early_refresh, get_id and get_string go through the
+    decorator on cache_client before the tiers, which adds its stampede
+    protection to single lookups. Batch lookups don't use it.
     """
     def __init__(self,
                  mongo_host,
                  mongo_db,
                  cache_client,
-                 cache_decorator_class,
-                 lrusize=500):
-        super(CachedMinifier,self).__init__(mongo_host, mongo_db)
-        lrucache = lrudecorator(lrusize)
+                 cache_decorator_class=None,
+                 lrusize=500,
+                 lru_bytes=None,
+                 lru_ttl=None,
+                 lru_policy='lru',
+                 coalesce=False,
+                 negative_ttl=None,
+                 negative_size=10000,
+                 shared_cache=None,
+                 cache_tiers=(),
+                 **kwargs):
+        super(CachedMinifier,self).__init__(mongo_host, mongo_db, **kwargs)
         self.cache_client = cache_client
-        self.dec = cache_decorator_class(cache_client)
+        self.shared_cache = shared_cache
+        self.cache = TieredCache([_shared_tier(shared_cache)] + list(cache_tiers) +
+                                 [cache_client])
+        self._flight = SingleFlight() if coalesce else None
+        self.negative_ttl = negative_ttl
+        self._negative = NegativeCache(negative_size, negative_ttl) if negative_ttl else None
+
+        if cache_decorator_class is not None:
+            self.dec = cache_decorator_class(cache_client)
+            self.get_string = self.dec(self.get_string)
+            self.get_id = self.dec(self.get_id)
+
+        self.local_cache = LocalCache(lrusize, lru_bytes, lru_ttl, policy=lru_policy)
+        self.get_string = local_cached(self.local_cache, self.get_string)
+        self.get_id = local_cached(self.local_cache, self.get_id)
+
+    def _id_key(self, url, groupkey):
+        """The key the cached decorators give get_id(url, groupkey)"""
+        return cache_key('get_id', {'url': url, 'groupkey': groupkey, 'dont_create': False},
+                         self.cache_namespace)
+
+    def _string_key(self, id):
+        """The key the cached decorators give get_string(id)"""
+        return cache_key('get_string', {'id': id}, self.cache_namespace)
 
-        self.get_string = lrucache(self.dec(self.get_string))
-        self.get_id = lrucache(self.dec(self.get_id))
-        self.get_multiple_strings = self.dec(self.get_multiple_strings)
-        self.get_multiple_ids = self.dec(self.get_multiple_ids)
+    def get_id(self, url, groupkey, dont_create=False):
+        return self.get_multiple_ids([url], groupkey, dont_create).get(url)
+
+    def get_multiple_ids(self, urls, groupkey, dont_create=False):
+        if not urls:
+            return None
+        if dont_create:
+            urls = self._may_exist(urls, groupkey)
+        keys = {self._id_key(url, groupkey): url for url in urls}
+        lookup_func = lambda items: super(CachedMinifier, self).get_multiple_ids(
+            items, groupkey, dont_create=dont_create)
+        reverse_func = lambda url, id: (self._string_key(id), url)
+        return self._get_cached_items(keys, lookup_func, dont_create, reverse_func)
+
+    def get_multiple_strings(self, ids):
+        keys = {self._string_key(id): id for id in ids}
+        groupkeys = {}
+        def lookup_func(items):
+            entries = self._find_entries(items)
+            groupkeys.update((id, entry.get('groupkey')) for id, entry in entries.iteritems())
+            return {id: entry['url'] for id, entry in entries.iteritems()}
+        def reverse_func(id, url):
+            minified = id if isinstance(id, basestring) else self.int_to_base62(id)
+            return (self._id_key(url, groupkeys[id]), minified)
+        # strings are never created by a lookup
+        res = self._get_cached_items(keys, lookup_func, True, reverse_func)
+        return {id: res.get(id) for id in ids}
+
+    def warm(self, entries, shared=True, local=False):
+        """Caches both lookup directions of urlById entries, in the cache
+        tiers with shared and in the in-process LRU with local"""
+        entries = list(entries)
+        minified = self.ints_to_base62([entry['_id'] for entry in entries])
+        if shared:
+            store = {}
+            for entry, id in zip(entries, minified):
+                if 'groupkey' in entry:
+                    store[self._id_key(entry['url'], entry['groupkey'])] = id
+                store[self._string_key(id)] = entry['url']
+            self.cache.set_many(store)
+            if self._negative is not None:
+                self._negative.discard_many(store)
+        if local:
+            store = {}
+            for entry, id in zip(entries, minified):
+                if 'groupkey' in entry:
+                    store[('get_id', (entry['url'], entry['groupkey']), ())] = id
+                store[('get_string', (id,), ())] = entry['url']
+            self.local_cache.set_many(store)
+
+    def _get_cached_items(self, keys, lookup_func, dont_create=False, reverse_func=None):
+        """Reads the {cache_key: item} keys in one go and looks up only
+        the missing items, returns {item: value}
+
+        reverse_func(item, value) gives the (cache_key, value) of the
+        opposite lookup, which is cached along with the found items.
+        """
+        fetch = lambda cache_keys: self._fetch_items(cache_keys, keys, lookup_func,
+                                                     dont_create, reverse_func)
+        if self._flight is None:
+            found = fetch(keys.keys())
+        else:
+            # lookups that can't create entries don't share flights with
+            # lookups that can
+            found = self._flight.do_many(
+                [(key, dont_create) for key in keys],
+                lambda flights: {(key, dont_create): val for key, val in
+                                 fetch([key for key, _ in flights]).iteritems()})
+            found = {key: val for (key, _), val in found.iteritems()}
+        return {keys[key]: val for key, val in found.iteritems()}
+
+    def _fetch_items(self, cache_keys, keys, lookup_func, dont_create, reverse_func):
+        """Returns {cache_key: value} from the cache or lookup_func.
+
+        Items known not to exist are skipped, unless the lookup may create
+        them.
+        """
+        if self._negative is not None and dont_create:
+            cache_keys = [key for key in cache_keys if key not in self._negative]
+        res = self.cache.get_many(cache_keys)
+        missing = {keys[key]: key for key in cache_keys
+                   if key not in res or (res[key] == NOT_FOUND and not dont_create)}
+        res = {key: val for key, val in res.iteritems() if val != NOT_FOUND}
+
+        if missing:
+            found = lookup_func(missing.keys()) or {}
+            found = {item: val for item, val in found.iteritems() if val is not None}
+            store = dict(reverse_func(item, val) for item, val in found.iteritems()
+                         ) if reverse_func else {}
+            found = {missing[item]: val for item, val in found.iteritems()}
+            store.update(found)
+            self.cache.set_many(store)
+            res.update(found)
+
+            if self._negative is not None:
+                self._negative.discard_many(store)
+                not_found = set(missing.values()) - set(found)
+                self._negative.add_many(not_found)
+                self.cache.set_many(dict.fromkeys(not_found, NOT_FOUND),
+                                    timeout=self.negative_ttl)
+        return res
 
 class SimplerMinifier(Minifier):
     # mini:<group_key>:<type (id|str)>:<hash>
     key_format = "mini:{group_key}:{get_type}:{hashed}"
     cache_expiry = 60 * 60 * 24 # these don't go bad, set expire to 1d
 
-    def __init__(self, mongo_db, redis_conn, group_key):
-        self._cache_conn = redis_conn
+    def __init__(self, mongo_db, redis_conn, group_key, lrusize=500, lru_bytes=None,
+                 lru_ttl=None, lru_policy='lru', coalesce=False, negative_ttl=None,
+                 negative_size=10000, shared_cache=None, cache_tiers=(), lock_timeout=None,
+                 early_refresh=None, hash_buckets=None, **kwargs):
+        """
+        redis_conn: redis connection, or a list or {name: connection} dict
+                    of them to shard the cache across, see RedisCacheBackend
+        lrusize: entries kept in the in-process LRU of get_id and get_string
+        lru_bytes: bytes of keys and values kept in that LRU, unbounded if None
+        lru_ttl: seconds an entry of that LRU stays valid, forever if None
+        lru_policy: 'lru', or 'tinylfu' to favour frequently used entries
+        coalesce: threads missing the same items at the same time share
+                  one redis and mongo lookup
+        negative_ttl: seconds to remember URLs and IDs that don't exist,
+                      in redis and in an LRU of negative_size entries
+        shared_cache: cache checked between the LRU and redis, usually a
+                      SharedMemoryCache all worker processes of a host use
+        cache_tiers: more CacheBackends or Tiers checked, in order, after
+                     shared_cache and before redis
+        lock_timeout: seconds one process may spend looking up keys missing
+                      from redis while the others missing them wait, see
+                      stampede
+        early_refresh: seconds before they expire that redis entries start
+                       having their expiry renewed on hits
+        hash_buckets: pack the redis entries into that many hashes, see
+                      redis_hash_cache. Negative entries then only go to
+                      the LRU, and buckets are only dropped by the
+                      server's maxmemory-policy. Can't be combined with
+                      early_refresh, bucket entries have no expiry of
+                      their own to renew.
+        """
+        if early_refresh and hash_buckets:
+            raise ValueError("early_refresh can't renew hash_buckets entries, "
+                             "pass only one of them.")
+        self.lock_timeout = lock_timeout
+        self.shared_cache = shared_cache
+        # values stay plain strings in redis, readable by any client
+        params = {'codec': 'bytes',
+                  'timeout': self.cache_expiry,
+                  'renew_early': early_refresh}
+        if isinstance(redis_conn, (list, tuple, dict)):
+            params['nodes'] = redis_conn
+        else:
+            params['client'] = redis_conn
+        if hash_buckets:
+            params['buckets'] = hash_buckets
+            self._redis_cache = RedisHashCacheBackend(params)
+        else:
+            self._redis_cache = RedisCacheBackend(params)
+        self.cache = TieredCache([_shared_tier(shared_cache)] + list(cache_tiers) +
+                                 [self._redis_cache])
         self.group_key = group_key
-        super(SimplerMinifier,self).__init__(mongo_db.connection, mongo_db.name)
+        self._flight = SingleFlight() if coalesce else None
+        self.negative_ttl = negative_ttl
+        self._negative = NegativeCache(negative_size, negative_ttl) if negative_ttl else None
+        super(SimplerMinifier,self).__init__(mongo_db.connection, mongo_db.name, **kwargs)
 
+        self.local_cache = LocalCache(lrusize, lru_bytes, lru_ttl, policy=lru_policy)
+        self.get_id = local_cached(self.local_cache, self.get_id)
+        self.get_string = local_cached(self.local_cache, self.get_string)
 
-    @lrudecorator(500)
     def get_id(self, url, dont_create=False):
         return self.get_ids([url], dont_create).get(url)
 
@@ -203,10 +644,12 @@ class SimplerMinifier(Minifier):
                                                        self.group_key,
                                                        as_str=True,
                                                        dont_create=dont_create)
-        return self._get_items(urls, 'str', lookup_func)
+        reverse_func = lambda url, minified: ('id', minified, url)
+        if dont_create:
+            urls = self._may_exist(urls, self.group_key)
+        return self._get_items(urls, 'str', lookup_func, dont_create, reverse_func)
 
 
-    @lrudecorator(500)
     def get_string(self, minifier_id):
         res = self.get_strings([minifier_id]).get(minifier_id)
         if not res:
@@ -216,39 +659,170 @@ class SimplerMinifier(Minifier):
     @mongodb_retry()
     def get_strings(self, minifier_ids):
         """Looks up the string by its ID (minified or integer form)"""
+        groupkeys = {}
         def lookup_func(items):
             # decode from base62 to int
-            from_int = {self.base62_to_int(item): item for item in items}
+            from_int = dict(zip(self.base62_to_ints(items), items))
             criteria = {'_id': {'$in': from_int.keys()}}
-            urls = self.db.urlById.find(criteria, fields=['url'])
-            return {from_int[rec["_id"]]: rec["url"] for rec in urls}
-
-        return self._get_items(minifier_ids, "id", lookup_func)
-
+            urls = self.db.urlById.find(criteria, fields=['url', 'groupkey'])
+            res = {}
+            for rec in urls:
+                res[from_int[rec["_id"]]] = rec["url"]
+                groupkeys[from_int[rec["_id"]]] = rec.get("groupkey")
+            return res
 
-    def _get_items(self, items, get_type, lookup_func):
-        """Looks up the string by its ID (minified or integer form)"""
+        def reverse_func(minified, url):
+            # IDs are global, only URLs of our group are cached by URL
+            if groupkeys[minified] == self.group_key:
+                return ('str', url, minified)
+
+        # strings are never created by a lookup
+        return self._get_items(minifier_ids, "id", lookup_func, True, reverse_func)
+
+
+    def warm(self, entries, shared=True, local=False):
+        """Caches both lookup directions of urlById entries, in the cache
+        tiers with shared and in the in-process LRU with local. Only the
+        URLs of our group are cached by URL."""
+        entries = list(entries)
+        minified = self.ints_to_base62([entry['_id'] for entry in entries])
+        if shared:
+            store = {}
+            for entry, id in zip(entries, minified):
+                store.update(dict.fromkeys(self._cache_key_names('id', [id]), entry['url']))
+                if entry.get('groupkey') == self.group_key:
+                    store.update(dict.fromkeys(self._cache_key_names('str', [entry['url']]), id))
+            self._store_cache(store)
+            if self._negative is not None:
+                self._negative.discard_many(store)
+        if local:
+            store = {}
+            for entry, id in zip(entries, minified):
+                store[('get_string', (id,), ())] = entry['url']
+                if entry.get('groupkey') == self.group_key:
+                    store[('get_id', (entry['url'],), ())] = id
+            self.local_cache.set_many(store)
+
+    def _get_items(self, items, get_type, lookup_func, dont_create=False, reverse_func=None):
+        """Looks up the string by its ID (minified or integer form)
+
+        reverse_func(item, val) gives (get_type, item, val) for the
+        opposite lookup, which is cached along with the found items.
+        """
         if not items:
             return {}
         keys = self._cache_key_names(get_type, items)
 
+        fetch = lambda cache_keys: self._fetch_items(cache_keys, keys, lookup_func,
+                                                     dont_create, reverse_func)
+        if self._flight is None:
+            res = fetch(keys.keys())
+        else:
+            # lookups that can't create entries don't share flights with
+            # lookups that can
+            res = self._flight.do_many(
+                [(key, dont_create) for key in keys],
+                lambda flights: {(key, dont_create): val for key, val in
+                                 fetch([key for key, _ in flights]).iteritems()})
+            res = {key: val for (key, _), val in res.iteritems()}
+
+        # the res now is cache_key -> minified, translate that to url -> minified
+        return {keys[key]: val for key, val in res.iteritems()}
+
+    def _fetch_items(self, lookup_keys, keys, lookup_func, dont_create, reverse_func):
+        """Returns {cache_key: val} for lookup_keys from redis or lookup_func.
+
+        Items known not to exist are skipped, unless the lookup may create
+        them.
+        """
+        if self._negative is not None and dont_create:
+            lookup_keys = [key for key in lookup_keys if key not in self._negative]
+        if not lookup_keys:
+            return {}
+
         # check cache
-        lookup_keys = keys.keys()
-        res = {key: val for key, val in zip(lookup_keys,
-                                            self._cache_conn.mget(lookup_keys)) if val}
+        res = self.cache.get_many(lookup_keys)
+        missing_keys = set(key for key in lookup_keys
+                           if key not in res or (res[key] == NOT_FOUND and not dont_create))
+        res = {key: val for key, val in res.iteritems() if val != NOT_FOUND}
+
+        locks = []
+        if missing_keys and self.lock_timeout:
+            token = lock_token()
+            waited, missing_keys, locks = self._lead_or_wait(missing_keys, dont_create, token)
+            res.update((key, val) for key, val in waited.iteritems() if val != NOT_FOUND)
+        try:
+            self._lookup_missing(res, missing_keys, keys, lookup_func, reverse_func)
+        finally:
+            # locks that expired and were taken over stay
+            if locks:
+                self._redis_cache.delete_if_equal([lock_key(key) for key in locks], token)
+        return res
 
-        missing_keys = set(keys.keys()) - set(res.keys())
+    def _lookup_missing(self, res, missing_keys, keys, lookup_func, reverse_func):
+        """Looks up missing_keys, caching and adding to res what's found"""
         if missing_keys:
             missing_items = {keys[key]: key for key in missing_keys}
             found = lookup_func(missing_items.keys())
+            reverse = self._reverse_entries(found, reverse_func)
 
             # convert from {item: val} to {cache_key: val} so we can cache
             found = {missing_items[item]: val for item, val in found.iteritems()}
-            self._store_cache(found)
+            reverse.update(found)
+            self._store_cache(reverse)
             res.update(found)
 
-        # the res now is cache_key -> minified, translate that to url -> minified
-        return {keys[key]: val for key, val in res.iteritems()}
+            if self._negative is not None:
+                self._negative.discard_many(reverse)
+                self._store_negative(missing_keys - set(found))
+
+    lock_poll_interval = 0.05
+
+    def _lead_or_wait(self, cache_keys, dont_create, token):
+        """Takes the lookup locks of the cache_keys no other process holds,
+        storing token in them, and waits for the others to be looked up.
+
+        Returns ({cache_key: val} others looked up, set of cache keys left
+        to look up ourselves, cache keys we hold the lock of)
+        """
+        # a lock lives on the node of its own key, like stampede's
+        def take(client, locks):
+            with client.pipeline(transaction=False) as pipe:
+                for lock in locks:
+                    pipe.set(lock, token, nx=True, px=int(self.lock_timeout * 1000))
+                return [locks_of[lock] for lock, won in zip(locks, pipe.execute()) if won]
+        def locked(client, locks):
+            with client.pipeline(transaction=False) as pipe:
+                for lock in locks:
+                    pipe.exists(lock)
+                return [locks_of[lock] for lock, exists in zip(locks, pipe.execute()) if exists]
+
+        cache_keys = list(cache_keys)
+        locks_of = {lock_key(key): key for key in cache_keys}
+        taken = sum(self._redis_cache.map_nodes(locks_of, take), [])
+        waiting = set(cache_keys) - set(taken)
+        left = set(taken)
+        res = {}
+        deadline = time.time() + self.lock_timeout
+        while waiting and time.time() < deadline:
+            time.sleep(self.lock_poll_interval)
+            # the lock check first, a value stored after it is still seen
+            still_locked = set(sum(self._redis_cache.map_nodes(
+                [lock_key(key) for key in waiting], locked), []))
+            found = self._redis_cache.get_many(waiting)
+            still_waiting = set()
+            for key in waiting:
+                val = found.get(key)
+                # a lookup that could create the item doesn't take NOT_FOUND
+                if val and (val != NOT_FOUND or dont_create):
+                    res[key] = val
+                elif key in still_locked:
+                    still_waiting.add(key)
+                else:
+                    left.add(key) # the holder gave up without storing it
+            waiting = still_waiting
+        left.update(waiting)
+        return res, left, taken
 
     def _cache_key_names(self, get_type, keys):
         """generates a {cache_key: key} dict for the given keys"""
@@ -256,18 +830,26 @@ class SimplerMinifier(Minifier):
                                        get_type=get_type,
                                        hashed=md5.md5(_unicode_to_str(key)).hexdigest()): key for key in keys}
 
+    def _reverse_entries(self, found, reverse_func):
+        """{cache_key: val} of the opposite lookups for the found items"""
+        res = {}
+        if reverse_func is None:
+            return res
+        for item, val in found.iteritems():
+            reverse = reverse_func(item, val)
+            if reverse:
+                get_type, reverse_item, reverse_val = reverse
+                res.update((key, reverse_val) for key in
+                           self._cache_key_names(get_type, [reverse_item]))
+        return res
+
     def _store_cache(self, cache_dict):
         """saves the dict to cache with the default expiration"""
-        with self._cache_conn.pipeline() as pipe:
-            for cache_key, val in cache_dict.iteritems():
-                # need reverse key now
-                pipe.set(cache_key, val)
-                pipe.expire(cache_key, self.cache_expiry)
-            pipe.execute()
-
-def _unicode_to_str(text, encoding=None, errors='strict'):
-    if encoding is None:
-        encoding = 'utf-8'
-    if isinstance(text, unicode):
-        return text.encode(encoding, errors)
-    return text
+        self.cache.set_many(cache_dict)
+
+    def _store_negative(self, cache_keys):
+        """remembers that the items of cache_keys don't exist"""
+        if not cache_keys:
+            return
+        self._negative.add_many(cache_keys)
+        self.cache.set_many(dict.fromkeys(cache_keys, NOT_FOUND), timeout=self.negative_ttl)
@@ -0,0 +1,46 @@
+"""
+Negative caching of URLs and IDs that don't exist.
+
+Lookups that can't create entries (get_id with dont_create, get_string)
+for unknown items would go to mongo every time. Their misses are kept for
+a short TTL, locally and in the shared cache under the NOT_FOUND marker.
+Creating an entry overwrites the shared marker and drops the local one.
+"""
+import threading
+import time
+
+import pylru
+
+# Cached in place of a value for items known not to exist. It can't be a
+# base62 ID and URLs don't contain NUL bytes.
+NOT_FOUND = '\x00'
+
+class NegativeCache(object):
+    """Thread-safe, size bounded set of keys that expire after ttl seconds"""
+    def __init__(self, size=10000, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._expiry = pylru.lrucache(size)
+
+    def __contains__(self, key):
+        with self._lock:
+            try:
+                expiry = self._expiry[key]
+            except KeyError:
+                return False
+            if expiry < time.time():
+                del self._expiry[key]
+                return False
+            return True
+
+    def add_many(self, keys):
+        expiry = time.time() + self.ttl
+        with self._lock:
+            for key in keys:
+                self._expiry[key] = expiry
+
+    def discard_many(self, keys):
+        with self._lock:
+            for key in keys:
+                if key in self._expiry:
+                    del self._expiry[key]
@@ -1,59 +1,260 @@
-import md5
+import Queue
+import os
+import sys
+import threading
+
 import redis
-import cPickle as pickle
 
-from cache import CacheBackend
+from cache import CacheBackend, batches, call_key
+from hash_ring import HashRing
+from negative_cache import NOT_FOUND
+from stampede import cached_call, refresh_early
+from value_codecs import get_codec
+
+def node_name(client):
+    """host:port/db of a redis connection"""
+    kwargs = client.connection_pool.connection_kwargs
+    return '%s:%s/%s' % (kwargs.get('host', 'localhost'), kwargs.get('port', 6379),
+                         kwargs.get('db', 0))
+
+def connect(node):
+    """Redis connection to a 'host:port/db' address, connections pass through"""
+    if not isinstance(node, basestring):
+        return node
+    address, _, db = node.partition('/')
+    host, _, port = address.partition(':')
+    return redis.Redis(host, int(port or 6379), int(db or 0))
+
+class _Workers(object):
+    """Daemon threads running calls in parallel, idle ones just block.
+    The threads only run in the process that started them, pid."""
+    def __init__(self, size):
+        self.pid = os.getpid()
+        self._tasks = Queue.Queue()
+        for i in xrange(size):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            index, call, results = self._tasks.get()
+            try:
+                results.put((index, True, call()))
+            except Exception:
+                results.put((index, False, sys.exc_info()))
+
+    def run(self, calls):
+        """Returns the results of calls, the first made in this thread"""
+        results = Queue.Queue()
+        for index, call in enumerate(calls[1:], 1):
+            self._tasks.put((index, call, results))
+        res = [None] * len(calls)
+        errors = []
+        try:
+            res[0] = calls[0]()
+        except Exception:
+            errors.append(sys.exc_info())
+        for i in xrange(len(calls) - 1):
+            index, ok, value = results.get()
+            if ok:
+                res[index] = value
+            else:
+                errors.append(value)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return res
 
 class RedisCacheBackend(CacheBackend):
+    """Cache in one redis server, or sharded across several.
+
+    params['nodes'], a list of redis connections or 'host:port/db' strings,
+    spreads the keys over those servers by consistent hashing. Multi-key
+    calls then go to every server involved in parallel. Nodes are named
+    by address, a {name: connection or address} dict names them
+    explicitly so a server can move without moving its keys.
+    """
     def __init__(self,params):
         self.timeout = params.get('timeout', 3600)
-        host = params.get('host', 'localhost')
-        port = params.get('port', 6379)
-        self.client = redis.Redis(host,port)
-        
+        self.batch_size = params.get('batch_size', self.batch_size)
+        # pickle stays the default so releases that only read pickles can
+        # share the cache, switch once every reader runs this version
+        self.codec = get_codec(params.get('codec', 'pickle'),
+                               params.get('compress_threshold'))
+        # seconds, for values that never change: hits about to expire get
+        # their timeout renewed, see stampede.refresh_early
+        self.renew_early = params.get('renew_early')
+        self.ring = None
+        self._workers = None
+        self._workers_lock = threading.Lock()
+        nodes = params.get('nodes')
+        if nodes:
+            if isinstance(nodes, dict):
+                nodes = [(name, connect(node)) for name, node in nodes.iteritems()]
+            else:
+                nodes = [(node_name(node), node) for node in map(connect, nodes)]
+            self.ring = HashRing(nodes)
+            self.client = None
+            return
+        # an existing connection can be shared instead of opening one
+        self.client = params.get('client')
+        if self.client is None:
+            host = params.get('host', 'localhost')
+            port = params.get('port', 6379)
+            self.client = redis.Redis(host,port)
+
+    def client_for(self, key):
+        """The redis connection holding key"""
+        if self.ring is None:
+            return self.client
+        return self.ring.get_node(key)
+
+    def map_nodes(self, keys, func):
+        """Calls func(client, keys) once per server with the keys it holds,
+        in parallel when there are several. Returns the list of results."""
+        keys = list(keys)
+        if self.ring is None:
+            return [func(self.client, keys)]
+        calls = [(self.ring.nodes[name], node_keys)
+                 for name, node_keys in self.ring.split(keys).iteritems()]
+        if len(calls) <= 1:
+            return [func(client, node_keys) for client, node_keys in calls]
+        return self._node_workers().run([lambda client=client, node_keys=node_keys:
+                                          func(client, node_keys)
+                                          for client, node_keys in calls])
+
+    def _node_workers(self):
+        with self._workers_lock:
+            # a forked child has the pool but not its threads
+            if self._workers is None or self._workers.pid != os.getpid():
+                self._workers = _Workers(len(self.ring.nodes) - 1)
+            return self._workers
+
     def get(self, key):
-        value = self.client.get(key)
+        value = self.client_for(key).get(key)
         if not value:
             return None
-        return pickle.loads(value)
+        return self.codec.decode(value)
+
+    def get_with_ttl(self, key):
+        with self.client_for(key).pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.pttl(key)
+            value, pttl = pipe.execute()
+        if not value:
+            return None, None
+        return self.codec.decode(value), pttl / 1000.0 if pttl >= 0 else None
+
+    def add(self, key, value, timeout=None):
+        timeout = timeout or self.timeout
+        # lock timeouts can be fractions of a second
+        return bool(self.client_for(key).set(key, self.codec.encode(value), nx=True,
+                                    px=int(timeout * 1000) if timeout else None))
 
     def get_all(self, keys):
-        values = self.client.mget(keys)
-        return [(pickle.loads(value) if value else None) for value in values]
+        values = self.get_many(keys)
+        return [values.get(key) for key in keys]
+
+    def get_many(self, keys):
+        res = {}
+        for found in self.map_nodes(keys, self._get_many):
+            res.update(found)
+        return res
+
+    def _get_many(self, client, keys):
+        res = {}
+        for batch in batches(keys, self.batch_size):
+            if self.renew_early:
+                res.update(self._get_renewing(client, batch))
+            else:
+                res.update((key, self.codec.decode(value))
+                           for key, value in zip(batch, client.mget(batch)) if value)
+        return res
+
+    def _get_renewing(self, client, keys):
+        with client.pipeline(transaction=False) as pipe:
+            pipe.mget(keys)
+            for key in keys:
+                pipe.pttl(key)
+            replies = pipe.execute()
+        res = {}
+        renew = []
+        for key, value, pttl in zip(keys, replies[0], replies[1:]):
+            if not value:
+                continue
+            res[key] = self.codec.decode(value)
+            # negative entries have to expire
+            if (res[key] != NOT_FOUND and pttl >= 0 and
+                    refresh_early(pttl / 1000.0, self.renew_early)):
+                renew.append(key)
+        if renew:
+            with client.pipeline(transaction=False) as pipe:
+                for key in renew:
+                    pipe.expire(key, self.timeout)
+                pipe.execute()
+        return res
 
     def set(self, key, value):
-        if self.timeout:
-            self.client.set(key, pickle.dumps(value))
-            self.client.expire(key, self.timeout)
-        else:
-            self.client.set(key, pickle.dumps(value))
+        # the expiry goes with the SET, no separate EXPIRE round trip
+        self.client_for(key).set(key, self.codec.encode(value), ex=self.timeout or None)
+
+    def set_many(self, mapping, timeout=None):
+        timeout = timeout or self.timeout or None
+        def set_node(client, keys):
+            for batch in batches(keys, self.batch_size):
+                with client.pipeline(transaction=False) as pipe:
+                    for key in batch:
+                        pipe.set(key, self.codec.encode(mapping[key]), ex=timeout)
+                    pipe.execute()
+        if mapping:
+            self.map_nodes(mapping, set_node)
 
     def delete(self, key):
-         self.client.delete(key)
+         self.client_for(key).delete(key)
+
+    def delete_many(self, keys):
+        def delete_node(client, keys):
+            for batch in batches(keys, self.batch_size):
+                client.delete(*batch)
+        self.map_nodes(keys, delete_node)
+
+    def delete_if_equal(self, keys, value):
+        """Deletes those of keys still holding value, the check and delete
+        in one WATCH transaction. Keys are plain strings, for locks."""
+        encoded = self.codec.encode(value)
+        def delete_node(client, keys):
+            def delete_held(pipe):
+                held = [key for key, current in zip(keys, pipe.mget(keys))
+                        if current == encoded]
+                pipe.multi()
+                if held:
+                    pipe.delete(*held)
+            client.transaction(delete_held, *keys)
+        self.map_nodes(keys, delete_node)
 
     def clear(self):
-        self.client.flushdb()
+        clients = self.ring.nodes.values() if self.ring is not None else [self.client]
+        for client in clients:
+            client.flushdb()
 
 class cached(object):
-    """ This decorator wraps methods and caches their results"""
-    def __init__(self,client):
+    """ This decorator wraps methods and caches their results
+
+    lock_timeout and early_refresh protect against stampedes, see stampede
+    """
+    def __init__(self, client, lock_timeout=None, early_refresh=None, beta=1.0):
         self.client = client
-        
+        self.lock_timeout = lock_timeout
+        self.early_refresh = early_refresh
+        self.beta = beta
+
     def _cache_key(self, func, args, kw):
-        classname = args[0].__class__.__name__
-        funcname = func.__name__
-        mangled_args = str(args)+str(kw)
-        key = "%s:%s:%s" % (classname,funcname,md5.md5(mangled_args).hexdigest())
-        return key
+        return call_key(func, args, kw)
 
     def __call__(self, func):
         def _wrapped(*args,**kw):
-            cacheclient = self.client
             key = self._cache_key(func, args,kw)
-            data = cacheclient.get(key)
-            if data is None:
-                data = func(*args,**kw)
-                cacheclient.set(key, data)
-            return data
+            return cached_call(self.client, key, lambda: func(*args, **kw),
+                               self.lock_timeout, self.early_refresh, self.beta)
 
         return _wrapped
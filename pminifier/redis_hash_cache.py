@@ -0,0 +1,143 @@
+"""
+Redis cache that packs entries into bucketed hashes.
+
+A Redis string costs about 50-90 bytes of overhead besides its key and
+value, which is most of the memory at hundreds of millions of short
+mappings. Here every entry is a field of one of `buckets` hashes, named by
+8 bytes of the md5 of its key. Hashes of up to hash-max-listpack-entries
+fields (hash-max-ziplist-entries before Redis 7) whose values are at most
+hash-max-listpack-value bytes are stored as one compact array, a few
+bytes of overhead per entry. Size buckets for about ENTRIES_PER_BUCKET
+entries each, passing the expected number of entries does that, and raise
+hash-max-listpack-value above the longest URLs cached:
+
+    hash-max-listpack-entries 256
+    hash-max-listpack-value 1024
+
+Hash fields can't expire on their own, so a bucket expires as a whole
+`timeout` seconds after its last write. Under a steady stream of new
+entries every bucket keeps being written, so in practice nothing
+expires: the server needs a maxmemory limit and an allkeys eviction
+policy, like allkeys-lru, to drop old buckets. Entries that have to
+expire on time, like NOT_FOUND markers, aren't stored, and stampede
+locks stay plain Redis strings.
+"""
+import math
+import md5
+
+from cache import batches
+from digest import _unicode_to_str
+from negative_cache import NOT_FOUND
+from redis_cache_backend import RedisCacheBackend
+from stampede import LOCK_SUFFIX
+
+# well below hash-max-listpack-entries, so buckets stay compact as their
+# sizes vary
+ENTRIES_PER_BUCKET = 100
+
+def _is_lock(key):
+    return key.endswith(LOCK_SUFFIX)
+
+def bucket_count(entries):
+    """Buckets to hold entries at about ENTRIES_PER_BUCKET each"""
+    return max(1, int(math.ceil(entries / float(ENTRIES_PER_BUCKET))))
+
+class RedisHashCacheBackend(RedisCacheBackend):
+    """RedisCacheBackend storing entries in params['buckets'] hashes
+    named params['prefix'] + bucket number. Instead of buckets, params
+    can give the expected number of 'entries' to size them for.
+
+    add() and delete_if_equal() work on plain strings, they are only
+    meant for stampede locks.
+    """
+    def __init__(self, params):
+        super(RedisHashCacheBackend, self).__init__(params)
+        if params.get('buckets'):
+            self.buckets = params['buckets']
+        elif params.get('entries'):
+            self.buckets = bucket_count(params['entries'])
+        else:
+            raise ValueError("RedisHashCacheBackend needs the number of 'buckets' "
+                             "or of expected 'entries'.")
+        self.prefix = params.get('prefix', 'mini:h:')
+
+    def _locate(self, key):
+        """(bucket key, field) of a cache key"""
+        digest = md5.md5(_unicode_to_str(key)).digest()
+        bucket = int(digest[:8].encode('hex'), 16) % self.buckets
+        return '%s%x' % (self.prefix, bucket), digest[8:]
+
+    def _by_bucket(self, keys):
+        """{bucket key: [(key, field)]}"""
+        res = {}
+        for key in keys:
+            bucket, field = self._locate(key)
+            res.setdefault(bucket, []).append((key, field))
+        return res
+
+    def get(self, key):
+        if _is_lock(key):
+            return super(RedisHashCacheBackend, self).get(key)
+        bucket, field = self._locate(key)
+        value = self.client_for(bucket).hget(bucket, field)
+        if not value:
+            return None
+        return self.codec.decode(value)
+
+    def get_with_ttl(self, key):
+        return self.get(key), None
+
+    def get_many(self, keys):
+        keys = list(keys)
+        res = super(RedisHashCacheBackend, self).get_many(
+            [key for key in keys if _is_lock(key)])
+        by_bucket = self._by_bucket(key for key in keys if not _is_lock(key))
+        def get_node(client, buckets):
+            res = {}
+            # one HMGET per bucket, batch_size buckets per round trip
+            for batch in batches(buckets, self.batch_size):
+                with client.pipeline(transaction=False) as pipe:
+                    for bucket in batch:
+                        pipe.hmget(bucket, [field for key, field in by_bucket[bucket]])
+                    replies = pipe.execute()
+                for bucket, values in zip(batch, replies):
+                    res.update((key, self.codec.decode(value)) for (key, field), value
+                               in zip(by_bucket[bucket], values) if value)
+            return res
+        for found in self.map_nodes(by_bucket, get_node):
+            res.update(found)
+        return res
+
+    def set(self, key, value, timeout=None):
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        timeout = timeout or self.timeout
+        by_bucket = self._by_bucket(key for key, value in mapping.iteritems()
+                                    if value != NOT_FOUND)
+        def set_node(client, buckets):
+            for batch in batches(buckets, self.batch_size):
+                with client.pipeline(transaction=False) as pipe:
+                    for bucket in batch:
+                        pipe.hmset(bucket, dict((field, self.codec.encode(mapping[key]))
+                                                for key, field in by_bucket[bucket]))
+                        if timeout:
+                            pipe.expire(bucket, int(math.ceil(timeout)))
+                    pipe.execute()
+        if by_bucket:
+            self.map_nodes(by_bucket, set_node)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        super(RedisHashCacheBackend, self).delete_many([key for key in keys if _is_lock(key)])
+        by_bucket = self._by_bucket(key for key in keys if not _is_lock(key))
+        def delete_node(client, buckets):
+            with client.pipeline(transaction=False) as pipe:
+                for bucket in buckets:
+                    pipe.hdel(bucket, *[field for key, field in by_bucket[bucket]])
+                pipe.execute()
+        if by_bucket:
+            self.map_nodes(by_bucket, delete_node)
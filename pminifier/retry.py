@@ -0,0 +1,19 @@
+import logging
+import time
+
+from pymongo.errors import AutoReconnect
+
+log = logging.getLogger('pminifier')
+
+class mongodb_retry(object):
+    """Retry operation 100 times, wait between retries"""
+    def __call__(self,f):
+        def f_retry(cls,*args, **kwargs):
+            for i in range(100):
+                try:
+                    return f(cls,*args, **kwargs)
+                except AutoReconnect:
+                    log.warning("Failed to connect to PRIMARY. Sleeping 1 second")
+                    time.sleep(1.0)
+
+        return f_retry
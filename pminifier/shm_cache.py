@@ -0,0 +1,200 @@
+"""
+Cache shared by every process on a host through a memory mapped file.
+
+Pre-forked workers that open the same path (on /dev/shm for RAM backing)
+see each other's entries, so a mapping fetched by one worker is a local
+hit for all of them and survives worker restarts.
+
+The file holds a fixed number of slots of slot_size bytes. A key can live
+in one of two slots picked from its md5, and when both are taken the one
+written longest ago is replaced. Keys and encoded values that don't fit a
+slot aren't cached.
+
+Reads take no locks: every slot carries a sequence number that writers
+make odd while they change the slot, and a reader retries when the number
+was odd or changed under it. Writers lock the slot's stripe, with a thread
+lock and an fcntl lock on a byte past the end of the file.
+"""
+import fcntl
+import md5
+import mmap
+import os
+import struct
+import threading
+import time
+
+from cache import CacheBackend
+from value_codecs import get_codec
+
+MAGIC = 'PMSHM001'
+FILE_HEADER = struct.Struct('<8sII') # magic, slots, slot_size
+HEADER_SIZE = 64
+# seq, key hash, expiry, time written, key length, value length
+SLOT_HEADER = struct.Struct('<IqddHH')
+SEQ = struct.Struct('<I')
+READ_ATTEMPTS = 3
+
+class SharedMemoryCache(CacheBackend):
+    """mmap backed cache shared between processes.
+
+    path: file to map, created if missing. Every process must open it
+          with the same slots and slot_size.
+    slots: number of entries the file holds
+    slot_size: bytes per slot, including a 32 byte header and the key
+    timeout: seconds an entry stays valid, None to keep it until replaced
+    stripes: number of write locks the slots are spread over
+    codec: name of a value codec or a Codec, see value_codecs
+    """
+    def __init__(self, path, slots=65536, slot_size=256, timeout=None,
+                 stripes=256, codec='int'):
+        if slot_size <= SLOT_HEADER.size:
+            raise ValueError('slot_size must be larger than %i' % SLOT_HEADER.size)
+        self.client = None
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.timeout = timeout
+        self.stripes = stripes
+        self.codec = get_codec(codec)
+        self._size = HEADER_SIZE + slots * slot_size
+        self._locks = [threading.Lock() for i in xrange(stripes)]
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        self._init_file()
+        self._mm = mmap.mmap(self._fd, self._size)
+
+    def _init_file(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, self._size)
+                os.write(self._fd, FILE_HEADER.pack(MAGIC, self.slots, self.slot_size))
+                return
+            header = os.read(self._fd, FILE_HEADER.size)
+            if header != FILE_HEADER.pack(MAGIC, self.slots, self.slot_size):
+                raise ValueError('%s was created with another slot layout' % self.path)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+    def get(self, key):
+        key = _key_bytes(key)
+        keyhash, candidates = self._candidates(key)
+        now = time.time()
+        for slot in candidates:
+            data = self._read(slot, key, keyhash, now)
+            if data is not None:
+                return self.codec.decode(data)
+        return None
+
+    def set(self, key, value, timeout=None):
+        self._write(_key_bytes(key), self.codec.encode(value), self._expiry(timeout))
+
+    def set_many(self, mapping, timeout=None):
+        expiry = self._expiry(timeout)
+        for key, value in mapping.iteritems():
+            self._write(_key_bytes(key), self.codec.encode(value), expiry)
+
+    def delete(self, key):
+        key = _key_bytes(key)
+        keyhash, candidates = self._candidates(key)
+        with self._locked(candidates):
+            for slot in candidates:
+                if self._read(slot, key, keyhash, 0) is not None:
+                    self._store(slot, 0, 0.0, 0.0, '', '')
+
+    def clear(self):
+        for slot in xrange(self.slots):
+            with self._locked([slot]):
+                self._store(slot, 0, 0.0, 0.0, '', '')
+
+    def _expiry(self, timeout):
+        timeout = self.timeout if timeout is None else timeout
+        return time.time() + timeout if timeout else 0.0
+
+    def _candidates(self, key):
+        keyhash, second = struct.unpack('<qQ', md5.md5(key).digest())
+        first = keyhash % self.slots
+        second %= self.slots
+        return keyhash, (first,) if first == second else (first, second)
+
+    def _offset(self, slot):
+        return HEADER_SIZE + slot * self.slot_size
+
+    def _read(self, slot, key, keyhash, now):
+        """Returns the encoded value of key in slot, or None"""
+        offset = self._offset(slot)
+        for attempt in xrange(READ_ATTEMPTS):
+            seq, slot_hash, expiry, written, klen, vlen = SLOT_HEADER.unpack_from(self._mm, offset)
+            if seq & 1:
+                time.sleep(0) # a writer is in the middle of this slot
+                continue
+            if slot_hash != keyhash or klen != len(key):
+                return None
+            start = offset + SLOT_HEADER.size
+            data = self._mm[start:start + klen + vlen]
+            if SEQ.unpack_from(self._mm, offset)[0] != seq:
+                continue
+            if data[:klen] != key or (expiry and expiry <= now):
+                return None
+            return data[klen:]
+        return None
+
+    def _write(self, key, data, expiry):
+        if SLOT_HEADER.size + len(key) + len(data) > self.slot_size:
+            return
+        keyhash, candidates = self._candidates(key)
+        with self._locked(candidates):
+            now = time.time()
+            slot = self._pick_slot(candidates, key, keyhash, now)
+            self._store(slot, keyhash, expiry, now, key, data)
+
+    def _pick_slot(self, candidates, key, keyhash, now):
+        """The slot holding key, else a free one, else the oldest"""
+        oldest = None
+        for slot in candidates:
+            if self._read(slot, key, keyhash, 0) is not None:
+                return slot
+        for slot in candidates:
+            _, _, expiry, written, klen, _ = SLOT_HEADER.unpack_from(self._mm, self._offset(slot))
+            if not klen or (expiry and expiry <= now):
+                return slot
+            if oldest is None or written < oldest[0]:
+                oldest = (written, slot)
+        return oldest[1]
+
+    def _store(self, slot, keyhash, expiry, written, key, data):
+        offset = self._offset(slot)
+        seq = SEQ.unpack_from(self._mm, offset)[0]
+        SEQ.pack_into(self._mm, offset, (seq + 1) & 0xffffffff)
+        start = offset + SLOT_HEADER.size
+        self._mm[start:start + len(key) + len(data)] = key + data
+        SLOT_HEADER.pack_into(self._mm, offset, (seq + 1) & 0xffffffff, keyhash,
+                              expiry, written, len(key), len(data))
+        SEQ.pack_into(self._mm, offset, (seq + 2) & 0xffffffff)
+
+    def _locked(self, slots):
+        return _StripeLock(self, sorted(set(slot % self.stripes for slot in slots)))
+
+class _StripeLock(object):
+    """Holds the thread and file locks of stripes, in order"""
+    def __init__(self, cache, stripes):
+        self.cache = cache
+        self.stripes = stripes
+
+    def __enter__(self):
+        for stripe in self.stripes:
+            self.cache._locks[stripe].acquire()
+            fcntl.lockf(self.cache._fd, fcntl.LOCK_EX, 1, self.cache._size + stripe)
+
+    def __exit__(self, *exc):
+        for stripe in reversed(self.stripes):
+            fcntl.lockf(self.cache._fd, fcntl.LOCK_UN, 1, self.cache._size + stripe)
+            self.cache._locks[stripe].release()
+
+def _key_bytes(key):
+    if isinstance(key, unicode):
+        return key.encode('utf-8')
+    return key
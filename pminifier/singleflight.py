@@ -0,0 +1,71 @@
+"""
+Coalescing of concurrent lookups for the same key.
+
+When several threads miss the local cache for the same URL or ID at once,
+only the first one goes to the backends. The others wait for its result.
+"""
+import threading
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.found = False
+        self.value = None
+        self.error = None
+
+class SingleFlight(object):
+    """Runs at most one backend call per key at a time"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """Returns func(), or the result of the call already running for key"""
+        res = self.do_many([key], lambda keys: {key: func()})
+        return res.get(key)
+
+    def do_many(self, keys, func):
+        """Looks up keys with func(keys) -> {key: value}.
+
+        func only gets the keys no other thread is currently fetching, the
+        results for the rest come from those threads. Keys func doesn't
+        return are missing from the result. If a call raises, every thread
+        waiting on it gets the exception.
+        """
+        owned = {}
+        waiting = {}
+        with self._lock:
+            for key in set(keys):
+                call = self._calls.get(key)
+                if call is None:
+                    owned[key] = self._calls[key] = _Call()
+                else:
+                    waiting[key] = call
+
+        res = {}
+        if owned:
+            try:
+                found = func(owned.keys()) or {}
+            except Exception as e:
+                self._finish(owned, {}, e)
+                raise
+            self._finish(owned, found, None)
+            res.update((key, found[key]) for key in owned if key in found)
+
+        for key, call in waiting.iteritems():
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            if call.found:
+                res[key] = call.value
+        return res
+
+    def _finish(self, calls, found, error):
+        with self._lock:
+            for key, call in calls.iteritems():
+                del self._calls[key]
+                if key in found:
+                    call.found = True
+                    call.value = found[key]
+                call.error = error
+                call.done.set()
@@ -0,0 +1,94 @@
+"""
+Stampede protection for cached values.
+
+When a popular key is missing or expires, every process that misses it
+recomputes it at the same moment. Two defences, both off by default:
+
+    lock_timeout: the first process to miss a key takes a short lived lock
+        (an add of a random token to key + ':lock') and recomputes it, the
+        others poll the cache until the value shows up, the lock goes away
+        or lock_timeout runs out. It has to be longer than a recompute
+        takes. The holder only deletes the lock if it still holds its
+        token, a lock that expired and was taken over stays.
+    early_refresh: XFetch. A hit is recomputed before it expires with a
+        probability that grows as its TTL runs out, early_refresh being
+        about how many seconds a recompute takes. Only one process does so
+        at a time and the others keep using the current value. Needs a
+        backend whose get_with_ttl knows TTLs.
+"""
+import math
+import os
+import random
+import time
+
+from negative_cache import NOT_FOUND
+
+LOCK_SUFFIX = ':lock'
+
+def lock_key(key):
+    return key + LOCK_SUFFIX
+
+def lock_token():
+    """Random lock value, so only its holder releases a lock"""
+    return os.urandom(8).encode('hex')
+
+def refresh_early(ttl, delta, beta=1.0, rand=None):
+    """True if a value with ttl seconds left should be recomputed now"""
+    if ttl is None or not delta:
+        return False
+    return -delta * beta * math.log(1.0 - (rand or random.random)()) >= ttl
+
+def cached_call(client, key, compute, lock_timeout=None, early_refresh=None,
+                beta=1.0, poll_interval=0.05):
+    """Returns the value of key from client, or compute() while guarding
+    against stampedes as configured.
+
+    None results aren't stored, and NOT_FOUND markers the minifiers keep
+    for missing items count as misses, compute decides about those.
+    """
+    if early_refresh:
+        value, ttl = client.get_with_ttl(key)
+    else:
+        value, ttl = client.get(key), None
+    if _found(value):
+        if not refresh_early(ttl, early_refresh, beta):
+            return value
+        # someone else refreshing it already, keep using the current value
+        token = lock_token()
+        if not client.add(lock_key(key), token, lock_timeout or 10):
+            return value
+        return _compute_locked(client, key, compute, token)
+
+    if not lock_timeout:
+        return _compute(client, key, compute)
+    token = lock_token()
+    if client.add(lock_key(key), token, lock_timeout):
+        return _compute_locked(client, key, compute, token)
+
+    deadline = time.time() + lock_timeout
+    while time.time() < deadline:
+        time.sleep(poll_interval)
+        # plain gets, get_many may renew what it reads. The lock check
+        # first, a value stored after it is still seen
+        locked = client.get(lock_key(key)) is not None
+        value = client.get(key)
+        if _found(value):
+            return value
+        if not locked:
+            break # the holder gave up without storing a value
+    return _compute(client, key, compute)
+
+def _found(value):
+    return value is not None and value != NOT_FOUND
+
+def _compute(client, key, compute):
+    value = compute()
+    if value is not None:
+        client.set(key, value)
+    return value
+
+def _compute_locked(client, key, compute, token):
+    try:
+        return _compute(client, key, compute)
+    finally:
+        client.delete_if_equal([lock_key(key)], token)
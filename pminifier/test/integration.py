@@ -3,6 +3,9 @@ import unittest
 
 from distutils import dir_util
 
+import mock
+
+from pminifier.minifier import SimplerMinifier
 from pminifier.test.cluster import get_global_cluster
 
 log = logging.getLogger(__name__)
@@ -26,6 +29,16 @@ class PMinifierIntegrationTest(unittest.TestCase):
     def setUp(self):
         get_global_cluster() # make sure everything is started
 
+    def simpler_minifier(self, group_key='groupkey', redis_conn=None, **kwargs):
+        """A SimplerMinifier on the test cluster, separate instances stand
+        for separate processes"""
+        mongo_db = mock.MagicMock()
+        mongo_db.connection = self.cluster.mongo.conn
+        mongo_db.name = 'pminifier'
+        if redis_conn is None:
+            redis_conn = self.cluster.redis.conn
+        return SimplerMinifier(mongo_db, redis_conn, group_key, **kwargs)
+
 
     def tearDown(self):
         self.cluster.flush()
@@ -0,0 +1,91 @@
+"""
+Cache made of an ordered list of CacheBackends, fastest first.
+
+Reads ask each tier in turn for the keys still missing, and copy what a
+slower tier had into the faster ones. Writes go to every tier with one
+set_many call each. How a tier takes part is set by wrapping it in a
+Tier, so adding or dropping a tier is a configuration change:
+
+    cache = TieredCache([LocalCache(10000),
+                         Tier(SharedMemoryCache('/dev/shm/pminifier'), timeout=3600),
+                         RedisCacheBackend({'host': 'redis'})])
+"""
+from cache import CacheBackend
+from negative_cache import NOT_FOUND
+
+class Tier(object):
+    """A backend and how it is used in a TieredCache.
+
+    timeout: expiry of the entries written to this tier when the write
+             doesn't set one, None for the backend's default
+    backfill: copy hits of slower tiers into this one
+    write: store writes in this tier, off for tiers filled some other way
+    negatives: store NOT_FOUND markers, off for tiers that can't expire
+               them on time
+    """
+    def __init__(self, backend, timeout=None, backfill=True, write=True, negatives=True):
+        self.backend = backend
+        self.timeout = timeout
+        self.backfill = backfill
+        self.write = write
+        self.negatives = negatives
+
+class TieredCache(CacheBackend):
+    """Reads through and writes to tiers, a list of CacheBackends or Tiers
+    ordered fastest first. None entries are skipped."""
+    def __init__(self, tiers):
+        self.client = None
+        self.tiers = [tier if isinstance(tier, Tier) else Tier(tier)
+                      for tier in tiers if tier is not None]
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        res = {}
+        missing = list(keys)
+        for i, tier in enumerate(self.tiers):
+            if not missing:
+                break
+            found = tier.backend.get_many(missing)
+            if not found:
+                continue
+            res.update(found)
+            missing = [key for key in missing if key not in found]
+            # a NOT_FOUND marker has to expire with its original timeout,
+            # which the slower tier doesn't tell
+            backfill = {key: val for key, val in found.iteritems() if val != NOT_FOUND}
+            if backfill:
+                for faster in self.tiers[:i]:
+                    if faster.backfill:
+                        faster.backend.set_many(backfill, timeout=faster.timeout)
+        return res
+
+    def set(self, key, value, timeout=None):
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        if not mapping:
+            return
+        found = None
+        for tier in self.tiers:
+            if not tier.write:
+                continue
+            if tier.negatives:
+                tier.backend.set_many(mapping, timeout=timeout or tier.timeout)
+                continue
+            if found is None:
+                found = {key: val for key, val in mapping.iteritems() if val != NOT_FOUND}
+            if found:
+                tier.backend.set_many(found, timeout=timeout or tier.timeout)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        for tier in self.tiers:
+            tier.backend.delete_many(keys)
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.backend.clear()
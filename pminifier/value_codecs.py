@@ -0,0 +1,170 @@
+"""
+Codecs turning cache values into bytes and back.
+
+Everything but PickleCodec writes a one byte tag in front of the payload.
+Pickles never start with one of the tag bytes, so untagged data is treated
+as written by an older release and handed to the backend's legacy decoder.
+That keeps existing cache entries readable while a new codec rolls out.
+"""
+import cPickle as pickle
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+RAW = '\x01'
+TEXT = '\x02'
+INT = '\x03'
+MSGPACK = '\x04'
+PICKLE = '\x05'
+ZLIB = '\x06'
+
+def decode(data, legacy=pickle.loads):
+    """Decodes data written by any codec, legacy decodes untagged data"""
+    decoder = _DECODERS.get(data[:1])
+    if decoder is None:
+        return legacy(data)
+    return decoder(data)
+
+def _decode_msgpack(data):
+    if msgpack is None:
+        raise ValueError("msgpack is needed to decode this value")
+    return msgpack.unpackb(data[1:], raw=False)
+
+_DECODERS = {
+    RAW: lambda data: data[1:],
+    TEXT: lambda data: data[1:].decode('utf-8'),
+    INT: lambda data: _read_varint(data, 1),
+    PICKLE: lambda data: pickle.loads(data[1:]),
+    MSGPACK: _decode_msgpack,
+    # compressed payloads come from our codecs, untagged means pickle
+    ZLIB: lambda data: decode(zlib.decompress(data[1:])),
+}
+
+class Codec(object):
+    """Turns a cache value into bytes"""
+    def encode(self, value):
+        raise NotImplementedError
+
+    def decode(self, data, legacy=pickle.loads):
+        return decode(data, legacy)
+
+class PickleCodec(Codec):
+    """Untagged pickles, the format every release can read"""
+    def encode(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+class RawCodec(Codec):
+    """Byte and unicode strings stored as they are, anything else pickled"""
+    def encode(self, value):
+        if isinstance(value, str):
+            return RAW + value
+        if isinstance(value, unicode):
+            return TEXT + value.encode('utf-8')
+        return PICKLE + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+class BytesCodec(Codec):
+    """Strings stored as they are without a tag, for values also read by
+    clients that don't know these codecs. Unicode comes back as utf-8."""
+    def encode(self, value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if not isinstance(value, str):
+            raise TypeError("BytesCodec only stores strings, not %r" % type(value))
+        return value
+
+    def decode(self, data, legacy=None):
+        return data
+
+class IntCodec(RawCodec):
+    """Non negative integers as varints, anything else like RawCodec"""
+    def encode(self, value):
+        if isinstance(value, (int, long)) and not isinstance(value, bool) and value >= 0:
+            return INT + _write_varint(value)
+        return super(IntCodec, self).encode(value)
+
+class MsgpackCodec(Codec):
+    """msgpack for structured values, needs the msgpack package"""
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("MsgpackCodec needs the msgpack package")
+
+    def encode(self, value):
+        return MSGPACK + msgpack.packb(value, use_bin_type=True)
+
+class AutoCodec(IntCodec):
+    """Strings raw, integers as varints and the rest as msgpack when it's
+    installed, pickle otherwise"""
+    def __init__(self):
+        self._structured = MsgpackCodec() if msgpack is not None else None
+
+    def encode(self, value):
+        if self._structured is None or isinstance(value, (str, unicode, int, long)):
+            return super(AutoCodec, self).encode(value)
+        return self._structured.encode(value)
+
+class CompressedCodec(Codec):
+    """Compresses what codec writes when it's longer than threshold bytes"""
+    def __init__(self, codec, threshold=1024, level=6):
+        self.codec = codec
+        self.threshold = threshold
+        self.level = level
+
+    def encode(self, value):
+        data = self.codec.encode(value)
+        if len(data) > self.threshold:
+            compressed = ZLIB + zlib.compress(data, self.level)
+            if len(compressed) < len(data):
+                return compressed
+        return data
+
+    def decode(self, data, legacy=pickle.loads):
+        if data[:1] == ZLIB:
+            data = zlib.decompress(data[1:])
+        return self.codec.decode(data, legacy)
+
+CODECS = {
+    'pickle': PickleCodec,
+    'raw': RawCodec,
+    'bytes': BytesCodec,
+    'int': IntCodec,
+    'msgpack': MsgpackCodec,
+    'auto': AutoCodec,
+}
+
+def get_codec(codec, compress_threshold=None):
+    """Returns a codec from its name in CODECS or a Codec instance"""
+    if isinstance(codec, basestring):
+        if codec not in CODECS:
+            raise ValueError("Unknown codec '%s'" % codec)
+        codec = CODECS[codec]()
+    if compress_threshold is not None:
+        # compressed values couldn't be told apart from untagged ones
+        if isinstance(codec, BytesCodec):
+            raise ValueError("The bytes codec can't be compressed")
+        codec = CompressedCodec(codec, compress_threshold)
+    return codec
+
+def _write_varint(value):
+    out = []
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(chr(byte | 0x80))
+        else:
+            out.append(chr(byte))
+            return ''.join(out)
+
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    for c in data[pos:]:
+        byte = ord(c)
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value
+        shift += 7
+    raise ValueError("Truncated varint")
@@ -0,0 +1,156 @@
+"""
+Warm the caches from urlById after a cache flush or failover.
+
+Streams urlById by _id, newest first by default, and caches both lookup
+directions of every entry through the minifier's cache tiers, one batched
+write per tier and batch. max_rate throttles the load on mongo and the
+cache. With local, a process also fills its in-process LRU at startup.
+
+    python -m pminifier.warmup --mongo-host localhost --redis-host localhost \\
+        --groupkey test --limit 1000000 --rate 20000
+"""
+import argparse
+import logging
+import time
+
+import pymongo
+import redis
+
+from minifier import CachedMinifier, SimplerMinifier
+from redis_cache_backend import RedisCacheBackend, cached, connect
+from redis_hash_cache import RedisHashCacheBackend
+from retry import mongodb_retry
+
+log = logging.getLogger('pminifier')
+
+class EntryStream(object):
+    """Batches of urlById entries, paged by _id.
+
+    groupkey: only entries of that groupkey
+    min_id, max_id: only entries with _id in that range, both included
+    newest_first: page from the highest _id down
+    """
+    def __init__(self, collection, groupkey=None, min_id=None, max_id=None,
+                 newest_first=True, batch_size=1000):
+        self.collection = collection
+        self.groupkey = groupkey
+        self.min_id = min_id
+        self.max_id = max_id
+        self.newest_first = newest_first
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        last_id = None
+        while True:
+            entries = self._fetch(last_id)
+            if not entries:
+                return
+            yield entries
+            last_id = entries[-1]['_id']
+
+    @mongodb_retry()
+    def _fetch(self, last_id):
+        id_range = {}
+        if self.min_id is not None:
+            id_range['$gte'] = self.min_id
+        if self.max_id is not None:
+            id_range['$lte'] = self.max_id
+        if last_id is not None:
+            id_range['$lt' if self.newest_first else '$gt'] = last_id
+        criteria = {'_id': id_range} if id_range else {}
+        if self.groupkey is not None:
+            criteria['groupkey'] = self.groupkey
+        return list(self.collection.find(criteria, fields=['_id', 'url', 'groupkey'],
+                                         sort=[('_id', -1 if self.newest_first else 1)],
+                                         limit=self.batch_size))
+
+def warm(minifier, groupkey=None, min_id=None, max_id=None, limit=None,
+         newest_first=True, batch_size=1000, max_rate=None, local=False):
+    """Caches both directions of urlById entries through minifier.
+
+    limit: most entries to load
+    max_rate: most entries per second
+    local: also fill the minifier's in-process LRU, with as many of the
+           first entries as it holds
+
+    Returns the number of entries loaded.
+    """
+    stream = EntryStream(minifier.db.urlById, groupkey, min_id, max_id,
+                         newest_first, batch_size)
+    # each entry takes two LRU entries, one per direction
+    local_left = (minifier.local_cache.max_entries or 0) // 2 if local else 0
+    local_entries = []
+    loaded = 0
+    start = time.time()
+    for entries in stream:
+        if limit is not None:
+            entries = entries[:limit - loaded]
+        minifier.warm(entries)
+        if local_left > 0:
+            local_entries.extend(entries[:local_left])
+            local_left -= len(entries[:local_left])
+        loaded += len(entries)
+        log.info('Warmed %i urlById entries', loaded)
+        if limit is not None and loaded >= limit:
+            break
+        if max_rate:
+            ahead = loaded / float(max_rate) - (time.time() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+    if local_entries:
+        # the first entries streamed end up the most recently used
+        minifier.warm(reversed(local_entries), shared=False, local=True)
+    return loaded
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--mongo-host', default='localhost')
+    parser.add_argument('--mongo-db', default='pminifier')
+    parser.add_argument('--redis-host', default='localhost')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--redis-nodes', help='comma separated host:port/db of the '
+                        'redis servers the cache is sharded across')
+    parser.add_argument('--layout', choices=['simpler', 'cached'], default='simpler',
+                        help='cache keys of SimplerMinifier or CachedMinifier')
+    parser.add_argument('--codec', default='pickle', help='CachedMinifier value codec')
+    parser.add_argument('--hash-buckets', type=int, help='warm a cache packed into '
+                        'that many Redis hashes, see redis_hash_cache')
+    parser.add_argument('--groupkey', help='only warm this groupkey, '
+                        'SimplerMinifier caches URLs of this group')
+    parser.add_argument('--min-id', type=int)
+    parser.add_argument('--max-id', type=int)
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--oldest-first', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--rate', type=float, help='most entries per second')
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    conn = pymongo.Connection(options.mongo_host)
+    if options.redis_nodes:
+        redis_conn = [connect(node) for node in options.redis_nodes.split(',')]
+        params = {'nodes': redis_conn}
+    else:
+        redis_conn = redis.Redis(options.redis_host, options.redis_port)
+        params = {'client': redis_conn}
+    if options.layout == 'simpler':
+        if options.groupkey is None:
+            parser.error('--groupkey is needed for the simpler layout')
+        minifier = SimplerMinifier(conn[options.mongo_db], redis_conn, options.groupkey,
+                                   hash_buckets=options.hash_buckets)
+    else:
+        params['codec'] = options.codec
+        if options.hash_buckets:
+            params['buckets'] = options.hash_buckets
+            cache_client = RedisHashCacheBackend(params)
+        else:
+            cache_client = RedisCacheBackend(params)
+        minifier = CachedMinifier(conn, options.mongo_db, cache_client, cached)
+
+    loaded = warm(minifier, options.groupkey, options.min_id, options.max_id,
+                  options.limit, not options.oldest_first, options.batch_size,
+                  options.rate)
+    print 'Warmed %i entries' % loaded
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,8 @@ from setuptools import setup, find_packages
 install_requires = ['pymongo','pylru','redis']
 tests_require = ['mock', 'coverage']
 lint_requires = ['pep8', 'pyflakes']
+msgpack_requires = ['msgpack']
+numpy_requires = ['numpy']
 setup_requires = []
 
 if 'nosetests' in sys.argv[1:]:
@@ -23,5 +25,7 @@ setup(
         'test': tests_require,
         'all': install_requires + tests_require,
         'lint': lint_requires,
+        'msgpack': msgpack_requires,
+        'numpy': numpy_requires,
     },
 )
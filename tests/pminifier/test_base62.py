@@ -0,0 +1,46 @@
+import random
+import unittest
+
+import mock
+
+from pminifier import base62
+
+class Base62Tests(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.ids = [1, 61, 62, 3294, 9999999999999999, 2 ** 63 - 1]
+        self.ids += [rng.randrange(1, 2 ** 63) for i in range(200)]
+
+    def test_known_values(self):
+        self.assertEqual('LfqqC7n0s', base62.encode(9999999999999999))
+        self.assertEqual(9999999999999999, base62.decode('LfqqC7n0s'))
+        self.assertEqual(3294, base62.decode(u'0U'))
+
+    def test_exact_for_large_ids(self):
+        for id in [2 ** 64 + 1, 62 ** 20 - 1, 10 ** 30 + 7]:
+            self.assertEqual(id, base62.decode(base62.encode(id)))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, base62.encode, -1)
+        self.assertRaises(ValueError, base62.decode, '0U!')
+
+    def test_batches(self):
+        minified = [base62.encode(id) for id in self.ids]
+        self.assertEqual(minified, base62.encode_many(self.ids))
+        self.assertEqual(self.ids, base62.decode_many(minified))
+        self.assertEqual([], base62.encode_many([]))
+        self.assertEqual([], base62.decode_many([]))
+
+    def test_batches_without_numpy(self):
+        with mock.patch.object(base62, 'numpy', None):
+            self.test_batches()
+
+    def test_batch_invalid(self):
+        minified = ['0U'] * 100
+        self.assertRaises(ValueError, base62.encode_many, [1] * 100 + [-1])
+        self.assertRaises(ValueError, base62.decode_many, minified + ['0U!'])
+        self.assertRaises(ValueError, base62.decode_many, minified + [u'0\xfc'])
+
+    def test_batch_mixed_types(self):
+        self.assertEqual([3294] * 100, base62.decode_many([u'0U', '0U'] * 50))
+        self.assertEqual(['0U'] * 100, base62.encode_many([3294, 3294L] * 50))
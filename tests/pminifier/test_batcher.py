@@ -0,0 +1,74 @@
+import threading
+
+import mock
+
+from pminifier.test.integration import PMinifierIntegrationTest
+from pminifier.batcher import BatchingMinifier
+from pminifier.minifier import Minifier
+
+class BatchingMinifierTests(PMinifierIntegrationTest):
+    def setUp(self):
+        self.m = Minifier(self.cluster.mongo.conn, 'pminifier')
+
+    def run_threads(self, targets):
+        threads = [threading.Thread(target=target) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_get_id(self):
+        batcher = BatchingMinifier(self.m, max_wait=0.2)
+        urls = ['http://example.com/%i' % i for i in range(10)]
+        results = {}
+        def target(url):
+            return lambda: results.__setitem__(url, batcher.get_id(url, 'test'))
+        with mock.patch.object(self.m, 'get_multiple_ids',
+                               wraps=self.m.get_multiple_ids) as spy:
+            self.run_threads([target(url) for url in urls])
+            self.assertTrue(spy.call_count < len(urls))
+        self.assertEqual(self.m.get_multiple_ids(urls, 'test'), results)
+
+    def test_max_batch_size(self):
+        batcher = BatchingMinifier(self.m, max_batch_size=3, max_wait=0.2)
+        urls = ['http://example.com/%i' % i for i in range(9)]
+        with mock.patch.object(self.m, 'get_multiple_ids',
+                               wraps=self.m.get_multiple_ids) as spy:
+            self.run_threads([lambda url=url: batcher.get_id(url, 'test') for url in urls])
+            for call in spy.call_args_list:
+                self.assertTrue(len(call[0][0]) <= 3)
+
+    def test_get_string(self):
+        batcher = BatchingMinifier(self.m, max_wait=0)
+        o_id = self.m.get_id("http://www.youtube.com/", 'test')
+        self.assertEqual("http://www.youtube.com/", batcher.get_string(o_id))
+        self.assertRaises(Minifier.DoesNotExist, batcher.get_string, 9001)
+
+    def test_errors_reach_every_caller(self):
+        batcher = BatchingMinifier(self.m, max_wait=0.2)
+        errors = []
+        def target():
+            try:
+                batcher.get_id('http://example.com/', 'test')
+            except ValueError as e:
+                errors.append(e)
+        with mock.patch.object(self.m, 'get_multiple_ids', side_effect=ValueError):
+            self.run_threads([target] * 3)
+        self.assertEqual(3, len(errors))
+
+    def test_simpler_minifier(self):
+        simpler = self.simpler_minifier('test')
+        batcher = BatchingMinifier(simpler, max_wait=0.2)
+        urls = ['http://example.com/%i' % i for i in range(5)]
+        results = {}
+        def target(url):
+            return lambda: results.__setitem__(url, batcher.get_id(url))
+        self.run_threads([target(url) for url in urls])
+        # went through the redis cache, not straight to mongo
+        with mock.patch.object(Minifier, '_get_id_multi') as lookup:
+            self.assertEqual(results, simpler.get_ids(urls))
+            self.assertEqual(results[urls[0]], batcher.get_id(urls[0], 'test'))
+            self.assertFalse(lookup.called)
+        self.assertEqual(urls[1], batcher.get_string(results[urls[1]]))
+        self.assertRaises(Minifier.DoesNotExist, batcher.get_string, 'AfTea')
+        self.assertRaises(ValueError, batcher.get_id, urls[0], 'other')
@@ -0,0 +1,86 @@
+import unittest
+
+import mock
+
+from pminifier.test.integration import PMinifierIntegrationTest
+from pminifier.bloom import BloomFilter, KnownUrls
+from pminifier.minifier import Minifier
+
+class BloomFilterTests(unittest.TestCase):
+    def test_contains(self):
+        bloom = BloomFilter(1000, 0.01)
+        urls = ['http://example.com/%i' % i for i in range(1000)]
+        for url in urls:
+            bloom.add(url)
+        self.assertTrue(all(url in bloom for url in urls))
+        bloom.add(u'http://g\xf6\xf6gle.com')
+        self.assertTrue(u'http://g\xf6\xf6gle.com' in bloom)
+        false_positives = sum(1 for i in range(10000) if 'http://other.com/%i' % i in bloom)
+        self.assertTrue(false_positives < 300)
+
+    def test_bytes(self):
+        bloom = BloomFilter(1000, 0.01)
+        bloom.add('http://google.com')
+        copy = BloomFilter(1000, 0.01, bloom.to_bytes().rstrip('\0'))
+        self.assertEqual(bloom.bits, copy.bits)
+        self.assertTrue('http://google.com' in copy)
+
+class KnownUrlsTests(PMinifierIntegrationTest):
+    def setUp(self):
+        self.m = Minifier(self.cluster.mongo.conn, 'pminifier')
+        self.ids = self.m.get_multiple_ids(['http://google.com', 'http://bing.com'], 'test')
+
+    def test_unbuilt_groupkeys_pass(self):
+        known = KnownUrls(1000)
+        self.assertEqual(['http://nope.com'], known.may_exist('test', ['http://nope.com']))
+        known.add('test', ['http://nope.com'])
+
+    def test_local(self):
+        known = KnownUrls(1000)
+        self.assertEqual(2, known.build(self.m.db.urlById, 'test', batch_size=1))
+        self.assertEqual(['http://google.com'],
+                         known.may_exist('test', ['http://google.com', 'http://nope.com']))
+        known.add('test', ['http://nope.com'])
+        self.assertEqual(['http://nope.com'], known.may_exist('test', ['http://nope.com']))
+        self.assertEqual(['http://nope.com'], known.may_exist('other', ['http://nope.com']))
+
+    def test_shared_through_redis(self):
+        redis = self.cluster.redis.conn
+        builder = KnownUrls(1000, redis_conn=redis)
+        other = KnownUrls(1000, redis_conn=redis, refresh_interval=0)
+        # created by another process while the filter isn't ready yet
+        other.add('test', ['http://early.com'])
+        self.assertEqual(['http://early.com'], other.may_exist('test', ['http://early.com']))
+
+        builder.build(self.m.db.urlById, 'test')
+        self.assertEqual(['http://google.com', 'http://early.com'],
+                         other.may_exist('test', ['http://google.com', 'http://early.com',
+                                                  'http://nope.com']))
+        builder.add('test', ['http://late.com'])
+        self.assertEqual(['http://late.com'], other.may_exist('test', ['http://late.com']))
+
+    def test_reload_on_new_version(self):
+        redis = self.cluster.redis.conn
+        builder = KnownUrls(1000, redis_conn=redis)
+        builder.build(self.m.db.urlById, 'test')
+        other = KnownUrls(1000, redis_conn=redis, refresh_interval=3600)
+        self.assertEqual([], other.may_exist('test', ['http://late.com']))
+
+        # created elsewhere, the local copy answers until the next check
+        builder.add('test', ['http://late.com'])
+        with mock.patch.object(redis, 'get', wraps=redis.get) as get:
+            self.assertEqual([], other.may_exist('test', ['http://late.com']))
+            self.assertFalse(get.called)
+
+        other.refresh_interval = 0
+        with mock.patch.object(redis, 'pipeline', wraps=redis.pipeline) as pipeline:
+            self.assertEqual(['http://late.com'],
+                             other.may_exist('test', ['http://late.com', 'http://nope.com']))
+            self.assertEqual(1, pipeline.call_count)
+            # same version, nothing to load
+            self.assertEqual([], other.may_exist('test', ['http://nope.com']))
+            self.assertEqual(1, pipeline.call_count)
+            # nor after adding URLs itself
+            other.add('test', ['http://own.com'])
+            self.assertEqual(['http://own.com'], other.may_exist('test', ['http://own.com']))
+            self.assertEqual(2, pipeline.call_count)
@@ -0,0 +1,91 @@
+import unittest
+
+from pminifier.cache import call_key, cache_key
+from pminifier.redis_cache_backend import cached
+
+class RecordingBackend(object):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+class CacheKeyTests(unittest.TestCase):
+    def test_stable_key(self):
+        key = cache_key('get_id', {'url': 'http://google.com', 'groupkey': 'test'})
+        self.assertTrue(key.startswith('pminifier:v2:get_id:'))
+        self.assertEqual(key, cache_key('get_id', {'url': u'http://google.com',
+                                                   'groupkey': 'test'}))
+        self.assertEqual(key, cache_key('get_id', dict([('groupkey', 'test'),
+                                                        ('url', 'http://google.com')])))
+
+    def test_arguments_matter(self):
+        key = cache_key('get_id', {'url': 'http://google.com', 'groupkey': 'test'})
+        self.assertNotEqual(key, cache_key('get_id', {'url': 'http://google.com',
+                                                      'groupkey': 'other'}))
+        self.assertNotEqual(key, cache_key('get_string', {'url': 'http://google.com',
+                                                          'groupkey': 'test'}))
+        self.assertNotEqual(key, cache_key('get_id', {'url': 'http://google.com',
+                                                      'groupkey': 'test',
+                                                      'dont_create': True}))
+        self.assertNotEqual(cache_key('get_string', {'id': 5}),
+                            cache_key('get_string', {'id': '5'}))
+        self.assertEqual(cache_key('get_string', {'id': 5}),
+                         cache_key('get_string', {'id': 5L}))
+
+    def test_namespace(self):
+        key = cache_key('get_string', {'id': 5}, 'pminifier')
+        self.assertTrue(key.startswith('pminifier:v2:pminifier:get_string:'))
+        self.assertNotEqual(key, cache_key('get_string', {'id': 5}, 'other'))
+        self.assertNotEqual(key, cache_key('get_string', {'id': 5}))
+
+    def test_call_key(self):
+        class Thing(object):
+            cache_namespace = 'things'
+            def get_id(self, url, groupkey, dont_create=False):
+                pass
+        def get_id(url, groupkey, dont_create=False):
+            pass
+        thing = Thing()
+        key = cache_key('get_id', {'url': 'a', 'groupkey': 'b', 'dont_create': False}, 'things')
+        self.assertEqual(key, call_key(thing.get_id, ('a', 'b'), {}))
+        self.assertEqual(key, call_key(thing.get_id, ('a', 'b', False), {}))
+        self.assertEqual(key, call_key(thing.get_id, ('a',), {'groupkey': 'b',
+                                                              'dont_create': False}))
+        self.assertEqual(key, call_key(Thing.__dict__['get_id'], (thing, 'a', 'b'), {}))
+        self.assertNotEqual(key, call_key(thing.get_id, ('a', 'b'), {'dont_create': True}))
+        self.assertEqual(cache_key('get_id', {'url': 'a', 'groupkey': 'b', 'dont_create': False}),
+                         call_key(get_id, ('a', 'b'), {}))
+
+    def test_instances_share_keys(self):
+        backend = RecordingBackend()
+        calls = []
+        class Worker(object):
+            @cached(backend)
+            def get_id(self, url, groupkey):
+                calls.append(url)
+                return 'id'
+        Worker().get_id('http://google.com', 'test')
+        Worker().get_id(u'http://google.com', 'test')
+        self.assertEqual(['http://google.com'], calls)
+        self.assertEqual(1, len(backend.data))
+
+    def test_keyword_and_namespace(self):
+        backend = RecordingBackend()
+        calls = []
+        class Worker(object):
+            def __init__(self, namespace):
+                self.cache_namespace = namespace
+            @cached(backend)
+            def get_id(self, url, groupkey, dont_create=False):
+                calls.append(url)
+                return 'id'
+        Worker('one').get_id('http://google.com', 'test', False)
+        Worker('one').get_id('http://google.com', groupkey='test', dont_create=False)
+        Worker('one').get_id('http://google.com', 'test')
+        self.assertEqual(1, len(calls))
+        Worker('two').get_id('http://google.com', 'test')
+        self.assertEqual(2, len(calls))
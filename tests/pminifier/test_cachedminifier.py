@@ -1,10 +1,19 @@
 import unittest
 import sys
 import os
+import tempfile
+import threading
+import time
+import mock
+from functools import partial
 
 from pminifier.test.integration import PMinifierIntegrationTest
 from pminifier.minifier import CachedMinifier, Minifier
 from pminifier.redis_cache_backend import RedisCacheBackend, cached
+from pminifier.cache import call_key
+from pminifier.stampede import lock_key
+from pminifier.local_cache import LocalCache
+from pminifier.shm_cache import SharedMemoryCache
 
 class CachedMinifierIntegrationTests(PMinifierIntegrationTest):
     def setUp(self):
@@ -14,6 +23,43 @@ class CachedMinifierIntegrationTests(PMinifierIntegrationTest):
         self.m = CachedMinifier(self.cluster.mongo.conn, 'pminifier',
                                 cache_client, cached)
         
+    def test_cache_decorator(self):
+        url = "http://www.youtube.com/"
+        o_id = self.m.get_id(url, 'test')
+        # the decorator and the batch lookups share the entry
+        self.assertEqual(o_id, self.m.cache_client.get(self.m._id_key(url, 'test')))
+        self.assertEqual({url: o_id}, self.m.get_multiple_ids([url], 'test'))
+
+        missing = "http://www.youtube.com/missing"
+        self.assertEqual(None, self.m.get_id(missing, 'test', dont_create=True))
+        key = call_key(CachedMinifier.__dict__['get_id'], (self.m, missing, 'test', True), {})
+        self.assertEqual(None, self.m.cache_client.get(key))
+
+    def test_cache_decorator_lock(self):
+        m = CachedMinifier(self.cluster.mongo.conn, 'pminifier', self.m.cache_client,
+                           partial(cached, lock_timeout=0.2))
+        url = "http://www.youtube.com/"
+        # another process is looking the URL up
+        lock = lock_key(m._id_key(url, 'test'))
+        self.m.cache_client.add(lock, 'other', 5)
+        start = time.time()
+        with mock.patch.object(m, '_get_id_multi', wraps=m._get_id_multi) as lookup:
+            o_id = m.get_id(url, 'test')
+            self.assertEqual(1, lookup.call_count)
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertEqual(o_id, self.m.get_id(url, 'test'))
+        self.assertEqual('other', self.m.cache_client.get(lock))
+
+    def test_cache_keys(self):
+        url = "http://www.youtube.com/"
+        self.assertEqual(call_key(CachedMinifier.__dict__['get_id'], (self.m, url, 'test'), {}),
+                         self.m._id_key(url, 'test'))
+        self.assertEqual(call_key(Minifier.__dict__['get_string'], (self.m, 'Fq'), {}),
+                         self.m._string_key('Fq'))
+        # minifiers on other databases don't share entries
+        other = CachedMinifier(self.cluster.mongo.conn, 'other', self.m.cache_client)
+        self.assertNotEqual(self.m._id_key(url, 'test'), other._id_key(url, 'test'))
+
     def test_int_to_base62(self):
         self.assertEqual('LfqqC7n0s', self.m.int_to_base62(9999999999999999))
         self.assertEqual('0U', self.m.int_to_base62(3294))
@@ -63,6 +109,126 @@ class CachedMinifierIntegrationTests(PMinifierIntegrationTest):
         self.assertEqual(set(urls_to_ids.values()), set(ids_to_urls.keys()))
         self.assertEqual(set(urls_to_ids.keys()), set(ids_to_urls.values()))
 
+    def test_get_multiple_ids_caches_items(self):
+        urls = ["http://google.com", "http://www.google.com"]
+        urls_to_ids = self.m.get_multiple_ids(urls, 'test')
+        with mock.patch.object(self.m, '_get_id_multi', wraps=self.m._get_id_multi) as lookup:
+            # reordered batch with one new url only looks up the new url
+            res = self.m.get_multiple_ids(["http://yahoo.com"] + urls[::-1], 'test')
+            self.assertEqual(1, lookup.call_count)
+            self.assertEqual(["http://yahoo.com"], list(lookup.call_args[0][0]))
+            # single lookups share the batch entries
+            self.assertEqual(urls_to_ids["http://google.com"],
+                             self.m.get_id("http://google.com", 'test'))
+            self.assertEqual(1, lookup.call_count)
+        self.assertEqual(urls_to_ids["http://google.com"], res["http://google.com"])
+
+    def test_get_multiple_strings_caches_items(self):
+        ids = self.m.get_multiple_ids(["http://google.com", "http://www.google.com"], 'test')
+        self.m.cache_client.clear()
+        self.m.get_multiple_strings([ids["http://google.com"]])
+        with mock.patch.object(self.m.db, 'urlById', wraps=self.m.db.urlById) as collection:
+            res = self.m.get_multiple_strings(ids.values())
+            self.assertEqual(1, collection.find.call_count)
+            self.assertEqual("http://google.com", self.m.get_string(ids["http://google.com"]))
+            self.assertEqual(1, collection.find.call_count)
+        self.assertEqual(set(ids.keys()), set(res.values()))
+
+    def test_caches_both_directions(self):
+        urls = ["http://google.com", "http://www.google.com"]
+        ids = self.m.get_multiple_ids(urls, 'test')
+        with mock.patch.object(self.m.db, 'urlById', wraps=self.m.db.urlById) as collection:
+            self.assertEqual(dict((v, k) for k, v in ids.items()),
+                             self.m.get_multiple_strings(ids.values()))
+            self.assertEqual(0, collection.find.call_count)
+
+        self.m.cache_client.clear()
+        self.m.get_multiple_strings(ids.values())
+        with mock.patch.object(self.m, '_get_id_multi') as lookup:
+            self.assertEqual(ids, self.m.get_multiple_ids(urls, 'test'))
+            self.assertEqual(0, lookup.call_count)
+            # the reverse entry is only for the url's own groupkey
+            self.m.get_multiple_ids(urls, 'other')
+            self.assertEqual(1, lookup.call_count)
+
+    def test_shared_cache(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.unlink, path)
+        shared_cache = SharedMemoryCache(path, slots=1024)
+        m = CachedMinifier(self.cluster.mongo.conn, 'pminifier', self.m.cache_client,
+                           shared_cache=shared_cache)
+        urls = ["http://google.com", "http://www.google.com"]
+        ids = m.get_multiple_ids(urls, 'test')
+        m.get_id("http://www.youtube.com/", 'test', dont_create=True)
+
+        # another worker process on the host
+        other = CachedMinifier(self.cluster.mongo.conn, 'pminifier', self.m.cache_client,
+                               shared_cache=SharedMemoryCache(path, slots=1024),
+                               negative_ttl=60)
+        self.m.cache_client.clear()
+        with mock.patch.object(other, '_get_id_multi') as lookup:
+            self.assertEqual(ids, other.get_multiple_ids(urls, 'test'))
+            self.assertEqual(urls[0], other.get_string(ids[urls[0]]))
+            self.assertEqual(0, lookup.call_count)
+        # misses aren't shared, they can't expire there
+        self.assertEqual(None, other.get_id("http://www.youtube.com/", 'test', dont_create=True))
+        other.get_id("http://www.youtube.com/", 'test')
+        self.assertNotEqual(None, m.get_id("http://www.youtube.com/", 'test', dont_create=True))
+
+    def test_cache_tiers(self):
+        tier = LocalCache(1000)
+        m = CachedMinifier(self.cluster.mongo.conn, 'pminifier', self.m.cache_client,
+                           cache_tiers=[tier])
+        ids = m.get_multiple_ids(["http://google.com", "http://www.google.com"], 'test')
+        # both directions of both urls
+        self.assertEqual(4, len(tier))
+        self.m.cache_client.clear()
+        tier.clear()
+        self.m.get_multiple_ids(ids.keys(), 'test')
+        m.local_cache.clear()
+        with mock.patch.object(m, '_get_id_multi') as lookup:
+            self.assertEqual(ids, m.get_multiple_ids(ids.keys(), 'test'))
+            self.assertEqual(0, lookup.call_count)
+        self.assertEqual(2, len(tier)) # backfilled from cache_client
+
+    def test_coalesce(self):
+        m = CachedMinifier(self.cluster.mongo.conn, 'pminifier',
+                           self.m.cache_client, coalesce=True)
+        lookup = m._get_id_multi
+        def slow_lookup(*args, **kwargs):
+            time.sleep(0.1)
+            return lookup(*args, **kwargs)
+        results = []
+        with mock.patch.object(m, '_get_id_multi', side_effect=slow_lookup) as spy:
+            threads = [threading.Thread(target=lambda: results.append(
+                           m.get_id("http://www.youtube.com/", 'test')))
+                       for i in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(1, spy.call_count)
+        self.assertEqual(5, len(results))
+        self.assertEqual(1, len(set(results)))
+
+    def test_negative_cache(self):
+        m = CachedMinifier(self.cluster.mongo.conn, 'pminifier',
+                           self.m.cache_client, negative_ttl=60)
+        url = "http://www.youtube.com/"
+        with mock.patch.object(m, '_get_id_multi', wraps=m._get_id_multi) as lookup:
+            self.assertEqual(None, m.get_id(url, 'test', dont_create=True))
+            self.assertEqual({}, m.get_multiple_ids([url], 'test', dont_create=True))
+            self.assertEqual(1, lookup.call_count)
+            o_id = m.get_id(url, 'test')
+            self.assertEqual(2, lookup.call_count)
+        self.assertEqual(o_id, m.get_id(url, 'test', dont_create=True))
+
+        with mock.patch.object(m.db, 'urlById', wraps=m.db.urlById) as collection:
+            self.assertRaises(Minifier.DoesNotExist, m.get_string, 9001)
+            self.assertRaises(Minifier.DoesNotExist, m.get_string, 9001)
+            self.assertEqual({9001: None}, m.get_multiple_strings([9001]))
+            self.assertEqual(1, collection.find.call_count)
+
     def test_empty_get_multiple(self):
         try:
             self.assertEqual(self.m.get_multiple_ids([], 'test'), None)
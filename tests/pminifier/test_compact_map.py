@@ -0,0 +1,51 @@
+import random
+import unittest
+
+from pminifier.compact_map import EMPTY, CompactIdMap
+from pminifier.digest import url_digest
+
+class CompactIdMapTests(unittest.TestCase):
+    def test_get_and_put(self):
+        id_map = CompactIdMap()
+        self.assertEqual(None, id_map.get(12345))
+        id_map.put(12345, 7)
+        id_map.put(-12345, 8)
+        self.assertEqual(7, id_map.get(12345))
+        self.assertEqual(8, id_map.get(-12345))
+        id_map.put(12345, 9)
+        self.assertEqual(9, id_map.get(12345))
+        self.assertEqual(2, len(id_map))
+
+    def test_empty_marker_digest(self):
+        id_map = CompactIdMap()
+        id_map.put(EMPTY, 3)
+        self.assertEqual(3, id_map.get(EMPTY))
+        self.assertEqual(1, len(id_map))
+
+    def test_grows(self):
+        rng = random.Random(0)
+        digests = [rng.randint(-2 ** 63, 2 ** 63 - 1) for i in range(5000)]
+        id_map = CompactIdMap(capacity=8)
+        for i, digest in enumerate(digests):
+            id_map.put(digest, i)
+        self.assertEqual(5000, len(id_map))
+        self.assertTrue(id_map.nbytes <= 16 * 8192)
+        for i, digest in enumerate(digests):
+            self.assertEqual(i, id_map.get(digest))
+
+    def test_colliding_slots(self):
+        id_map = CompactIdMap(capacity=8)
+        for i in range(5): # all land on the same slot
+            id_map.put(i * 1024, i)
+        for i in range(5):
+            self.assertEqual(i, id_map.get(i * 1024))
+        self.assertEqual(None, id_map.get(5 * 1024))
+
+    def test_urls(self):
+        id_map = CompactIdMap()
+        id_map.put_many('test', {'http://google.com': 1, u'http://g\xf6\xf6gle.com': 2})
+        self.assertEqual({'http://google.com': 1, u'http://g\xf6\xf6gle.com': 2},
+                         id_map.get_many('test', ['http://google.com', u'http://g\xf6\xf6gle.com',
+                                                  'http://bing.com']))
+        self.assertEqual({}, id_map.get_many('other', ['http://google.com']))
+        self.assertEqual(1, id_map.get(url_digest('test', u'http://google.com')))
@@ -0,0 +1,33 @@
+import unittest
+
+from pminifier.hash_ring import HashRing
+
+class HashRingTests(unittest.TestCase):
+    def setUp(self):
+        self.keys = ['mini:groupkey:str:%i' % i for i in range(10000)]
+
+    def test_spread(self):
+        ring = HashRing({'a': 1, 'b': 2, 'c': 3})
+        counts = dict((name, len(keys)) for name, keys in ring.split(self.keys).iteritems())
+        self.assertEqual(['a', 'b', 'c'], sorted(counts))
+        for count in counts.values():
+            self.assertTrue(2500 < count < 4200, counts)
+        self.assertEqual(ring.nodes[ring.get_name('key')], ring.get_node('key'))
+
+    def test_adding_a_node_moves_few_keys(self):
+        before = HashRing(dict.fromkeys('abcd'))
+        after = HashRing(dict.fromkeys('abcde'))
+        moved = [key for key in self.keys if before.get_name(key) != after.get_name(key)]
+        # only keys of the new node move, about a fifth of them
+        self.assertEqual(set('e'), set(after.get_name(key) for key in moved))
+        self.assertTrue(len(moved) < len(self.keys) * 0.3)
+
+    def test_removing_a_node_only_moves_its_keys(self):
+        before = HashRing(dict.fromkeys('abcd'))
+        after = HashRing(dict.fromkeys('abc'))
+        for key in self.keys:
+            if before.get_name(key) != 'd':
+                self.assertEqual(before.get_name(key), after.get_name(key))
+
+    def test_needs_nodes(self):
+        self.assertRaises(ValueError, HashRing, {})
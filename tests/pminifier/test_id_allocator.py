@@ -0,0 +1,190 @@
+import threading
+import time
+import unittest
+
+import mock
+
+from pminifier.test.integration import PMinifierIntegrationTest
+from pminifier.id_allocator import (IdOverlapError, MongoCounterAllocator,
+                                    NodeSequenceAllocator, RedisRangeAllocator)
+from pminifier.minifier import Minifier
+
+class MongoCounterAllocatorTests(PMinifierIntegrationTest):
+    def setUp(self):
+        self.db = self.cluster.mongo.conn['pminifier']
+        self.counter_id = self.id()
+
+    def _allocator(self, **kwargs):
+        return MongoCounterAllocator(self.db, counter_id=self.counter_id, **kwargs)
+
+    def _counter(self, counter_id=None):
+        counter = self.db.urlByIdMeta.find_one({'_id': counter_id or self.counter_id})
+        return counter['value'] if counter else 0
+
+    def test_single_ids(self):
+        allocator = self._allocator()
+        self.assertEqual([1], allocator.allocate())
+        self.assertEqual([2, 3], allocator.allocate(2))
+        self.assertEqual(3, self._counter())
+
+    def test_block_reservation(self):
+        allocator = self._allocator(block_size=100)
+        self.assertEqual(range(1, 11), allocator.allocate(10))
+        self.assertEqual(100, self._counter())
+        self.assertEqual(range(11, 21), allocator.allocate(10))
+        self.assertEqual(100, self._counter())
+
+    def test_large_request_spans_blocks(self):
+        allocator = self._allocator(block_size=10)
+        allocator.allocate(5)
+        ids = allocator.allocate(50)
+        self.assertEqual(range(6, 56), ids)
+
+    def test_allocators_dont_overlap(self):
+        first = self._allocator(block_size=10)
+        second = self._allocator(block_size=10)
+        ids = first.allocate(15) + second.allocate(15) + first.allocate(15)
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_lease_expiry(self):
+        allocator = self._allocator(block_size=10, lease=0.01)
+        self.assertEqual([1], allocator.allocate())
+        time.sleep(0.02)
+        self.assertEqual([11], allocator.allocate())
+
+    def test_release(self):
+        allocator = self._allocator(block_size=10)
+        self.assertEqual([1, 2], allocator.allocate(2))
+        allocator.release([2])
+        self.assertEqual([2, 3], allocator.allocate(2))
+        # only the last IDs handed out can come back
+        allocator.release([1])
+        self.assertEqual([4], allocator.allocate())
+        allocator.release(allocator.allocate(8)) # spans two blocks
+        self.assertEqual([13], allocator.allocate())
+
+    def test_threaded_allocation(self):
+        allocator = self._allocator(block_size=7)
+        results = []
+        def worker():
+            for i in range(20):
+                results.extend(allocator.allocate(3))
+        threads = [threading.Thread(target=worker) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(300, len(results))
+        self.assertEqual(300, len(set(results)))
+
+    def test_minifier_block_size(self):
+        start = self._counter('minifier_counter')
+        m = Minifier(self.cluster.mongo.conn, 'pminifier', id_block_size=50)
+        urls = ['http://example.com/%i' % i for i in range(10)]
+        ids = m.get_multiple_ids(urls, 'block_size')
+        self.assertEqual(10, len(set(ids.values())))
+        self.assertEqual(start + 50, self._counter('minifier_counter'))
+
+    def test_check(self):
+        allocator = self._allocator(block_size=10)
+        allocator.check(None)
+        allocator.allocate(5)
+        allocator.check(5)
+        self.assertRaises(IdOverlapError, allocator.check, 6)
+        allocator.seed(100)
+        allocator.seed(50)
+        self.assertEqual(100, self._counter())
+        allocator.allocate(5)
+        allocator.check(100)
+        self.assertEqual([101], allocator.allocate())
+
+    def test_seed_new_counter(self):
+        allocator = self._allocator()
+        allocator.seed(20)
+        self.assertEqual([21], allocator.allocate())
+
+    def test_minifier_checks_ids(self):
+        m = Minifier(self.cluster.mongo.conn, 'pminifier')
+        m.get_multiple_ids(['http://example.com/%i' % i for i in range(10)], 'check')
+        behind = self._allocator()
+        self.assertRaises(IdOverlapError, Minifier, self.cluster.mongo.conn, 'pminifier',
+                          id_allocator=behind, check_ids=True)
+        # only on request, it costs a query
+        with mock.patch.object(Minifier, '_max_id') as max_id:
+            Minifier(self.cluster.mongo.conn, 'pminifier', id_allocator=behind)
+            self.assertFalse(max_id.called)
+        behind.seed(m._max_id())
+        Minifier(self.cluster.mongo.conn, 'pminifier', id_allocator=behind, check_ids=True)
+
+class RedisRangeAllocatorTests(PMinifierIntegrationTest):
+    def setUp(self):
+        self.redis = self.cluster.redis.conn
+
+    def test_blocks(self):
+        first = RedisRangeAllocator(self.redis, block_size=10)
+        second = RedisRangeAllocator(self.redis, block_size=10)
+        self.assertEqual(range(1, 6), first.allocate(5))
+        self.assertEqual(range(11, 16), second.allocate(5))
+        self.assertEqual(range(6, 11) + range(21, 26), first.allocate(10))
+        self.assertEqual(30, first.current())
+
+    def test_seed_and_check(self):
+        allocator = RedisRangeAllocator(self.redis, block_size=10)
+        self.assertRaises(IdOverlapError, allocator.check, 1000)
+        allocator.seed(1000)
+        allocator.seed(10)
+        allocator.check(1000)
+        self.assertEqual([1001], allocator.allocate())
+
+    def test_minifier(self):
+        Minifier(self.cluster.mongo.conn, 'pminifier').get_id('http://example.com/', 'redis')
+        allocator = RedisRangeAllocator(self.redis, block_size=10)
+        self.assertRaises(IdOverlapError, Minifier, self.cluster.mongo.conn, 'pminifier',
+                          id_allocator=allocator, check_ids=True)
+        m = Minifier(self.cluster.mongo.conn, 'pminifier', id_allocator=allocator)
+        max_id = m._max_id()
+        allocator.seed(max_id)
+        Minifier(self.cluster.mongo.conn, 'pminifier', id_allocator=allocator, check_ids=True)
+        ids = m.get_multiple_ids(['http://example.com/%i' % i for i in range(5)], 'redis')
+        self.assertEqual(range(max_id + 1, max_id + 6), sorted(m.base62_to_ints(ids.values())))
+        self.assertEqual(max_id + 10, allocator.current())
+
+class NodeSequenceAllocatorTests(unittest.TestCase):
+    def _allocator(self, node_id=1, now=1000, **kwargs):
+        allocator = NodeSequenceAllocator(node_id, **kwargs)
+        allocator._now = mock.Mock(return_value=now)
+        return allocator
+
+    def test_layout(self):
+        allocator = self._allocator(node_id=3)
+        self.assertEqual([(1000 << 22) | (3 << 12), (1000 << 22) | (3 << 12) | 1],
+                         allocator.allocate(2))
+        allocator._now.return_value = 1001
+        self.assertEqual([(1001 << 22) | (3 << 12)], allocator.allocate())
+
+    def test_nodes_dont_overlap(self):
+        ids = self._allocator(node_id=1).allocate(100) + self._allocator(node_id=2).allocate(100)
+        self.assertEqual(200, len(set(ids)))
+
+    def test_sequence_overflow_and_clock_going_back(self):
+        allocator = self._allocator(sequence_bits=2)
+        ids = allocator.allocate(6)
+        allocator._now.return_value = 900
+        ids += allocator.allocate(3)
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual([1000, 1000, 1000, 1000, 1001, 1001, 1001, 1001, 1002],
+                         [id >> 12 for id in ids])
+
+    def test_check(self):
+        allocator = self._allocator()
+        allocator.check(None)
+        allocator.check(12345)
+        # IDs of a node whose clock is a bit ahead are skipped past
+        ahead = (1500 << 22) | (900 << 12) | 7
+        allocator.check(ahead)
+        self.assertTrue(allocator.allocate()[0] > ahead)
+        self.assertRaises(IdOverlapError, allocator.check, (200000 << 22))
+
+    def test_node_id_range(self):
+        self.assertRaises(ValueError, NodeSequenceAllocator, 1024)
+        self.assertEqual(1023, NodeSequenceAllocator(1023).node_id)
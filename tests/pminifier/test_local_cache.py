@@ -0,0 +1,157 @@
+import threading
+import unittest
+
+import mock
+
+from pminifier.local_cache import FrequencySketch, LocalCache, local_cached
+
+class LocalCacheTests(unittest.TestCase):
+    def test_get_and_set(self):
+        cache = LocalCache()
+        self.assertEqual(None, cache.get('a'))
+        cache.set('a', 1)
+        cache.set_many({'b': 2, 'c': 3})
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual({'a': 1, 'b': 2}, cache.get_many(['a', 'b', 'd']))
+        cache.delete_many(['a', 'b'])
+        self.assertEqual({'c': 3}, cache.get_many(['a', 'b', 'c']))
+        cache.clear()
+        self.assertEqual(0, len(cache))
+
+    def test_evicts_least_recently_used(self):
+        cache = LocalCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual({'a': 1, 'c': 3}, cache.get_many(['a', 'b', 'c']))
+        self.assertEqual(1, cache.stats()['evictions'])
+
+    def test_byte_limit(self):
+        cache = LocalCache(max_entries=None, max_bytes=100, sizeof=lambda k, v: len(v))
+        cache.set('a', 'x' * 60)
+        cache.set('b', 'x' * 30)
+        self.assertEqual(90, cache.stats()['bytes'])
+        cache.set('c', 'x' * 30)
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual(60, cache.stats()['bytes'])
+        cache.set('d', 'x' * 101) # never fits
+        self.assertEqual(None, cache.get('d'))
+        self.assertEqual(2, len(cache))
+
+    def test_default_sizeof_counts_contents(self):
+        cache = LocalCache(max_bytes=10 ** 6)
+        cache.set(('get_id', ('http://google.com',)), 'abc')
+        small = cache.stats()['bytes']
+        cache.clear()
+        cache.set(('get_id', ('http://google.com/' + 'x' * 1000,)), 'abc')
+        self.assertTrue(cache.stats()['bytes'] > small + 1000)
+
+    def test_ttl(self):
+        cache = LocalCache(timeout=10)
+        with mock.patch('time.time', return_value=1000.0):
+            cache.set('a', 1)
+            cache.set('b', 2, timeout=100)
+        with mock.patch('time.time', return_value=1050.0):
+            self.assertEqual(None, cache.get('a'))
+            self.assertEqual(2, cache.get('b'))
+        stats = cache.stats()
+        self.assertEqual(1, stats['expirations'])
+        self.assertEqual(1, stats['entries'])
+
+    def test_stats(self):
+        cache = LocalCache()
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get_many(['a', 'b'])
+        stats = cache.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_concurrent_access(self):
+        cache = LocalCache(max_entries=50, max_bytes=5000, sizeof=lambda k, v: 100)
+        def worker(n):
+            for i in xrange(2000):
+                cache.set((n, i % 80), i)
+                cache.get((n, (i * 7) % 80))
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = cache.stats()
+        self.assertEqual(50, stats['entries'])
+        self.assertEqual(5000, stats['bytes'])
+        self.assertEqual(8 * 2000, stats['hits'] + stats['misses'])
+
+    def test_local_cached(self):
+        cache = LocalCache()
+        calls = []
+        def get_string(id):
+            calls.append(id)
+            return None if id == 'missing' else id.upper()
+        def get_id(id):
+            return 'other'
+        get_string = local_cached(cache, get_string)
+        self.assertEqual('ABC', get_string('abc'))
+        self.assertEqual('ABC', get_string('abc'))
+        self.assertEqual('other', local_cached(cache, get_id)('abc'))
+        get_string('missing')
+        get_string('missing')
+        self.assertEqual(['abc', 'missing', 'missing'], calls)
+
+class TinyLFUTests(unittest.TestCase):
+    def test_scan_resistance(self):
+        hot = ['hot%i' % i for i in range(50)]
+        def replay(policy):
+            cache = LocalCache(100, policy=policy)
+            for i in range(5):
+                for key in hot:
+                    if cache.get(key) is None:
+                        cache.set(key, key)
+            for i in range(1000): # a scan of keys asked for once
+                key = 'scan%i' % i
+                if cache.get(key) is None:
+                    cache.set(key, key)
+            return len(cache.get_many(hot))
+        self.assertEqual(0, replay('lru'))
+        self.assertTrue(replay('tinylfu') >= 45)
+
+    def test_limits(self):
+        cache = LocalCache(100, policy='tinylfu')
+        for i in range(1000):
+            cache.set(i, i)
+            cache.get(i % 10)
+        self.assertEqual(100, len(cache))
+        self.assertEqual(900, cache.stats()['evictions'])
+        self.assertEqual(10, len(cache.get_many(range(10))))
+
+        cache = LocalCache(None, max_bytes=1000, sizeof=lambda k, v: 100, policy='tinylfu')
+        for i in range(50):
+            cache.set(i, i)
+        self.assertEqual(10, len(cache))
+
+    def test_delete_and_clear(self):
+        cache = LocalCache(10, policy='tinylfu')
+        for i in range(20):
+            cache.set(i, i)
+            cache.get(i)
+        cache.delete_many(range(20))
+        self.assertEqual(0, len(cache))
+        for i in range(20):
+            cache.set(i, i)
+        cache.clear()
+        cache.set('a', 1)
+        self.assertEqual(1, cache.get('a'))
+
+    def test_sketch_ages(self):
+        sketch = FrequencySketch(16)
+        for i in range(15):
+            sketch.increment('a')
+        self.assertEqual(15, sketch.frequency('a'))
+        for i in range(sketch.sample_size):
+            sketch.increment(i)
+        self.assertTrue(sketch.frequency('a') < 15)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, LocalCache, 10, policy='fifo')
@@ -2,7 +2,11 @@ import unittest
 import sys
 import os
 
+import mock
+
 from pminifier.test.integration import PMinifierIntegrationTest
+from pminifier.bloom import KnownUrls
+from pminifier.compact_map import CompactIdMap
 from pminifier.minifier import Minifier
 
 class MinifierIntegrationTests(PMinifierIntegrationTest):
@@ -61,6 +65,164 @@ class MinifierIntegrationTests(PMinifierIntegrationTest):
         self.assertEqual(set(urls_to_ids.values()), set(ids_to_urls.keys()))
         self.assertEqual(set(urls_to_ids.keys()), set(ids_to_urls.values()))
 
+    def test_create_resolves_concurrent_duplicates(self):
+        # a unique_urls process built the unique index
+        Minifier(self.cluster.mongo.conn, 'pminifier', unique_urls=True)
+        winner = self.m.get_multiple_ids(["http://google.com"], 'test')
+        # another writer got there first, only the new url gets our ID
+        created = self.m._create_ids(["http://google.com", "http://yahoo.com"], 'test')
+        self.assertEqual(self.m.base62_to_int(winner["http://google.com"]),
+                         created["http://google.com"])
+        self.assertEqual("http://yahoo.com", self.m.get_string(created["http://yahoo.com"]))
+
+    def test_groupkeys_are_separate(self):
+        first = self.m.get_id("http://www.youtube.com/", 'test')
+        second = self.m.get_id("http://www.youtube.com/", 'other')
+        self.assertNotEqual(first, second)
+        self.assertEqual({"http://www.youtube.com/": second},
+                         self.m.get_multiple_ids(["http://www.youtube.com/"], 'other'))
+
+    def test_url_index(self):
+        self.assertIn(Minifier.url_index, self.m._index_keys())
+
+    def test_migrate_indexes(self):
+        self.m.db.urlById.drop_indexes()
+        self.m.db.urlById.ensure_index(Minifier.legacy_url_index)
+        o_id = self.m.get_id("http://www.youtube.com/", 'test')
+
+        m = Minifier(self.cluster.mongo.conn, 'pminifier')
+        self.assertNotIn(Minifier.url_index, m._index_keys())
+        m.migrate_indexes()
+        self.assertIn(Minifier.url_index, m._index_keys())
+        self.assertNotIn(Minifier.legacy_url_index, m._index_keys())
+        self.assertEqual(o_id, m.get_id("http://www.youtube.com/", 'test'))
+
+    def test_url_hash(self):
+        m = Minifier(self.cluster.mongo.conn, 'pminifier', url_hash=True)
+        self.assertIn(Minifier.hash_index, m._index_keys())
+        urls = [u"http://www.youtube.com/", u"http://www.google.com/"]
+        ids = m.get_multiple_ids(urls, 'test')
+        self.assertEqual(ids, m.get_multiple_ids(urls, 'test'))
+        self.assertNotEqual(ids, m.get_multiple_ids(urls, 'other'))
+        for url, o_id in ids.iteritems():
+            self.assertEqual(url, m.get_string(o_id))
+
+    def test_url_hash_collision(self):
+        m = Minifier(self.cluster.mongo.conn, 'pminifier', url_hash=True)
+        o_id = m.get_id("http://www.youtube.com/", 'test')
+        # pretend another url shares the digest
+        entry = m.db.urlById.find_one({'_id': m.base62_to_int(o_id)})
+        m.db.urlById.insert({'_id': -1, 'url': 'http://other.com/',
+                             'groupkey': 'test', 'h': entry['h']})
+        self.assertEqual(o_id, m.get_id("http://www.youtube.com/", 'test'))
+
+    def test_backfill_url_hashes(self):
+        o_id = self.m.get_id("http://www.youtube.com/", 'test')
+        m = Minifier(self.cluster.mongo.conn, 'pminifier', url_hash=True)
+        self.assertEqual(None, m.get_id("http://www.youtube.com/", 'test', dont_create=True))
+        self.assertTrue(m.backfill_url_hashes(batch_size=1) >= 1)
+        self.assertEqual(o_id, m.get_id("http://www.youtube.com/", 'test', dont_create=True))
+
+    def test_unique_urls(self):
+        m = Minifier(self.cluster.mongo.conn, 'pminifier', unique_urls=True)
+        self.assertIn(Minifier.unique_url_index, m._index_keys(unique=True))
+        o_id = m.get_id("http://www.youtube.com/", 'test')
+        # a concurrent writer that missed the url too ends up with our ID
+        created = m._create_ids(["http://www.youtube.com/", "http://google.com/"], 'test')
+        self.assertEqual(m.base62_to_int(o_id), created["http://www.youtube.com/"])
+        self.assertEqual("http://google.com/", m.get_string(created["http://google.com/"]))
+
+    def test_get_or_create_id(self):
+        m = Minifier(self.cluster.mongo.conn, 'pminifier', unique_urls=True)
+        o_id = m.get_or_create_id("http://www.youtube.com/", 'test')
+        self.assertEqual(o_id, m.get_or_create_id("http://www.youtube.com/", 'test'))
+        self.assertEqual(o_id, m.get_id("http://www.youtube.com/", 'test'))
+        self.assertNotEqual(o_id, m.get_or_create_id("http://www.youtube.com/", 'other'))
+        self.assertRaises(ValueError, self.m.get_or_create_id, "http://www.youtube.com/", 'test')
+
+    def test_get_or_create_id_existing_url(self):
+        m = Minifier(self.cluster.mongo.conn, 'pminifier', unique_urls=True)
+        o_id = m.get_or_create_id("http://www.youtube.com/", 'test')
+        counter = m.db.urlByIdMeta.find_one({'_id': 'minifier_counter'})['value']
+        with mock.patch.object(m.db.urlById, 'find_and_modify',
+                               wraps=m.db.urlById.find_and_modify) as upsert:
+            for i in range(5):
+                self.assertEqual(o_id, m.get_or_create_id("http://www.youtube.com/", 'test'))
+            self.assertEqual(5, upsert.call_count)
+        self.assertEqual(counter, m.db.urlByIdMeta.find_one({'_id': 'minifier_counter'})['value'])
+        # the IDs offered for the existing url were handed back
+        self.assertEqual(m.base62_to_int(o_id) + 1,
+                         m.base62_to_int(m.get_or_create_id("http://google.com/", 'test')))
+
+    def test_unique_index_replaces_url_index(self):
+        self.m.db.urlById.drop_indexes()
+        m = Minifier(self.cluster.mongo.conn, 'pminifier', unique_urls=True)
+        self.assertNotIn(Minifier.url_index, m._index_keys())
+        o_id = m.get_id("http://www.youtube.com/", 'test')
+
+        self.m.migrate_indexes()
+        self.assertIn(Minifier.url_index, m._index_keys())
+        m.migrate_indexes()
+        self.assertNotIn(Minifier.url_index, m._index_keys())
+        self.assertIn(Minifier.unique_url_index, m._index_keys(unique=True))
+        self.assertEqual(o_id, m.get_id("http://www.youtube.com/", 'test', dont_create=True))
+
+    def test_unique_urls_with_url_hash(self):
+        self.assertRaises(ValueError, Minifier, self.cluster.mongo.conn, 'pminifier',
+                          url_hash=True, unique_urls=True)
+
+    def test_id_map(self):
+        id_map = CompactIdMap()
+        m = Minifier(self.cluster.mongo.conn, 'pminifier', id_map=id_map)
+        urls = ["http://www.youtube.com/", "http://www.google.com/"]
+        ids = m.get_multiple_ids(urls, 'test')
+        self.assertEqual(2, len(id_map))
+        m.db.urlById.remove({'_id': {'$in': m.base62_to_ints(ids.values())}})
+        self.assertEqual(ids, m.get_multiple_ids(urls, 'test')) # served by the map
+        self.assertEqual(None, m.get_id(urls[0], 'other', dont_create=True))
+
+    def test_id_map_load(self):
+        ids = self.m.get_multiple_ids(["http://www.youtube.com/", u"http://www.g\xf6\xf6gle.com/"],
+                                      'test')
+        hashed = Minifier(self.cluster.mongo.conn, 'pminifier', url_hash=True)
+        h_id = hashed.get_id("http://www.bing.com/", 'test')
+        id_map = CompactIdMap(capacity=8)
+        self.assertEqual(3, id_map.load(self.m.db.urlById, groupkey='test', batch_size=2))
+        m = Minifier(self.cluster.mongo.conn, 'pminifier', id_map=id_map)
+        with mock.patch.object(m, '_find_ids') as find_ids:
+            self.assertEqual(ids, m.get_multiple_ids(ids.keys(), 'test'))
+            self.assertEqual(h_id, m.get_id("http://www.bing.com/", 'test'))
+            self.assertEqual(0, find_ids.call_count)
+
+    def test_verify_id_map(self):
+        id_map = CompactIdMap()
+        m = Minifier(self.cluster.mongo.conn, 'pminifier', id_map=id_map, verify_id_map=True)
+        o_id = m.get_id("http://www.youtube.com/", 'test')
+        self.assertEqual(o_id, m.get_id("http://www.youtube.com/", 'test'))
+        # a digest collision hands out the wrong ID, verification catches it
+        other = self.m.get_id("http://other.com/", 'test')
+        id_map.put_many('test', {"http://www.youtube.com/": self.m.base62_to_int(other)})
+        self.assertEqual(o_id, m.get_id("http://www.youtube.com/", 'test'))
+
+    def test_known_urls(self):
+        o_id = self.m.get_id("http://www.youtube.com/", 'test')
+        known = KnownUrls(1000)
+        known.build(self.m.db.urlById, 'test')
+        m = Minifier(self.cluster.mongo.conn, 'pminifier', known_urls=known)
+        with mock.patch.object(m, '_find_ids', wraps=m._find_ids) as find_ids:
+            self.assertEqual({}, m.get_multiple_ids(["http://nope.com/"], 'test',
+                                                    dont_create=True))
+            self.assertEqual(0, find_ids.call_count)
+            self.assertEqual(o_id, m.get_id("http://www.youtube.com/", 'test', dont_create=True))
+        created = m.get_id("http://nope.com/", 'test')
+        self.assertEqual(created, m.get_id("http://nope.com/", 'test', dont_create=True))
+
+        # the filter has a URL before its entry is written
+        with mock.patch.object(m.db.urlById, 'initialize_unordered_bulk_op',
+                               side_effect=ValueError):
+            self.assertRaises(ValueError, m.get_id, "http://late.com/", 'test')
+        self.assertEqual(["http://late.com/"], known.may_exist('test', ["http://late.com/"]))
+
     def test_empty_get_multiple(self):
         try:
             self.assertEqual(self.m.get_multiple_ids([], 'test'), None)
@@ -0,0 +1,154 @@
+from pminifier.test.integration import PMinifierIntegrationTest
+import os
+import signal
+import time
+
+import mock
+import redis
+
+from pminifier.negative_cache import NOT_FOUND
+from pminifier.redis_cache_backend import RedisCacheBackend
+from pminifier.stampede import cached_call, lock_key
+
+class RedisCacheBackendTests(PMinifierIntegrationTest):
+    def setUp(self):
+        self.cache = RedisCacheBackend({'host': '127.0.0.1',
+                                        'port': self.cluster.redis.port,
+                                        'batch_size': 2})
+        self.cache.client = self.cluster.redis.conn
+
+    def test_set_has_expiry(self):
+        self.cache.set('key', {'a': 1})
+        self.assertEqual({'a': 1}, self.cache.get('key'))
+        self.assertTrue(0 < self.cache.client.ttl('key') <= 3600)
+
+    def test_many(self):
+        values = {'key%i' % i: i for i in range(5)}
+        self.cache.set_many(values)
+        for key in values:
+            self.assertTrue(0 < self.cache.client.ttl(key) <= 3600)
+        self.assertEqual(values, self.cache.get_many(values.keys() + ['missing']))
+        self.assertEqual([0, None, 4], self.cache.get_all(['key0', 'missing', 'key4']))
+
+        self.cache.delete_many(['key0', 'key1', 'key2'])
+        self.assertEqual({'key3': 3, 'key4': 4}, self.cache.get_many(values.keys()))
+
+    def test_add(self):
+        self.assertTrue(self.cache.add('key', 1, 10))
+        self.assertFalse(self.cache.add('key', 2, 10))
+        self.assertEqual(1, self.cache.get('key'))
+        self.assertTrue(0 < self.cache.client.ttl('key') <= 10)
+
+    def test_get_with_ttl(self):
+        self.assertEqual((None, None), self.cache.get_with_ttl('key'))
+        self.cache.set('key', 1)
+        value, ttl = self.cache.get_with_ttl('key')
+        self.assertEqual(1, value)
+        self.assertTrue(3500 < ttl <= 3600)
+
+    def test_renew_early(self):
+        self.cache.renew_early = 10
+        self.cache.set_many({'key': 1, 'negative': NOT_FOUND}, timeout=5)
+        with mock.patch('random.random', return_value=0.5):
+            self.assertEqual({'key': 1, 'negative': NOT_FOUND},
+                             self.cache.get_many(['key', 'negative']))
+        self.assertTrue(self.cache.client.ttl('key') > 5)
+        self.assertTrue(self.cache.client.ttl('negative') <= 5)
+
+    def test_delete_if_equal(self):
+        self.cache.add('mine', 'token', 10)
+        self.cache.add('taken', 'other', 10)
+        self.cache.delete_if_equal(['mine', 'taken', 'missing'], 'token')
+        self.assertEqual({'taken': 'other'}, self.cache.get_many(['mine', 'taken']))
+
+    def test_waiters_dont_renew_locks(self):
+        self.cache.renew_early = 3600
+        self.cache.add(lock_key('key'), 'other', 5)
+        with mock.patch('random.random', return_value=0.5):
+            self.assertEqual('value', cached_call(self.cache, 'key', lambda: 'value',
+                                                  lock_timeout=0.1, poll_interval=0.01))
+        self.assertTrue(0 < self.cache.client.ttl(lock_key('key')) <= 5)
+
+    def test_empty(self):
+        self.assertEqual({}, self.cache.get_many([]))
+        self.cache.set_many({})
+        self.cache.delete_many([])
+
+    def test_codec(self):
+        cache = RedisCacheBackend({'codec': 'raw'})
+        cache.client = self.cluster.redis.conn
+        self.cache.set('legacy', u'http://google.com')
+        cache.set('new', u'http://google.com')
+        self.assertEqual({'legacy': u'http://google.com', 'new': u'http://google.com'},
+                         cache.get_many(['legacy', 'new']))
+        self.assertEqual('\x02http://google.com', cache.client.get('new'))
+
+class ShardedRedisCacheBackendTests(PMinifierIntegrationTest):
+    def setUp(self):
+        # databases of the test server stand for separate servers
+        self.nodes = [redis.Redis('127.0.0.1', self.cluster.redis.port, db)
+                      for db in (1, 2, 3)]
+        self.cache = RedisCacheBackend({'nodes': self.nodes, 'batch_size': 2})
+
+    def test_keys_spread_across_nodes(self):
+        values = {'key%i' % i: i for i in range(100)}
+        self.cache.set_many(values)
+        sizes = [node.dbsize() for node in self.nodes]
+        self.assertEqual(100, sum(sizes))
+        self.assertTrue(all(sizes))
+        for key in values:
+            self.assertEqual(1, self.cache.client_for(key).exists(key))
+        self.assertEqual(values, self.cache.get_many(values.keys() + ['missing']))
+
+        self.cache.delete_many(['key%i' % i for i in range(50)])
+        self.assertEqual(50, len(self.cache.get_many(values.keys())))
+        self.cache.clear()
+        self.assertEqual([0, 0, 0], [node.dbsize() for node in self.nodes])
+
+    def test_single_keys(self):
+        self.cache.set('key', 1)
+        self.assertEqual(1, self.cache.get('key'))
+        self.assertFalse(self.cache.add('key', 2))
+        self.assertEqual(1, self.cache.get_with_ttl('key')[0])
+        self.cache.delete('key')
+        self.assertEqual(None, self.cache.get('key'))
+
+    def test_node_addresses(self):
+        port = self.cluster.redis.port
+        cache = RedisCacheBackend({'nodes': ['127.0.0.1:%i/1' % port, '127.0.0.1:%i/2' % port]})
+        cache.set_many({'key%i' % i: i for i in range(20)})
+        self.assertEqual(20, self.nodes[0].dbsize() + self.nodes[1].dbsize())
+        # same names, same places
+        other = RedisCacheBackend({'nodes': self.nodes[:2]})
+        self.assertEqual({'key%i' % i: i for i in range(20)},
+                         other.get_many(['key%i' % i for i in range(20)]))
+
+    def test_named_nodes(self):
+        values = {'key%i' % i: i for i in range(20)}
+        RedisCacheBackend({'nodes': {'a': self.nodes[0], 'b': self.nodes[1]}}).set_many(values)
+        # b moves to another server
+        for key in self.nodes[1].keys():
+            self.nodes[2].set(key, self.nodes[1].get(key))
+        moved = RedisCacheBackend({'nodes': {'a': self.nodes[0], 'b': self.nodes[2]}})
+        self.assertEqual(values, moved.get_many(values.keys()))
+
+    def test_workers_after_fork(self):
+        values = {'key%i' % i: i for i in range(20)}
+        self.cache.set_many(values)
+        pid = os.fork()
+        if not pid:
+            # the parent's pool threads don't exist here
+            ok = self.cache.get_many(values.keys()) == values
+            os._exit(0 if ok else 1)
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                break
+            time.sleep(0.01)
+        else:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self.fail('the forked process hung')
+        self.assertEqual(0, status)
+        self.assertEqual(values, self.cache.get_many(values.keys()))
@@ -0,0 +1,68 @@
+import redis
+
+from pminifier.test.integration import PMinifierIntegrationTest
+from pminifier.negative_cache import NOT_FOUND
+from pminifier.redis_hash_cache import RedisHashCacheBackend, bucket_count
+from pminifier.stampede import cached_call, lock_key
+
+class RedisHashCacheBackendTests(PMinifierIntegrationTest):
+    def setUp(self):
+        self.cache = RedisHashCacheBackend({'client': self.cluster.redis.conn,
+                                            'codec': 'bytes',
+                                            'buckets': 4,
+                                            'batch_size': 2})
+        self.conn = self.cluster.redis.conn
+
+    def test_many(self):
+        values = {'mini:groupkey:str:%i' % i: 'id%i' % i for i in range(100)}
+        self.cache.set_many(values)
+        self.assertEqual(values, self.cache.get_many(values.keys() + ['missing']))
+        # everything lives in the buckets
+        keys = self.conn.keys('*')
+        self.assertEqual(4, len(keys))
+        self.assertEqual(100, sum(self.conn.hlen(key) for key in keys))
+        for key in keys:
+            self.assertTrue(0 < self.conn.ttl(key) <= 3600)
+
+        self.cache.delete_many(values.keys()[:50])
+        self.assertEqual(50, len(self.cache.get_many(values.keys())))
+
+    def test_bucket_count(self):
+        self.assertEqual(1, bucket_count(10))
+        self.assertEqual(11, bucket_count(1001))
+        cache = RedisHashCacheBackend({'client': self.conn, 'entries': 10 ** 6})
+        self.assertEqual(10 ** 4, cache.buckets)
+        self.assertRaises(ValueError, RedisHashCacheBackend, {'client': self.conn})
+
+    def test_single_keys(self):
+        self.cache.set('key', 'value')
+        self.assertEqual('value', self.cache.get('key'))
+        self.assertEqual(('value', None), self.cache.get_with_ttl('key'))
+        self.cache.delete('key')
+        self.assertEqual(None, self.cache.get('key'))
+        self.assertEqual({}, self.cache.get_many([]))
+
+    def test_negative_entries_skipped(self):
+        self.cache.set_many({'key': 'value', 'negative': NOT_FOUND}, timeout=60)
+        self.assertEqual({'key': 'value'}, self.cache.get_many(['key', 'negative']))
+
+    def test_locks_stay_strings(self):
+        self.assertTrue(self.cache.add(lock_key('key'), '1', 10))
+        self.assertFalse(self.cache.add(lock_key('key'), '1', 10))
+        self.assertTrue(0 < self.conn.ttl(lock_key('key')) <= 10)
+        self.assertEqual('value', cached_call(self.cache, 'other', lambda: 'value',
+                                              lock_timeout=10))
+        self.assertEqual(None, self.conn.get(lock_key('other')))
+        self.assertEqual({'other': 'value', lock_key('key'): '1'},
+                         self.cache.get_many(['other', lock_key('key')]))
+        self.cache.delete_many([lock_key('key')])
+        self.assertEqual(None, self.conn.get(lock_key('key')))
+
+    def test_sharded(self):
+        nodes = [redis.Redis('127.0.0.1', self.cluster.redis.port, db) for db in (1, 2)]
+        cache = RedisHashCacheBackend({'nodes': nodes, 'codec': 'bytes', 'buckets': 16})
+        values = {'key%i' % i: 'value%i' % i for i in range(100)}
+        cache.set_many(values)
+        self.assertEqual(16, sum(node.dbsize() for node in nodes))
+        self.assertTrue(all(node.dbsize() for node in nodes))
+        self.assertEqual(values, cache.get_many(values.keys()))
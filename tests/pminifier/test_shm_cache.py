@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from pminifier.shm_cache import SharedMemoryCache
+
+class SharedMemoryCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache')
+        self.cache = SharedMemoryCache(self.path, slots=64, slot_size=128)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.dir)
+
+    def test_get_and_set(self):
+        self.assertEqual(None, self.cache.get('a'))
+        self.cache.set('a', 'http://google.com')
+        self.cache.set_many({'b': u'http://g\xf6\xf6gle.com', u'c': 5})
+        self.assertEqual({'a': 'http://google.com', 'b': u'http://g\xf6\xf6gle.com', 'c': 5},
+                         self.cache.get_many(['a', 'b', 'c', 'd']))
+        self.cache.delete('a')
+        self.assertEqual(None, self.cache.get('a'))
+        self.cache.clear()
+        self.assertEqual({}, self.cache.get_many(['a', 'b', 'c']))
+
+    def test_full(self):
+        for i in range(1000):
+            self.cache.set('key%i' % i, i)
+        found = self.cache.get_many(['key%i' % i for i in range(1000)])
+        self.assertTrue(0 < len(found) <= 64)
+        for key, value in found.iteritems():
+            self.assertEqual(key, 'key%i' % value)
+        self.assertEqual(999, self.cache.get('key999'))
+
+    def test_too_large(self):
+        self.cache.set('a', 'x' * 200)
+        self.assertEqual(None, self.cache.get('a'))
+
+    def test_timeout(self):
+        with mock.patch('time.time', return_value=1000.0):
+            self.cache.set('a', 1, timeout=10)
+            self.cache.set('b', 2)
+        with mock.patch('time.time', return_value=1050.0):
+            self.assertEqual({'b': 2}, self.cache.get_many(['a', 'b']))
+
+    def test_shared_between_instances(self):
+        other = SharedMemoryCache(self.path, slots=64, slot_size=128)
+        self.cache.set('a', 'http://google.com')
+        self.assertEqual('http://google.com', other.get('a'))
+        other.close()
+        self.assertRaises(ValueError, SharedMemoryCache, self.path, slots=32, slot_size=128)
+
+    def test_shared_with_forked_processes(self):
+        pids = []
+        for n in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    cache = SharedMemoryCache(self.path, slots=64, slot_size=128)
+                    for i in range(200):
+                        cache.set('proc%i' % n, i)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        self.assertEqual({'proc%i' % n: 199 for n in range(4)},
+                         self.cache.get_many(['proc%i' % n for n in range(4)]))
+
+    def test_concurrent_readers_see_whole_values(self):
+        cache = SharedMemoryCache(os.path.join(self.dir, 'small'), slots=1, slot_size=128)
+        stop = threading.Event()
+        seen = set()
+        def write():
+            i = 0
+            while not stop.is_set():
+                cache.set('a', str(i % 10) * 50)
+                i += 1
+        def read():
+            for i in range(2000):
+                value = cache.get('a')
+                if value is not None:
+                    seen.add(value)
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            read()
+        finally:
+            stop.set()
+            writer.join()
+        for value in seen:
+            self.assertEqual(value[0] * 50, value)
+        cache.close()
@@ -2,19 +2,22 @@
 import unittest
 import sys
 import os
+import tempfile
+import threading
+import time
 import mock
+import redis
 
 from pminifier.test.integration import PMinifierIntegrationTest
-from pminifier.minifier import SimplerMinifier, Minifier
+from pminifier.minifier import Minifier
+from pminifier.bloom import KnownUrls
+from pminifier.negative_cache import NOT_FOUND
+from pminifier.shm_cache import SharedMemoryCache
+from pminifier.stampede import lock_key
 
 class SimplerMinifierTests(PMinifierIntegrationTest):
     def setUp(self):
-        mongo_db = mock.MagicMock()
-        mongo_db.connection = self.cluster.mongo.conn
-        mongo_db.name = 'pminifier'
-        self.m = SimplerMinifier(mongo_db,
-                                 self.cluster.redis.conn,
-                                 'groupkey')
+        self.m = self.simpler_minifier()
 
     def test_retrieve_bad_urls(self):
         self.assertRaises(Minifier.DoesNotExist, self.m.get_string, "AfTea")
@@ -52,6 +55,220 @@ class SimplerMinifierTests(PMinifierIntegrationTest):
         keys_fourth = self.m._cache_key_names('id', ['another thing'])
         self.assertNotEqual(set(keys_third.keys()), set(keys_fourth.keys()))
 
+    def test_coalesce(self):
+        m = self.simpler_minifier(coalesce=True)
+        lookup = m._get_id_multi
+        def slow_lookup(*args, **kwargs):
+            time.sleep(0.1)
+            return lookup(*args, **kwargs)
+        results = []
+        with mock.patch.object(m, '_get_id_multi', side_effect=slow_lookup) as spy:
+            threads = [threading.Thread(target=lambda: results.append(
+                           m.get_ids(["http://www.youtube.com/"])))
+                       for i in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(1, spy.call_count)
+        self.assertEqual(5, len(results))
+        self.assertEqual(1, len(set(r["http://www.youtube.com/"] for r in results)))
+
+    def test_lookup_lock(self):
+        # separate instances stand for separate processes
+        minifiers = [self.simpler_minifier(lock_timeout=5) for i in range(5)]
+        url = "http://www.youtube.com/"
+        o_id = self.m.get_id(url)
+        self.cluster.redis.conn.flushdb()
+        lookup = Minifier._get_id_multi
+        calls = []
+        def slow_lookup(*args, **kwargs):
+            calls.append(args)
+            time.sleep(0.1)
+            return lookup(*args, **kwargs)
+        results = []
+        with mock.patch.object(Minifier, '_get_id_multi', autospec=True,
+                               side_effect=slow_lookup):
+            threads = [threading.Thread(target=lambda m=m: results.append(m.get_ids([url])))
+                       for m in minifiers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual([{url: o_id}] * 5, results)
+        self.assertEqual([], self.cluster.redis.conn.keys('*:lock'))
+
+    def test_lookup_lock_timeout(self):
+        m = self.simpler_minifier(lock_timeout=0.2)
+        url = "http://www.youtube.com/"
+        o_id = self.m.get_id(url)
+        self.cluster.redis.conn.flushdb()
+        # a process that died holding the lock
+        key = m._cache_key_names('str', [url]).keys()[0]
+        self.cluster.redis.conn.set(key + ':lock', 1)
+        self.assertEqual({url: o_id}, m.get_ids([url]))
+
+    def test_lookup_lock_taken_over(self):
+        m = self.simpler_minifier(lock_timeout=5)
+        url = "http://www.youtube.com/"
+        lock = lock_key(m._cache_key_names('str', [url]).keys()[0])
+        lookup = m._get_id_multi
+        def expired_lookup(*args, **kwargs):
+            # the lock expired and another process took it
+            self.cluster.redis.conn.set(lock, 'other')
+            return lookup(*args, **kwargs)
+        with mock.patch.object(m, '_get_id_multi', side_effect=expired_lookup):
+            m.get_ids([url])
+        self.assertEqual('other', self.cluster.redis.conn.get(lock))
+
+    def test_early_refresh(self):
+        m = self.simpler_minifier(early_refresh=60)
+        url = "http://www.youtube.com/"
+        o_id = m.get_id(url)
+        key = m._cache_key_names('str', [url]).keys()[0]
+        self.cluster.redis.conn.expire(key, 5)
+        with mock.patch('random.random', return_value=0.5):
+            self.assertEqual({url: o_id}, m.get_ids([url]))
+        self.assertTrue(self.cluster.redis.conn.ttl(key) > 5)
+
+    def test_sharded_redis(self):
+        nodes = [redis.Redis('127.0.0.1', self.cluster.redis.port, db) for db in (1, 2, 3)]
+        m = self.simpler_minifier(redis_conn=nodes, lock_timeout=5)
+        urls = ['http://www.youtube.com/%i' % i for i in range(30)]
+        ids = m.get_ids(urls)
+        self.assertEqual(60, sum(node.dbsize() for node in nodes))
+        self.assertTrue(all(node.dbsize() for node in nodes))
+        self.assertEqual([], sum((node.keys('*:lock') for node in nodes), []))
+
+        other = self.simpler_minifier(redis_conn=nodes)
+        with mock.patch.object(Minifier, '_get_id_multi') as lookup:
+            self.assertEqual(ids, other.get_ids(urls, dont_create=True))
+            self.assertEqual({id: url for url, id in ids.iteritems()},
+                             other.get_strings(ids.values()))
+            self.assertFalse(lookup.called)
+
+    def test_hash_buckets(self):
+        m = self.simpler_minifier(hash_buckets=8, negative_ttl=60)
+        urls = ['http://www.youtube.com/%i' % i for i in range(30)]
+        ids = m.get_ids(urls)
+        self.assertEqual(None, m.get_id('http://missing.com/', dont_create=True))
+        keys = self.cluster.redis.conn.keys('*')
+        self.assertTrue(keys)
+        self.assertTrue(all(key.startswith('mini:h:') for key in keys))
+
+        other = self.simpler_minifier(hash_buckets=8)
+        with mock.patch.object(Minifier, '_get_id_multi') as lookup:
+            self.assertEqual(ids, other.get_ids(urls, dont_create=True))
+            self.assertFalse(lookup.called)
+        self.assertEqual(urls[0], other.get_string(ids[urls[0]]))
+
+    def test_hash_buckets_without_early_refresh(self):
+        self.assertRaises(ValueError, self.simpler_minifier, hash_buckets=8, early_refresh=60)
+
+    def test_negative_cache(self):
+        m = self.simpler_minifier(negative_ttl=60)
+        url = "http://www.youtube.com/"
+        with mock.patch.object(m, '_get_id_multi', wraps=m._get_id_multi) as lookup:
+            self.assertEqual(None, m.get_id(url, dont_create=True))
+            self.assertEqual(None, m.get_id(url, dont_create=True))
+            self.assertEqual({}, m.get_ids([url], dont_create=True))
+            self.assertEqual(1, lookup.call_count)
+            # creating the url bypasses and replaces the negative entry
+            o_id = m.get_id(url)
+            self.assertEqual(2, lookup.call_count)
+        self.assertEqual(o_id, m.get_id(url, dont_create=True))
+
+        # other processes only see the shared entry
+        other = self.simpler_minifier(negative_ttl=60)
+        self.assertEqual(o_id, other.get_id(url, dont_create=True))
+
+    def test_negative_cache_strings(self):
+        m = self.simpler_minifier(negative_ttl=60)
+        self.assertRaises(Minifier.DoesNotExist, m.get_string, "AfTea")
+        other = self.simpler_minifier(negative_ttl=60)
+        with mock.patch.object(m.db, 'urlById', wraps=m.db.urlById) as collection:
+            self.assertRaises(Minifier.DoesNotExist, m.get_string, "AfTea")
+            other.db = m.db
+            self.assertRaises(Minifier.DoesNotExist, other.get_string, "AfTea")
+            self.assertEqual(0, collection.find.call_count)
+
+    def test_caches_both_directions(self):
+        url = "http://www.youtube.com/"
+        o_id = self.m.get_id(url)
+        with mock.patch.object(self.m.db, 'urlById', wraps=self.m.db.urlById) as collection:
+            self.assertEqual({o_id: url}, self.m.get_strings([o_id]))
+            self.assertEqual(0, collection.find.call_count)
+
+        self.cluster.redis.flush()
+        self.m.get_strings([o_id])
+        with mock.patch.object(self.m, '_get_id_multi') as lookup:
+            self.assertEqual({url: o_id}, self.m.get_ids([url]))
+            self.assertEqual(0, lookup.call_count)
+
+    def test_reverse_entries_stay_in_group(self):
+        other = self.simpler_minifier('other')
+        url = "http://www.youtube.com/"
+        o_id = other.get_id(url)
+        self.cluster.redis.flush()
+        self.assertEqual({o_id: url}, self.m.get_strings([o_id]))
+        self.assertNotEqual(o_id, self.m.get_id(url))
+
+    def test_local_cache_per_instance(self):
+        other = self.simpler_minifier('other', lrusize=10, lru_policy='tinylfu')
+        url = "http://www.youtube.com/"
+        o_id = self.m.get_id(url)
+        self.assertNotEqual(o_id, other.get_id(url))
+        self.assertEqual(1, len(other.local_cache))
+        self.assertEqual(10, other.local_cache.max_entries)
+        self.assertEqual('tinylfu', other.local_cache.policy)
+        self.assertEqual(o_id, self.m.get_id(url))
+        self.assertEqual(1, self.m.local_cache.stats()['hits'])
+
+    def test_shared_cache(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.unlink, path)
+        m = self.simpler_minifier(shared_cache=SharedMemoryCache(path, slots=1024))
+        url = "http://www.youtube.com/"
+        o_id = m.get_id(url)
+
+        other = self.simpler_minifier(shared_cache=SharedMemoryCache(path, slots=1024))
+        self.cluster.redis.flush()
+        with mock.patch.object(other, '_get_id_multi') as lookup:
+            self.assertEqual(o_id, other.get_id(url))
+            self.assertEqual(url, other.get_string(o_id))
+            self.assertEqual(0, lookup.call_count)
+
+    def test_shared_cache_skips_negative_entries(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.unlink, path)
+        shared = SharedMemoryCache(path, slots=1024)
+        m = self.simpler_minifier(shared_cache=shared, negative_ttl=60)
+        url = "http://www.youtube.com/"
+        self.assertEqual(None, m.get_id(url, dont_create=True))
+        key = m._cache_key_names('str', [url]).keys()[0]
+        self.assertEqual(None, shared.get(key))
+        self.assertEqual(NOT_FOUND, m._redis_cache.get(key))
+
+    def test_redis_values_stay_plain(self):
+        url = u"http://www.y\xf6utube.com/"
+        o_id = self.m.get_id(url)
+        id_key = self.m._cache_key_names('str', [url]).keys()[0]
+        url_key = self.m._cache_key_names('id', [o_id]).keys()[0]
+        self.assertEqual(o_id, self.cluster.redis.conn.get(id_key))
+        self.assertEqual(url.encode('utf-8'), self.cluster.redis.conn.get(url_key))
+        self.assertTrue(0 < self.cluster.redis.conn.ttl(id_key) <= self.m.cache_expiry)
+
+    def test_known_urls(self):
+        known = KnownUrls(1000, redis_conn=self.cluster.redis.conn)
+        m = self.simpler_minifier(known_urls=known)
+        o_id = m.get_id("http://www.youtube.com/")
+        known.build(m.db.urlById, 'groupkey')
+        with mock.patch.object(m.cache, 'get_many', wraps=m.cache.get_many) as get_many:
+            self.assertEqual(None, m.get_id("http://nope.com/", dont_create=True))
+            self.assertEqual(0, get_many.call_count)
+        self.assertEqual(o_id, m.get_id("http://www.youtube.com/", dont_create=True))
+
     def test_store_and_retrieve_urls(self):
         urls_oid = []
         urls = ["http://google.com", "http://www.google.com",
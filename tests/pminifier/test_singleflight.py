@@ -0,0 +1,60 @@
+import threading
+import time
+import unittest
+
+from pminifier.singleflight import SingleFlight
+
+class SingleFlightTests(unittest.TestCase):
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def slow_lookup(self, keys):
+        self.calls.append(sorted(keys))
+        self.started.set()
+        self.release.wait(5)
+        return {key: key.upper() for key in keys if key != 'missing'}
+
+    def run_threads(self, targets):
+        threads = [threading.Thread(target=target) for target in targets]
+        threads[0].start()
+        self.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05) # let the others queue up behind the first call
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+
+    def test_do(self):
+        results = []
+        target = lambda: results.append(self.flight.do('a', lambda: self.slow_lookup(['a'])['a']))
+        self.run_threads([target] * 5)
+        self.assertEqual(['A'] * 5, results)
+        self.assertEqual([['a']], self.calls)
+
+    def test_do_many_overlap(self):
+        results = []
+        first = lambda: results.append(self.flight.do_many(['a', 'b', 'missing'], self.slow_lookup))
+        second = lambda: results.append(self.flight.do_many(['b', 'c', 'missing'], self.slow_lookup))
+        self.run_threads([first, second])
+        self.assertEqual([['a', 'b', 'missing'], ['c']], self.calls)
+        self.assertEqual([{'a': 'A', 'b': 'B'}, {'b': 'B', 'c': 'C'}], results)
+
+    def test_errors_reach_waiters(self):
+        errors = []
+        def failing(keys):
+            self.started.set()
+            self.release.wait(5)
+            raise KeyError('nope')
+        def target():
+            try:
+                self.flight.do_many(['a'], failing)
+            except KeyError as e:
+                errors.append(e)
+        self.run_threads([target] * 3)
+        self.assertEqual(3, len(errors))
+        # nothing is left in flight
+        self.assertEqual({'a': 1}, self.flight.do_many(['a'], lambda keys: {'a': 1}))
@@ -0,0 +1,103 @@
+import threading
+import time
+import unittest
+
+import mock
+
+from pminifier.local_cache import LocalCache
+from pminifier.negative_cache import NOT_FOUND
+from pminifier.stampede import cached_call, lock_key, refresh_early
+
+class RefreshEarlyTests(unittest.TestCase):
+    def test_probability_grows_as_ttl_runs_out(self):
+        self.assertFalse(refresh_early(100, 1, rand=lambda: 0.5))
+        self.assertTrue(refresh_early(0.5, 1, rand=lambda: 0.5))
+        self.assertTrue(refresh_early(0, 1, rand=lambda: 0.0))
+
+    def test_off(self):
+        self.assertFalse(refresh_early(None, 1, rand=lambda: 0.99))
+        self.assertFalse(refresh_early(0.1, None, rand=lambda: 0.99))
+
+class CachedCallTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = LocalCache(max_entries=None)
+        self.calls = []
+
+    def slow_compute(self, value='value', delay=0.1):
+        def compute():
+            self.calls.append(value)
+            time.sleep(delay)
+            return value
+        return compute
+
+    def run_threads(self, func, count=5):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func()))
+                   for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_without_lock_every_miss_computes(self):
+        results = self.run_threads(lambda: cached_call(self.cache, 'key', self.slow_compute()))
+        self.assertEqual(['value'] * 5, results)
+        self.assertEqual(5, len(self.calls))
+
+    def test_misses_not_stored(self):
+        self.assertEqual(None, cached_call(self.cache, 'key', lambda: None))
+        self.assertEqual(0, len(self.cache))
+        # a negative entry is a miss, compute decides about it
+        self.cache.set('key', NOT_FOUND)
+        self.assertEqual('value', cached_call(self.cache, 'key', lambda: 'value'))
+        self.assertEqual('value', self.cache.get('key'))
+
+    def test_lock_computes_once(self):
+        results = self.run_threads(lambda: cached_call(self.cache, 'key', self.slow_compute(),
+                                                       lock_timeout=5, poll_interval=0.01))
+        self.assertEqual(['value'] * 5, results)
+        self.assertEqual(['value'], self.calls)
+        self.assertEqual(None, self.cache.get(lock_key('key')))
+
+    def test_lock_timeout(self):
+        # a holder that never finishes only delays the others
+        self.cache.add(lock_key('key'), '1', 60)
+        start = time.time()
+        self.assertEqual('value', cached_call(self.cache, 'key', self.slow_compute(delay=0),
+                                              lock_timeout=0.2, poll_interval=0.01))
+        self.assertTrue(time.time() - start >= 0.2)
+
+    def test_failed_holder_releases_lock(self):
+        def fail():
+            raise ValueError()
+        self.assertRaises(ValueError, cached_call, self.cache, 'key', fail, lock_timeout=5)
+        self.assertEqual(None, self.cache.get(lock_key('key')))
+
+    def test_holder_keeps_lock_taken_over(self):
+        def compute():
+            # the lock expired and another process took it
+            self.cache.set(lock_key('key'), 'other')
+            return 'value'
+        self.assertEqual('value', cached_call(self.cache, 'key', compute, lock_timeout=5))
+        self.assertEqual('other', self.cache.get(lock_key('key')))
+
+    def test_early_refresh(self):
+        self.cache.set('key', 'old', timeout=100)
+        compute = self.slow_compute('new', delay=0)
+        with mock.patch('random.random', return_value=0.5):
+            self.assertEqual('old', cached_call(self.cache, 'key', compute, early_refresh=1))
+            self.assertEqual([], self.calls)
+        self.cache.set('key', 'old', timeout=0.5)
+        with mock.patch('random.random', return_value=0.5):
+            self.assertEqual('new', cached_call(self.cache, 'key', compute, early_refresh=1))
+        self.assertEqual(['new'], self.calls)
+        self.assertEqual('new', self.cache.get('key'))
+
+    def test_early_refresh_by_one_process(self):
+        self.cache.set('key', 'old', timeout=0.5)
+        self.cache.add(lock_key('key'), '1', 60)
+        with mock.patch('random.random', return_value=0.5):
+            self.assertEqual('old', cached_call(self.cache, 'key', self.slow_compute('new'),
+                                                early_refresh=1))
+        self.assertEqual([], self.calls)
@@ -0,0 +1,67 @@
+import unittest
+
+import mock
+
+from pminifier.local_cache import LocalCache
+from pminifier.negative_cache import NOT_FOUND
+from pminifier.tiered_cache import Tier, TieredCache
+
+class TieredCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.fast = LocalCache(100)
+        self.slow = LocalCache(100)
+        self.cache = TieredCache([self.fast, None, self.slow])
+
+    def test_reads_in_order(self):
+        self.fast.set('a', 'fast')
+        self.slow.set_many({'a': 'slow', 'b': 'slow'})
+        with mock.patch.object(self.slow, 'get_many', wraps=self.slow.get_many) as get_many:
+            self.assertEqual({'a': 'fast', 'b': 'slow'}, self.cache.get_many(['a', 'b', 'c']))
+            get_many.assert_called_once_with(['b', 'c'])
+        self.assertEqual('slow', self.fast.get('b')) # backfilled
+        self.assertEqual(None, self.cache.get('c'))
+
+    def test_writes_every_tier(self):
+        self.cache.set_many({'a': 1, 'b': 2})
+        self.cache.set('c', 3)
+        for tier in (self.fast, self.slow):
+            self.assertEqual({'a': 1, 'b': 2, 'c': 3}, tier.get_many(['a', 'b', 'c']))
+        self.cache.delete('a')
+        self.assertEqual(None, self.slow.get('a'))
+        self.cache.clear()
+        self.assertEqual(0, len(self.fast) + len(self.slow))
+
+    def test_tier_policies(self):
+        readonly = LocalCache(100)
+        readonly.set('b', 2)
+        cache = TieredCache([Tier(self.fast, backfill=False), Tier(readonly, write=False),
+                             self.slow])
+        cache.set('a', 1)
+        self.assertEqual(None, readonly.get('a'))
+        self.assertEqual({'b': 2}, cache.get_many(['b']))
+        self.assertEqual(None, self.fast.get('b'))
+
+    def test_tier_timeouts(self):
+        fast = mock.Mock(wraps=self.fast)
+        slow = mock.Mock(wraps=self.slow)
+        cache = TieredCache([Tier(fast, timeout=60), slow])
+        cache.set_many({'a': 1})
+        fast.set_many.assert_called_once_with({'a': 1}, timeout=60)
+        slow.set_many.assert_called_once_with({'a': 1}, timeout=None)
+        cache.set_many({'b': 2}, timeout=5)
+        fast.set_many.assert_called_with({'b': 2}, timeout=5)
+
+        self.slow.set('c', 3)
+        cache.get_many(['c'])
+        fast.set_many.assert_called_with({'c': 3}, timeout=60)
+
+    def test_negative_markers_arent_backfilled(self):
+        self.slow.set('a', NOT_FOUND)
+        self.assertEqual({'a': NOT_FOUND}, self.cache.get_many(['a']))
+        self.assertEqual(None, self.fast.get('a'))
+
+    def test_tier_without_negatives(self):
+        cache = TieredCache([Tier(self.fast, negatives=False), self.slow])
+        cache.set_many({'a': NOT_FOUND, 'b': 2}, timeout=5)
+        self.assertEqual({'b': 2}, self.fast.get_many(['a', 'b']))
+        self.assertEqual({'a': NOT_FOUND, 'b': 2}, self.slow.get_many(['a', 'b']))
@@ -0,0 +1,66 @@
+# - coding: utf-8 -
+import cPickle as pickle
+import unittest
+
+from pminifier import value_codecs
+from pminifier.value_codecs import (AutoCodec, BytesCodec, CompressedCodec, IntCodec,
+                                    PickleCodec, RawCodec, get_codec)
+
+VALUES = ['0U', u'http://www.google.com/', u'nīcē ūnīcōde', '', 0, 3294,
+          9999999999999999, -5, None, {'http://google.com': '0U'}]
+
+class CodecTests(unittest.TestCase):
+    def assertRoundTrip(self, codec, value):
+        decoded = codec.decode(codec.encode(value))
+        self.assertEqual(value, decoded)
+        self.assertEqual(type(value), type(decoded))
+
+    def test_round_trips(self):
+        codecs = [PickleCodec(), RawCodec(), IntCodec(), AutoCodec(),
+                  CompressedCodec(RawCodec(), threshold=0)]
+        for codec in codecs:
+            for value in VALUES:
+                self.assertRoundTrip(codec, value)
+
+    def test_msgpack(self):
+        if value_codecs.msgpack is None:
+            return
+        codec = get_codec('msgpack')
+        for value in ['0U', u'http://www.google.com/', 3294, None]:
+            self.assertRoundTrip(codec, value)
+        self.assertEqual({'http://google.com': '0U'},
+                         codec.decode(codec.encode({'http://google.com': '0U'})))
+
+    def test_compact(self):
+        self.assertEqual('\x010U', RawCodec().encode('0U'))
+        self.assertEqual(5, len(IntCodec().encode(9999999)))
+
+    def test_reads_legacy_pickles(self):
+        for codec in [RawCodec(), IntCodec(), AutoCodec()]:
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                for value in VALUES:
+                    self.assertEqual(value, codec.decode(pickle.dumps(value, protocol)))
+
+    def test_bytes(self):
+        codec = get_codec('bytes')
+        self.assertEqual('0U', codec.encode('0U'))
+        self.assertEqual('0U', codec.decode('0U'))
+        self.assertEqual(u'nīcē'.encode('utf-8'), codec.decode(codec.encode(u'nīcē')))
+        self.assertRaises(TypeError, codec.encode, 5)
+
+    def test_compression_threshold(self):
+        codec = get_codec('raw', compress_threshold=100)
+        url = u'http://www.google.com/?q=' + u'parsely' * 100
+        self.assertTrue(len(codec.encode(url)) < len(url) / 2)
+        self.assertEqual(url, codec.decode(codec.encode(url)))
+        self.assertEqual('\x010U', codec.encode('0U'))
+
+    def test_compressed_decodes_with_its_codec(self):
+        url = 'http://www.google.com/?q=' + 'parsely' * 100
+        codec = CompressedCodec(BytesCodec(), threshold=16)
+        self.assertEqual(url, codec.decode(codec.encode(url)))
+        self.assertEqual('0U', codec.decode(codec.encode('0U')))
+        self.assertRaises(ValueError, get_codec, 'bytes', 16)
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, get_codec, 'nope')
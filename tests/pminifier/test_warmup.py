@@ -0,0 +1,59 @@
+import mock
+
+from pminifier.test.integration import PMinifierIntegrationTest
+from pminifier.minifier import CachedMinifier, Minifier
+from pminifier.redis_cache_backend import RedisCacheBackend
+from pminifier.warmup import EntryStream, warm
+
+class WarmupTests(PMinifierIntegrationTest):
+    def setUp(self):
+        self.m = Minifier(self.cluster.mongo.conn, 'pminifier')
+        self.urls = ['http://example.com/%i' % i for i in range(10)]
+        self.ids = self.m.get_multiple_ids(self.urls, 'test')
+        self.other = self.m.get_id('http://other.com/', 'other')
+
+    def test_stream(self):
+        ids = sorted(self.m.base62_to_ints(self.ids.values()))
+        batches = list(EntryStream(self.m.db.urlById, 'test', batch_size=3))
+        self.assertEqual([3, 3, 3, 1], [len(batch) for batch in batches])
+        self.assertEqual(ids[::-1], [e['_id'] for batch in batches for e in batch])
+        stream = EntryStream(self.m.db.urlById, min_id=ids[2], max_id=ids[5],
+                             newest_first=False, batch_size=2)
+        self.assertEqual(ids[2:6], [e['_id'] for batch in stream for e in batch])
+
+    def test_warm_simpler(self):
+        m = self.simpler_minifier('test')
+        self.assertEqual(11, warm(m, batch_size=4))
+        with mock.patch.object(m, '_get_id_multi') as lookup:
+            self.assertEqual(self.ids, m.get_ids(self.urls))
+            self.assertEqual('http://other.com/', m.get_string(self.other))
+            self.assertEqual(0, lookup.call_count)
+        # URLs of other groups aren't cached by URL
+        self.assertNotEqual(self.other, m.get_id('http://other.com/'))
+
+    def test_warm_cached(self):
+        cache_client = RedisCacheBackend({'client': self.cluster.redis.conn})
+        m = CachedMinifier(self.cluster.mongo.conn, 'pminifier', cache_client)
+        self.assertEqual(3, warm(m, groupkey='test', limit=3, batch_size=2))
+        newest = sorted(self.ids.items(), key=lambda item: self.m.base62_to_int(item[1]))[-3:]
+        with mock.patch.object(m.db, 'urlById') as collection:
+            self.assertEqual(dict(newest), m.get_multiple_ids(dict(newest).keys(), 'test'))
+            self.assertEqual(0, collection.find.call_count)
+
+    def test_throttle(self):
+        m = self.simpler_minifier('test')
+        with mock.patch('time.sleep') as sleep:
+            warm(m, batch_size=5, max_rate=5)
+        self.assertEqual(3, sleep.call_count)
+        self.assertTrue(sleep.call_args_list[0][0][0] > 0.5)
+
+    def test_local(self):
+        m = self.simpler_minifier('test', lrusize=6)
+        warm(m, groupkey='test', local=True)
+        newest = sorted(self.ids.items(), key=lambda item: self.m.base62_to_int(item[1]))[-3:]
+        self.cluster.redis.flush()
+        with mock.patch.object(m, '_get_items') as get_items:
+            for url, o_id in newest:
+                self.assertEqual(o_id, m.get_id(url))
+                self.assertEqual(url, m.get_string(o_id))
+            self.assertEqual(0, get_items.call_count)